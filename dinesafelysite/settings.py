@@ -104,6 +104,61 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# The database backend is shared between the web and clock processes, so data
+# warmed by scheduled jobs is visible to every web worker. Once a cache holds
+# MAX_ENTRIES, a third of it is culled starting from the lowest keys, so the
+# entries that can be rebuilt on demand and come in large numbers (Yelp
+# responses, map tiles, recommendation buckets) go to their own "responses"
+# cache. The default cache keeps the job locks, the last good COVID data and
+# the favorites, and its cap is never expected to be reached.
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", "dinesafely_cache"),
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    "responses": {
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"
+        ),
+        "LOCATION": os.environ.get(
+            "RESPONSE_CACHE_LOCATION", "dinesafely_response_cache"
+        ),
+        "OPTIONS": {"MAX_ENTRIES": 50000},
+    },
+}
+
+# Restaurant keyword search. The SQLite backend reads an FTS5 table that the
+# restaurant migrations create on SQLite only. When unset, the backend is
+# chosen from the database vendor, see restaurant.search.get_search_backend.
+
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND")
+
+# Spatial index behind the nearby restaurants endpoint. The SQLite backend
+# keeps an R*Tree that the restaurant migrations create on SQLite only. When
+# unset, the backend is chosen from the database vendor, see
+# restaurant.geo.get_geo_backend. Nearest neighbour searches start
+# GEO_SEARCH_RADIUS_KM around the point and widen up to GEO_MAX_RADIUS_KM.
+GEO_BACKEND = os.environ.get("GEO_BACKEND")
+GEO_SEARCH_RADIUS_KM = 0.5
+GEO_MAX_RADIUS_KM = 50
+
+# GeoJSON map tiles, see restaurant.tiles. Up to GEO_TILE_CLUSTER_MAX_ZOOM the
+# restaurants of a tile are clustered on a GEO_TILE_CLUSTER_GRID square grid;
+# cached tiles are retired when restaurants change, browsers revalidate them
+# with their ETag after GEO_TILE_MAX_AGE seconds
+GEO_TILE_MAX_ZOOM = 20
+GEO_TILE_CLUSTER_MAX_ZOOM = 14
+GEO_TILE_CLUSTER_GRID = 8
+GEO_TILE_MAX_POINTS = 1000
+GEO_TILE_TTL = 24 * 60 * 60
+GEO_TILE_MAX_AGE = 5 * 60
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -146,6 +201,7 @@ STATICFILES_DIRS = [
 
 
 YELP_BUSINESS_API = "https://api.yelp.com/v3/businesses/"
+YELP_BUSINESS_MATCH_API = YELP_BUSINESS_API + "matches"
 YELP_ACCESS_TOKEN_REVIEW = os.environ.get("YELP_ACCESS_TOKEN_REVIEW")
 
 YELP_ACCESS_TOKEN_BUSINESS_SEARCH = os.environ.get("YELP_ACCESS_TOKEN_BUSINESS_SEARCH")
@@ -154,10 +210,136 @@ YELP_ACCESS_TOKEN_BUSINESS_ID = os.environ.get("YELP_ACCESS_TOKEN_BUSINESS_ID")
 
 YELP_TOKEN_CHUANQI = os.environ.get("YELP_TOKEN_CHUANQI")
 
+# Yelp responses are cached per business; stale entries are served for up to
+# YELP_CACHE_STALE_TTL more seconds while they are refreshed in the background
+YELP_CACHE_TTL = {
+    "info": 24 * 60 * 60,
+    "reviews": 6 * 60 * 60,
+    "missing": 60 * 60,
+}
+YELP_CACHE_STALE_TTL = 7 * 24 * 60 * 60
+
+# Yelp enrichment of newly ingested restaurants
+YELP_ENRICHMENT_WORKERS = int(os.environ.get("YELP_ENRICHMENT_WORKERS", 8))
+
+# Token bucket applied to each Yelp access token by the shared HTTP client
+YELP_REQUESTS_PER_SECOND = float(os.environ.get("YELP_REQUESTS_PER_SECOND", 5))
+YELP_REQUESTS_BURST = int(os.environ.get("YELP_REQUESTS_BURST", 5))
+
+# Shared outbound HTTP client, see restaurant.http_client. The timeout is
+# (connect, read) seconds; retries back off from `backoff` seconds with jitter.
+# Request counts are logged every metrics_log_interval seconds and after
+# every job run. REQUEST_HTTP_CLIENT is used for the calls made while a page
+# is loading, and fails fast instead of retrying.
+HTTP_CLIENT = {
+    "timeout": (3.05, 10),
+    "retries": 3,
+    "backoff": 0.5,
+    "max_backoff": 8,
+    "pool_maxsize": 16,
+    "metrics_log_interval": 5 * 60,
+}
+REQUEST_HTTP_CLIENT = {
+    "timeout": (3.05, 5),
+    "retries": 0,
+    "pool_maxsize": 16,
+    "metrics_log_interval": 5 * 60,
+}
+
 # Yelp categories
 YELP_CATEGORY_API = "https://api.yelp.com/v3/categories"
 YELP_ACCESS_TOKEN_CATEGORY = os.environ.get("YELP_ACCESS_TOKEN_CATEGORY")
 
+# NYC COVID-19 positivity by zip code, refreshed by the clock process
+COVID_DATA_URL = (
+    "https://raw.githubusercontent.com/nychealth/coronavirus-data/master/latest/"
+    "last7days-by-modzcta.csv"
+)
+COVID_DATA_TTL = 6 * 60 * 60
+
+# Seconds a user's favorite restaurant ids are cached; saving or removing a
+# favorite invalidates them immediately
+FAVORITES_CACHE_TTL = 24 * 60 * 60
+
+# Seconds the restaurant profile waits on each of its sources before
+# rendering without it
+PROFILE_SOURCE_TIMEOUTS = {
+    "covid": 2.0,
+    "yelp": 3.0,
+    "inspection": 2.0,
+    "feedback": 2.0,
+    "saved": 2.0,
+    "view": 1.0,
+}
+
+# NYC Open Restaurant Applications inspections, paged by the clock process
+SOCRATA_INSPECTIONS_API = "https://data.cityofnewyork.us/resource/4dx7-axux.json"
+SOCRATA_APP_TOKEN = os.environ.get("SOCRATA_APP_TOKEN", "dLBzJwg25psQttbxjLlQ8Z53V")
+SOCRATA_AUTH = (
+    os.environ.get("SOCRATA_USERNAME", "cx657@nyu.edu"),
+    os.environ.get("SOCRATA_PASSWORD", "Dinesafely123"),
+)
+SOCRATA_PAGE_SIZE = int(os.environ.get("SOCRATA_PAGE_SIZE", 5000))
+# An ingestion run that did not complete is resumed from its cursor at most
+# INGESTION_MAX_RESUMES times in a row before a fresh run starts over
+INGESTION_MAX_RESUMES = 3
+
+# Background jobs run by `manage.py run_jobs`, see restaurant.jobs. The
+# interval is in seconds; a job's lock expires after lock_timeout seconds
+# (its interval by default) if a worker dies while running it
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOBS = {
+    "inspections": {
+        "func": "getinspection.get_inspection_data",
+        "interval": 12 * 60 * 60,
+    },
+    "yelp_refresh": {
+        "func": "yelprestaurantdetails.refresh_yelp_restaurants",
+        "interval": 6 * 60 * 60,
+    },
+    "categories": {
+        "func": "yelprestaurantdetails.save_yelp_categories",
+        "interval": 7 * 24 * 60 * 60,
+    },
+    "covid_data": {
+        "func": "restaurant.utils.refresh_covid_data",
+        "interval": 60 * 60,
+    },
+    "top_compliant": {
+        "func": "restaurant.utils.refresh_top_compliant_restaurants",
+        "interval": 60 * 60,
+    },
+    "recommendations": {
+        "func": "restaurant.utils.refresh_recommendation_buckets",
+        "interval": 60 * 60,
+    },
+    "user_recommendations": {
+        "func": "restaurant.recommendation.refresh_all_recommendations",
+        "interval": 6 * 60 * 60,
+    },
+    "stale_recommendations": {
+        "func": "restaurant.recommendation.refresh_stale_recommendations",
+        "interval": 5 * 60,
+    },
+}
+# Seconds the chatbot candidate buckets are kept; they are rebuilt on demand
+# if the recommendations job has not refreshed them in time
+RECOMMENDATION_BUCKET_TTL = 2 * 60 * 60
+# Length of each user's precomputed recommendation list, and the number of
+# best rated matching restaurants scored to build it
+RECOMMENDATION_LIST_SIZE = 200
+RECOMMENDATION_POOL_SIZE = 2000
+YELP_REFRESH_BATCH_SIZE = int(os.environ.get("YELP_REFRESH_BATCH_SIZE", 500))
+# Yelp calls the background jobs may make per day, leaving the rest of the
+# 5,000 daily API calls for the profile pages; details are re-fetched once
+# they are YELP_DETAILS_MAX_AGE seconds old
+YELP_DAILY_BUDGET = int(os.environ.get("YELP_DAILY_BUDGET", 3000))
+YELP_DETAILS_MAX_AGE = 7 * 24 * 60 * 60
+# A restaurant Yelp could not match is retried after YELP_MATCH_RETRY_DELAY
+# seconds, doubling after every failure up to YELP_MATCH_MAX_RETRY_DELAY
+YELP_MATCH_RETRY_DELAY = 24 * 60 * 60
+YELP_MATCH_MAX_RETRY_DELAY = 30 * 24 * 60 * 60
+
 DEFAULT_IMAGE = (
     "https://www.theskinnypignyc.com/wp-content/uploads/2019/05/what"
     "shouldwedo-cecconis-750x430.jpg"
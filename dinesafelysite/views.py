@@ -1,5 +1,5 @@
 from django.shortcuts import render
-from restaurant.utils import get_compliant_restaurant_list
+from restaurant.utils import get_top_compliant_restaurant_list
 
 import logging
 
@@ -9,12 +9,7 @@ RESTAURANT_NUMBER = 18
 
 
 def index(request):
-    restaurant_list = get_compliant_restaurant_list(
-        1,
-        RESTAURANT_NUMBER,
-        rating_filter=[3, 3.5, 4, 4.5, 5],
-        compliant_filter="Compliant",
-    )
+    restaurant_list = get_top_compliant_restaurant_list(RESTAURANT_NUMBER)
     parameter_dict = {
         "restaurant_list": restaurant_list,
     }
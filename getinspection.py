@@ -2,47 +2,46 @@ import os
 import django
 
 import pandas as pd
-from sodapy import Socrata
 
-import requests
 import json
 import logging
-from django.conf import settings
-
-from apscheduler.schedulers.blocking import BlockingScheduler
+import time
+from django.db import transaction
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dinesafelysite.settings")
 django.setup()
 
-from restaurant.models import Restaurant, InspectionRecords  # noqa: E402
-from yelprestaurantdetails import save_yelp_restaurant_details  # noqa: E402
+from django.conf import settings  # noqa: E402
+from restaurant.http_client import get_http_client  # noqa: E402
+from restaurant.models import IngestionRun, Restaurant, InspectionRecords  # noqa: E402
+from restaurant.geo import get_geo_backend  # noqa: E402
+from restaurant.search import get_search_backend  # noqa: E402
+from restaurant.tiles import invalidate_tiles  # noqa: E402
+from restaurant.utils import (  # noqa: E402
+    refresh_questionnaire_aggregates,
+    refresh_top_compliant_restaurants,
+)
+from yelprestaurantdetails import (  # noqa: E402
+    match_on_yelp,
+    enrich_restaurants,
+    reset_reference_tables,
+    save_yelp_restaurant_details_bulk,
+)
 
 
-sched = BlockingScheduler()
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 500
 
-def match_on_yelp(restaurant_name, restaurant_location):
-    location_list = restaurant_location.split(", ")
-    address1 = location_list[0]
-    city = "New York"
-    state = "NY"
-    country = "US"
-
-    headers = {
-        "Authorization": "Bearer %s" % settings.YELP_ACCESS_TOKEN_BUSINESS_SEARCH
-    }
-    url = "https://api.yelp.com/v3/businesses/matches"
-    params = {
-        "name": restaurant_name,
-        "address1": address1,
-        "city": city,
-        "state": state,
-        "country": country,
-    }
-
-    response = requests.get(url, params=params, headers=headers)
-    return response.text.encode("utf8")
+SOCRATA_COLUMNS = [
+    "restaurantinspectionid",
+    "restaurantname",
+    "businessaddress",
+    "postcode",
+    "isroadwaycompliant",
+    "skippedreason",
+    "inspectedon",
+]
 
 
 def clean_inspection_data(results_df):
@@ -75,86 +74,249 @@ def clean_inspection_data(results_df):
     return restaurant_df, inspection_df
 
 
-def save_restaurants(restaurant_df, inspection_df):
-    for index, row in inspection_df.iterrows():
-        try:
-            b_id = None
-            if Restaurant.objects.filter(
-                restaurant_name=row["restaurantname"],
-                business_address=row["businessaddress"],
-                postcode=row["postcode"],
-            ).exists():
-                rt = Restaurant.objects.get(
-                    restaurant_name=row["restaurantname"],
-                    business_address=row["businessaddress"],
-                    postcode=row["postcode"],
-                )
-                Restaurant.objects.filter(
-                    restaurant_name=row["restaurantname"],
-                    business_address=row["businessaddress"],
-                    postcode=row["postcode"],
-                ).update(compliant_status=row["isroadwaycompliant"])
-                if rt.yelp_detail:
-                    save_inspections(row, rt.yelp_detail.business_id)
-                else:
-                    save_inspections(row, None)
-                logger.info(
-                    "Inspection record for restaurant saved successfully: {}".format(rt)
-                )
-            else:
-
-                response = json.loads(
-                    match_on_yelp(row["restaurantname"], row["businessaddress"])
-                )
-                if next(iter(response)) == "error" or not response["businesses"]:
-                    b_id = None
-                else:
-                    b_id = response["businesses"][0]["id"]
-
-                r = Restaurant(
-                    restaurant_name=row["restaurantname"],
-                    business_address=row["businessaddress"],
-                    postcode=row["postcode"],
-                    business_id=b_id,
-                    compliant_status=row["isroadwaycompliant"],
-                )
-                if b_id:
-                    if not Restaurant.objects.filter(business_id=b_id).exists():
-                        yelp_rest = save_yelp_restaurant_details(b_id)
-                        r.yelp_detail = yelp_rest
-                        r.save()
-                        logger.info(
-                            "Restaurant details successfully saved: {}".format(b_id)
-                        )
-                        save_inspections(row, b_id)
-
-                    else:
-                        Restaurant.objects.filter(business_id=b_id).update(
-                            compliant_status=row["isroadwaycompliant"]
-                        )
-                        logger.info("Restaurant details updated saved: {}".format(b_id))
-                        save_inspections(row, b_id)
-                else:
-                    logger.info(
-                        "Saving Restaurant details with no Business ID: {}".format(b_id)
-                    )
-                    r.yelp_detail = None
-                    r.save()
-                    logger.info(
-                        "Restaurant details saved with no business ID: {}".format(b_id)
-                    )
-                    save_inspections(row, b_id)
-
-        except Exception as e:
-            logger.error(
-                "Error while saving to table Restaurant: {} {}".format(b_id, e)
+def restaurant_keys(inspection_df):
+    return list(
+        zip(
+            inspection_df["restaurantname"],
+            inspection_df["businessaddress"],
+            inspection_df["postcode"],
+        )
+    )
+
+
+def get_existing_restaurants(keys, batch_size=BATCH_SIZE):
+    """
+    Return {(name, address, postcode): Restaurant} for the keys already in the
+    database, querying by restaurant name in batches.
+    """
+    keys = set(keys)
+    names = sorted({name for name, _, _ in keys})
+    existing = {}
+    for start in range(0, len(names), batch_size):
+        for restaurant in Restaurant.objects.filter(
+            restaurant_name__in=names[start : start + batch_size]  # noqa: E203
+        ):
+            key = (
+                restaurant.restaurant_name,
+                restaurant.business_address,
+                restaurant.postcode,
             )
+            if key in keys:
+                existing[key] = restaurant
+    return existing
+
+
+def enrich_new_restaurants(keys, existing):
+    """
+    Match every restaurant key that is not in the database yet on Yelp
+    concurrently, save their details in bulk and return
+    {(name, address, postcode): (business_id, YelpRestaurantDetails or None)}.
+    """
+    new_keys = [key for key in set(keys) if key not in existing]
+    if not new_keys:
+        return {}
+
+    enriched = enrich_restaurants(new_keys)
+    details = save_yelp_restaurant_details_bulk(enriched)
+    return {
+        key: (business_id, details.get(business_id))
+        for key, (business_id, _) in enriched.items()
+    }
 
-            # raise
-    return
 
+def create_new_restaurants(inspection_df, existing, matches, batch_size=BATCH_SIZE):
+    """
+    Bulk create the restaurants of inspection_df that are not in existing and
+    return {(name, address, postcode): Restaurant} for every key in the frame.
+    A restaurant matched to a Yelp business that another restaurant already
+    owns is folded into that restaurant, like the row by row import did.
+    """
+    restaurants = dict(existing)
+    matched_ids = {b_id for b_id, _ in matches.values() if b_id}
+    owners = {}
+    matched_list = sorted(matched_ids)
+    for start in range(0, len(matched_list), batch_size):
+        for restaurant in Restaurant.objects.filter(
+            business_id__in=matched_list[start : start + batch_size]  # noqa: E203
+        ):
+            owners[restaurant.business_id] = restaurant
+
+    latest_rows = inspection_df.drop_duplicates(
+        subset=["restaurantname", "businessaddress", "postcode"], keep="last"
+    )
+    new_restaurants = {}
+    first_key_by_business = {}
+    folded = {}
+    for key, status in zip(
+        restaurant_keys(latest_rows), latest_rows["isroadwaycompliant"]
+    ):
+        if key in restaurants:
+            continue
+        b_id, yelp_rest = matches.get(key, (None, None))
+        if b_id and b_id in owners:
+            restaurants[key] = owners[b_id]
+            continue
+        if b_id and b_id in first_key_by_business:
+            folded[key] = first_key_by_business[b_id]
+            continue
+        new_restaurants[key] = Restaurant(
+            restaurant_name=key[0],
+            business_address=key[1],
+            postcode=key[2],
+            business_id=b_id,
+            yelp_detail=yelp_rest,
+            compliant_status=status,
+        )
+        if b_id:
+            first_key_by_business[b_id] = key
+
+    Restaurant.objects.bulk_create(
+        new_restaurants.values(), batch_size=batch_size, ignore_conflicts=True
+    )
+    created = get_existing_restaurants(new_restaurants.keys(), batch_size)
+    restaurants.update(created)
+    for key, owner_key in folded.items():
+        if owner_key in created:
+            restaurants[key] = created[owner_key]
+    logger.info("Created {} new restaurants".format(len(created)))
+    return restaurants
+
+
+def save_inspections_bulk(inspection_df, restaurants, batch_size=BATCH_SIZE):
+    """
+    Bulk insert the inspections of inspection_df that are not stored yet and
+    return the list of InspectionRecords that were created.
+    """
+    inspection_ids = list(inspection_df["restaurantinspectionid"])
+    existing_ids = set()
+    for start in range(0, len(inspection_ids), batch_size):
+        existing_ids.update(
+            InspectionRecords.objects.filter(
+                pk__in=inspection_ids[start : start + batch_size]  # noqa: E203
+            ).values_list("pk", flat=True)
+        )
 
-def save_inspections(row, business_id):
+    records = []
+    for row in inspection_df.itertuples(index=False):
+        if row.restaurantinspectionid in existing_ids:
+            continue
+        restaurant = restaurants.get(
+            (row.restaurantname, row.businessaddress, row.postcode)
+        )
+        if restaurant is None:
+            continue
+        records.append(
+            InspectionRecords(
+                restaurant_name=row.restaurantname,
+                restaurant_inspection_id=row.restaurantinspectionid,
+                is_roadway_compliant=row.isroadwaycompliant,
+                business_address=row.businessaddress,
+                postcode=row.postcode,
+                skipped_reason=row.skippedreason,
+                inspected_on=row.inspectedon,
+                business_id=restaurant.business_id,
+            )
+        )
+    InspectionRecords.objects.bulk_create(
+        records, batch_size=batch_size, ignore_conflicts=True
+    )
+    return records
+
+
+def update_latest_inspections(restaurants, records, batch_size=BATCH_SIZE):
+    """
+    Move the latest_inspection pointer of every restaurant that received a
+    newer inspection in this run and bulk update them.
+    """
+    newest = {}
+    for record in records:
+        key = (record.restaurant_name, record.business_address, record.postcode)
+        restaurant = restaurants[key]
+        current = newest.get(restaurant.pk)
+        if current is None or record.inspected_on >= current.inspected_on:
+            newest[restaurant.pk] = record
+
+    changed = []
+    for restaurant in {r.pk: r for r in restaurants.values()}.values():
+        record = newest.get(restaurant.pk)
+        if record is None:
+            continue
+        if restaurant.inspected_on and restaurant.inspected_on > record.inspected_on:
+            continue
+        restaurant.latest_inspection = record
+        restaurant.inspected_on = record.inspected_on
+        restaurant.is_roadway_compliant = record.is_roadway_compliant
+        restaurant.compliant_status = record.is_roadway_compliant
+        changed.append(restaurant)
+
+    Restaurant.objects.bulk_update(
+        changed,
+        [
+            "latest_inspection",
+            "inspected_on",
+            "is_roadway_compliant",
+            "compliant_status",
+        ],
+        batch_size=batch_size,
+    )
+    return changed
+
+
+def save_restaurants(
+    restaurant_df, inspection_df, batch_size=BATCH_SIZE, checkpoint=None
+):
+    """
+    Upsert one Socrata pull: diff the frame against the stored restaurants and
+    inspections, enrich the new restaurants on Yelp, then write everything
+    with bulk operations inside a single transaction. checkpoint, if given,
+    is called with the stats inside that transaction.
+    """
+    started = time.perf_counter()
+    inspection_df = inspection_df.drop_duplicates(
+        subset=["restaurantinspectionid"], keep="last"
+    ).copy()
+    inspection_df["inspectedon"] = pd.to_datetime(inspection_df["inspectedon"])
+
+    keys = restaurant_keys(inspection_df)
+    existing = get_existing_restaurants(keys, batch_size)
+    matches = enrich_new_restaurants(keys, existing)
+
+    with transaction.atomic():
+        restaurants = create_new_restaurants(
+            inspection_df, existing, matches, batch_size
+        )
+        records = save_inspections_bulk(inspection_df, restaurants, batch_size)
+        changed = update_latest_inspections(restaurants, records, batch_size)
+        existing_ids = {r.pk for r in existing.values()}
+        created = {r.pk: r for r in restaurants.values() if r.pk not in existing_ids}
+        stats = {
+            "rows": len(inspection_df),
+            "inspections_created": len(records),
+            "restaurants_created": len(created),
+            "restaurants_updated": len(changed),
+            "seconds": time.perf_counter() - started,
+        }
+        if checkpoint:
+            checkpoint(stats)
+    get_search_backend().index(created.values())
+    get_geo_backend().index(created.values())
+    if created or changed:
+        invalidate_tiles()
+    refresh_top_compliant_restaurants([r.pk for r in changed])
+    refresh_questionnaire_aggregates(r.business_id for r in records if r.business_id)
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = elapsed
+    stats["rows_per_second"] = len(inspection_df) / elapsed if elapsed else 0
+    logger.info(
+        "Ingested {rows} rows ({inspections_created} new inspections, "
+        "{restaurants_created} new restaurants) in {seconds:.2f}s: "
+        "{rows_per_second:.0f} rows/sec".format(**stats)
+    )
+    return stats
+
+
+def save_inspections(row, business_id, restaurant=None):
     # for index, row in inspection_df.iterrows():
     try:
 
@@ -169,45 +331,100 @@ def save_inspections(row, business_id):
             business_id=business_id,
         )
         inspect_record.save()
+        if restaurant:
+            restaurant.set_latest_inspection(inspect_record)
+        return inspect_record
 
     except Exception as e:
         print(e)
     return
 
 
-@sched.scheduled_job("interval", hours=12)
-def get_inspection_data():
-    # ir = InspectionRecords.objects.all().count()
-    lastInspection = InspectionRecords.objects.order_by("-inspected_on")[0:1]
-
-    client = Socrata(
-        "data.cityofnewyork.us",
-        "dLBzJwg25psQttbxjLlQ8Z53V",
-        username="cx657@nyu.edu",
-        password="Dinesafely123",
+def fetch_inspection_pages(where=None, offset=0, page_size=None, client=None):
+    """
+    Yield (next offset, rows) for each page of the Socrata inspections dataset
+    matching the SoQL where clause, oldest inspection first, until the
+    dataset is exhausted. Only one page is held in memory at a time.
+    """
+    page_size = page_size or settings.SOCRATA_PAGE_SIZE
+    client = client or get_http_client()
+    params = {
+        "$order": "inspectedon, restaurantinspectionid",
+        "$limit": page_size,
+    }
+    if where:
+        params["$where"] = where
+    while True:
+        response = client.get(
+            settings.SOCRATA_INSPECTIONS_API,
+            "socrata.inspections",
+            params=dict(params, **{"$offset": offset}),
+            headers={"X-App-Token": settings.SOCRATA_APP_TOKEN},
+            auth=settings.SOCRATA_AUTH,
+        )
+        response.raise_for_status()
+        rows = response.json()
+        if not rows:
+            return
+        offset += len(rows)
+        yield offset, rows
+        if len(rows) < page_size:
+            return
+
+
+def watermark_clause(watermark):
+    """
+    SoQL filter for the inspections at or after watermark. It is inclusive
+    so rows sharing the newest stored timestamp are not skipped; the ones
+    already stored are dropped by their inspection id.
+    """
+    if watermark is None:
+        return None
+    return "inspectedon >= '{}'".format(watermark.isoformat(timespec="milliseconds"))
+
+
+def ingest_page(rows, checkpoint=None):
+    results_df = pd.DataFrame.from_records(rows).reindex(columns=SOCRATA_COLUMNS)
+    restaurant_df, inspection_df = clean_inspection_data(results_df)
+    return save_restaurants(restaurant_df, inspection_df, checkpoint=checkpoint)
+
+
+def ingest_inspections(run, page_size=None):
+    """
+    Stream the inspections of an IngestionRun into the database one page at
+    a time, starting at its cursor. Each page is written in the same
+    transaction that advances the cursor, so an interrupted run resumes
+    right after the last committed page.
+    """
+    pages = fetch_inspection_pages(
+        watermark_clause(run.watermark), run.cursor, page_size
     )
-    if lastInspection:
-        date = str(lastInspection[0].inspected_on)
-        date = date.replace(" ", "T")
-        date_query = "inspectedon > '" + date + "'"
-        results = client.get("4dx7-axux", where=date_query, limit=30000)
-    else:
-        results = client.get("4dx7-axux", limit=30000)
-
-    # Convert to pandas DataFrame
-
-    results_df = pd.DataFrame.from_records(results)
-    print(results_df.shape)
-    print(results_df.columns)
-
-    if results_df.shape[0] > 0:
-        restaurant_df, inspection_df = clean_inspection_data(results_df)
-        save_restaurants(restaurant_df, inspection_df)
-        # print(inspection_df)
-        # save_inspections(inspection_df)
+    try:
+        for cursor, rows in pages:
+            ingest_page(rows, lambda stats: run.record_page(cursor, stats))
+            logger.info("Ingested inspections up to offset {}".format(cursor))
+    except Exception as e:
+        logger.error("Ingestion run {} failed: {}".format(run.pk, e))
+        run.finish(error=e)
+        raise
+    run.finish()
+    return run
 
 
-sched.start()
+def get_inspection_data():
+    reset_reference_tables()
+    run = ingest_inspections(IngestionRun.start())
+    logger.info(
+        "Ingested {} rows in {} pages ({} new inspections, {} new restaurants) "
+        "at {:.0f} rows/sec".format(
+            run.rows,
+            run.pages,
+            run.inspections_created,
+            run.restaurants_created,
+            run.rows_per_second(),
+        )
+    )
+    return run
 
 
 def populate_restaurant_with_yelp_id():
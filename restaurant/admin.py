@@ -1,8 +1,10 @@
 from django.contrib import admin
 from .models import (
+    IngestionRun,
     InspectionRecords,
     Restaurant,
     UserQuestionnaire,
+    YelpCallBudget,
     YelpRestaurantDetails,
     Zipcodes,
 )
@@ -13,3 +15,5 @@ admin.site.register(InspectionRecords)
 admin.site.register(UserQuestionnaire)
 admin.site.register(YelpRestaurantDetails)
 admin.site.register(Zipcodes)
+admin.site.register(IngestionRun)
+admin.site.register(YelpCallBudget)
@@ -0,0 +1,174 @@
+import contextlib
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from django.db import connection
+
+from .geo import get_geo_backend
+from .search import get_search_backend, normalize_search_key
+from .models import (
+    Categories,
+    InspectionRecords,
+    Restaurant,
+    UserQuestionnaire,
+    YelpRestaurantDetails,
+)
+
+NEIGHBORHOODS = [
+    "Chelsea and Clinton",
+    "Lower East Side",
+    "Upper West Side",
+    "Upper East Side",
+    "Greenpoint",
+    "Flatbush",
+    "Long Island City",
+    "Jamaica",
+]
+PRICES = ["$", "$$", "$$$", "$$$$"]
+RATINGS = [1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+NAMES = ["Golden", "Lucky", "Corner", "Harbor", "Village", "Garden", "Royal", "Noodle"]
+CATEGORIES = ["chinese", "italian", "korean", "mexican", "pizza", "sushi", "bars"]
+STATUSES = ["Compliant", "Non-Compliant", "Skipped Inspection"]
+
+
+def restaurant_name(i):
+    return "%s Restaurant %d" % (NAMES[i % len(NAMES)], i)
+
+
+@contextlib.contextmanager
+def benchmark_database():
+    """
+    Run the block against a throwaway test database so seeding never touches
+    real data.
+    """
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def reset():
+    """Remove every seeded row so the next seed() starts from empty tables."""
+    UserQuestionnaire.objects.all().delete()
+    Restaurant.objects.all().delete()
+    InspectionRecords.objects.all().delete()
+    YelpRestaurantDetails.objects.all().delete()
+
+
+def seed(n_restaurants, n_inspections, n_feedback=0, batch_size=5000, seed_value=0):
+    """
+    Fill the database with n_restaurants restaurants (all matched on Yelp) and
+    n_inspections inspection records spread evenly across them.
+    """
+    rng = random.Random(seed_value)
+    categories = [
+        Categories(
+            category=alias,
+            parent_category=alias,
+            parent_category_key=normalize_search_key(alias),
+        )
+        for alias in CATEGORIES
+    ]
+    Categories.objects.bulk_create(categories, ignore_conflicts=True)
+
+    start = datetime(2020, 6, 1)
+    category_links = []
+    for offset in range(0, n_restaurants, batch_size):
+        details = []
+        restaurants = []
+        for i in range(offset, min(offset + batch_size, n_restaurants)):
+            business_id = "bench_%d" % i
+            neighborhood = rng.choice(NEIGHBORHOODS)
+            details.append(
+                YelpRestaurantDetails(
+                    business_id=business_id,
+                    neighborhood=neighborhood,
+                    neighborhood_key=normalize_search_key(neighborhood),
+                    price=rng.choice(PRICES),
+                    rating=rng.choice(RATINGS),
+                    latitude=round(40.5 + rng.random() * 0.4, 6),
+                    longitude=round(-74.25 + rng.random() * 0.55, 6),
+                )
+            )
+            restaurants.append(
+                Restaurant(
+                    restaurant_name=restaurant_name(i),
+                    business_address="%d Broadway" % i,
+                    postcode=str(10001 + i % 300),
+                    business_id=business_id,
+                    yelp_detail_id=business_id,
+                    compliant_status=rng.choice(STATUSES),
+                )
+            )
+            category_links.append(
+                YelpRestaurantDetails.category.through(
+                    yelprestaurantdetails_id=business_id,
+                    categories_id=rng.choice(CATEGORIES),
+                )
+            )
+        YelpRestaurantDetails.objects.bulk_create(details)
+        Restaurant.objects.bulk_create(restaurants)
+    YelpRestaurantDetails.category.through.objects.bulk_create(
+        category_links, batch_size=batch_size
+    )
+    get_search_backend().rebuild()
+    get_geo_backend().rebuild()
+
+    for offset in range(0, n_inspections, batch_size):
+        records = []
+        for i in range(offset, min(offset + batch_size, n_inspections)):
+            r = i % max(n_restaurants, 1)
+            records.append(
+                InspectionRecords(
+                    restaurant_inspection_id="bench_%d" % i,
+                    restaurant_name=restaurant_name(r),
+                    business_address="%d Broadway" % r,
+                    postcode=str(10001 + r % 300),
+                    is_roadway_compliant=rng.choice(STATUSES),
+                    skipped_reason="nan",
+                    inspected_on=start + timedelta(minutes=i),
+                    business_id="bench_%d" % r,
+                )
+            )
+        InspectionRecords.objects.bulk_create(records)
+
+    for offset in range(0, n_feedback, batch_size):
+        feedback = []
+        for i in range(offset, min(offset + batch_size, n_feedback)):
+            feedback.append(
+                UserQuestionnaire(
+                    restaurant_business_id="bench_%d" % (i % max(n_restaurants, 1)),
+                    user_id="1",
+                    safety_level=rng.randint(1, 5),
+                    saved_on=start + timedelta(minutes=i),
+                )
+            )
+        UserQuestionnaire.objects.bulk_create(feedback)
+
+
+def time_call(func, repeat=5):
+    """Return the median wall time of func() in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def drop_indexes(models):
+    with connection.schema_editor() as editor:
+        for model in models:
+            for index in model._meta.indexes:
+                editor.remove_index(model, index)
+
+
+def create_indexes(models):
+    with connection.schema_editor() as editor:
+        for model in models:
+            for index in model._meta.indexes:
+                editor.add_index(model, index)
@@ -2,17 +2,27 @@ from .models import UserQuestionnaire
 from django import forms
 
 
+class YesNoField(forms.NullBooleanField):
+    """A required yes/no answer posted as "true"/"false" radio values."""
+
+    def validate(self, value):
+        if value is None:
+            raise forms.ValidationError(
+                self.error_messages["required"], code="required"
+            )
+
+
 class QuestionnaireForm(forms.Form):
     restaurant_business_id = forms.CharField(label="restaurant_id")
     user_id = forms.CharField(label="user_id")
-    safety_level = forms.CharField(label="safety_level")
+    safety_level = forms.IntegerField(label="safety_level", min_value=1, max_value=5)
     saved_on = forms.DateTimeField(required=False, label="saved_on")
 
-    temperature_required = forms.CharField(label="body_temp_required")
-    contact_info_required = forms.CharField(label="contact_info")
-    employee_mask = forms.CharField(label="employee_mask")
-    capacity_compliant = forms.CharField(label="capacity")
-    distance_compliant = forms.CharField(label="distance")
+    temperature_required = YesNoField(label="body_temp_required")
+    contact_info_required = YesNoField(label="contact_info")
+    employee_mask = YesNoField(label="employee_mask")
+    capacity_compliant = YesNoField(label="capacity")
+    distance_compliant = YesNoField(label="distance")
 
     def save(self, commit=True):
         questionnaire = UserQuestionnaire.objects.create(
@@ -163,6 +173,11 @@ class SearchFilterForm(forms.Form):
         label="rating", choices=CHOICES_RATING, required=False
     )
 
+    cursor = forms.CharField(label="cursor", required=False)
+
+    def clean_cursor(self):
+        return self.cleaned_data.get("cursor") or None
+
     def clean_keyword(self):
         keyword = self.cleaned_data.get("keyword")
         if keyword == "":
@@ -206,3 +221,37 @@ class SearchFilterForm(forms.Form):
         if self.cleaned_data.get("All") == "Compliant":
             return "Compliant"
         return None
+
+
+class NearbyRestaurantsForm(forms.Form):
+    """
+    Query of the nearby restaurants endpoint: either a point (lat, lng) with
+    the number k of restaurants wanted, or a bounding box "south,west,north,east".
+    """
+
+    lat = forms.FloatField(required=False, min_value=-90, max_value=90)
+    lng = forms.FloatField(required=False, min_value=-180, max_value=180)
+    k = forms.IntegerField(required=False, min_value=1, max_value=100)
+    bbox = forms.CharField(required=False)
+    limit = forms.IntegerField(required=False, min_value=1, max_value=1000)
+
+    def clean_bbox(self):
+        bbox = self.cleaned_data.get("bbox")
+        if not bbox:
+            return None
+        try:
+            south, west, north, east = (float(value) for value in bbox.split(","))
+        except ValueError:
+            raise forms.ValidationError("bbox must be south,west,north,east")
+        if south > north or west > east:
+            raise forms.ValidationError("bbox corners are out of order")
+        return south, west, north, east
+
+    def clean(self):
+        cleaned_data = super().clean()
+        has_point = (
+            cleaned_data.get("lat") is not None and cleaned_data.get("lng") is not None
+        )
+        if not has_point and not cleaned_data.get("bbox") and not self.errors:
+            raise forms.ValidationError("Give either lat and lng or a bbox")
+        return cleaned_data
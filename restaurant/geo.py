@@ -0,0 +1,211 @@
+import functools
+import math
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Restaurant, YelpRestaurantDetails
+
+GEO_TABLE = "restaurant_geo"
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great circle distance between two points in kilometres."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat, lng, radius_km):
+    """(south, west, north, east) of a box containing the circle around a point."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+
+def located_restaurants():
+    """Restaurants whose Yelp details carry real coordinates."""
+    return Restaurant.objects.filter(yelp_detail__isnull=False).exclude(
+        yelp_detail__latitude=0, yelp_detail__longitude=0
+    )
+
+
+class DatabaseGeoBackend:
+    """
+    Plain ORM bounding box lookups on the indexed coordinate columns of
+    YelpRestaurantDetails. It needs no extra index, so it works on any
+    database.
+    """
+
+    def within(self, queryset, south, west, north, east):
+        """Restrict queryset to the restaurants inside the bounding box."""
+        # A subquery, so the box is resolved on the coordinates index before
+        # any other filter of queryset is applied
+        details = YelpRestaurantDetails.objects.filter(
+            latitude__range=(south, north), longitude__range=(west, east)
+        ).exclude(latitude=0, longitude=0)
+        return queryset.filter(yelp_detail__in=details.values("business_id"))
+
+    def nearest(self, queryset, lat, lng, k):
+        """
+        Return up to k (distance in km, restaurant) pairs of queryset closest
+        to the point, nearest first. The search box starts at
+        GEO_SEARCH_RADIUS_KM and doubles until it holds k restaurants or
+        reaches GEO_MAX_RADIUS_KM.
+        """
+        radius = settings.GEO_SEARCH_RADIUS_KM
+        while True:
+            candidates = self.within(queryset, *bounding_box(lat, lng, radius))
+            found = sorted(
+                (
+                    (
+                        haversine_km(
+                            lat,
+                            lng,
+                            float(r.yelp_detail.latitude),
+                            float(r.yelp_detail.longitude),
+                        ),
+                        r.id,
+                        r,
+                    )
+                    for r in candidates.select_related("yelp_detail")
+                ),
+                key=lambda found: found[:2],
+            )
+            # Only the circle inscribed in the box is searched completely
+            found = [(d, r) for d, _, r in found if d <= radius]
+            if len(found) >= k or radius >= settings.GEO_MAX_RADIUS_KM:
+                return found[:k]
+            radius = min(radius * 2, settings.GEO_MAX_RADIUS_KM)
+
+    def index(self, restaurants):
+        pass
+
+    def remove(self, restaurant_ids):
+        pass
+
+    def rebuild(self):
+        return 0
+
+
+class SQLiteGeoBackend(DatabaseGeoBackend):
+    """
+    SQLite R*Tree over restaurant coordinates, kept in step with the Yelp
+    details at enrichment time. Each restaurant is a point, so a bounding box
+    lookup is a single R*Tree range query instead of a range scan on one
+    coordinate column.
+    """
+
+    def within(self, queryset, south, west, north, east):
+        # The R*Tree stores 32 bit floats rounded outwards, so boxes may
+        # include points a few centimetres outside; callers filter exactly
+        ids = RawSQL(
+            "SELECT id FROM {} WHERE max_lat >= %s AND min_lat <= %s "
+            "AND max_lng >= %s AND min_lng <= %s".format(GEO_TABLE),
+            [south, north, west, east],
+        )
+        return queryset.filter(id__in=ids)
+
+    def index(self, restaurants):
+        ids = [r.id for r in restaurants if r.id]
+        if not ids:
+            return
+        rows = [
+            (pk, lat, lat, lng, lng)
+            for pk, lat, lng in located_restaurants()
+            .filter(id__in=ids)
+            .values_list("id", "yelp_detail__latitude", "yelp_detail__longitude")
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "DELETE FROM {} WHERE id = %s".format(GEO_TABLE),
+                [(pk,) for pk in ids],
+            )
+            cursor.executemany(
+                "INSERT INTO {} (id, min_lat, max_lat, min_lng, max_lng) "
+                "VALUES (%s, %s, %s, %s, %s)".format(GEO_TABLE),
+                [tuple(map(float, row)) for row in rows],
+            )
+
+    def remove(self, restaurant_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "DELETE FROM {} WHERE id = %s".format(GEO_TABLE),
+                [(pk,) for pk in restaurant_ids],
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(GEO_TABLE))
+            cursor.execute(
+                "INSERT INTO {} (id, min_lat, max_lat, min_lng, max_lng) "
+                "SELECT r.id, d.latitude, d.latitude, d.longitude, d.longitude "
+                "FROM {} r JOIN {} d ON r.yelp_detail_id = d.business_id "
+                "WHERE NOT (d.latitude = 0 AND d.longitude = 0)".format(
+                    GEO_TABLE,
+                    Restaurant._meta.db_table,
+                    YelpRestaurantDetails._meta.db_table,
+                )
+            )
+            return cursor.rowcount
+
+
+# Default geo backend by database vendor; others use DatabaseGeoBackend
+GEO_BACKENDS = {"sqlite": "restaurant.geo.SQLiteGeoBackend"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_geo_backend():
+    backend = settings.GEO_BACKEND or GEO_BACKENDS.get(
+        connection.vendor, "restaurant.geo.DatabaseGeoBackend"
+    )
+    return import_string(backend)()
+
+
+def geo_restaurant_dict(restaurant, distance=None):
+    detail = restaurant.yelp_detail
+    result = {
+        "id": restaurant.id,
+        "restaurant_name": restaurant.restaurant_name,
+        "business_address": restaurant.business_address,
+        "compliant_status": restaurant.compliant_status,
+        "rating": detail.rating,
+        "price": detail.price,
+        "latitude": float(detail.latitude),
+        "longitude": float(detail.longitude),
+    }
+    if distance is not None:
+        result["distance_km"] = round(distance, 3)
+    return result
+
+
+def nearby_restaurants(lat, lng, k=10, compliant="Compliant"):
+    """The k restaurants nearest to a point, optionally of one compliance status."""
+    queryset = located_restaurants()
+    if compliant:
+        queryset = queryset.filter(compliant_status=compliant)
+    return [
+        geo_restaurant_dict(restaurant, distance)
+        for distance, restaurant in get_geo_backend().nearest(queryset, lat, lng, k)
+    ]
+
+
+def restaurants_in_box(south, west, north, east, limit=500, compliant="Compliant"):
+    """Up to limit restaurants inside a box, optionally of one compliance status."""
+    queryset = get_geo_backend().within(located_restaurants(), south, west, north, east)
+    # The index may return points just outside the box; they are filtered
+    # out before the limit so that they never take the place of a match
+    queryset = queryset.filter(
+        yelp_detail__latitude__range=(south, north),
+        yelp_detail__longitude__range=(west, east),
+    )
+    if compliant:
+        queryset = queryset.filter(compliant_status=compliant)
+    queryset = queryset.select_related("yelp_detail").order_by("id")
+    return [geo_restaurant_dict(restaurant) for restaurant in queryset[:limit]]
@@ -0,0 +1,233 @@
+import email.utils
+import functools
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class RateLimiter:
+    """
+    Token bucket: up to `burst` calls start back to back, after which calls
+    are spaced out so that at most `rate` of them start per second.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.lock = threading.Lock()
+        self.updated = time.monotonic()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Take the token now, going into debt if none is left yet, so
+            # concurrent callers queue up in order
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class EndpointMetrics:
+    """
+    Thread safe request counters and latencies per endpoint name. With a
+    log_interval, a summary is logged by the first request recorded once
+    that many seconds have passed since the last one.
+    """
+
+    def __init__(self, log_interval=None):
+        self.lock = threading.Lock()
+        self.log_interval = log_interval
+        self.logged = time.monotonic()
+        self.endpoints = defaultdict(
+            lambda: {
+                "count": 0,
+                "errors": 0,
+                "retries": 0,
+                "throttled": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+            }
+        )
+
+    def record(self, endpoint, elapsed, error=False, retried=False, throttled=False):
+        elapsed_ms = elapsed * 1000
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["retries"] += int(retried)
+            stats["throttled"] += int(throttled)
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            due = (
+                self.log_interval is not None
+                and time.monotonic() - self.logged >= self.log_interval
+            )
+            if due:
+                self.logged = time.monotonic()
+        if due:
+            self.log_summary()
+
+    def snapshot(self, reset=False):
+        """
+        Return {endpoint: stats} with the mean latency of each endpoint,
+        starting the counts over if reset is set.
+        """
+        with self.lock:
+            snapshot = {
+                endpoint: dict(stats, mean_ms=stats["total_ms"] / stats["count"])
+                for endpoint, stats in self.endpoints.items()
+            }
+            if reset:
+                self.endpoints.clear()
+                self.logged = time.monotonic()
+        return snapshot
+
+    def log_summary(self):
+        """Log the counts since the last summary at info level and reset them."""
+        for endpoint, stats in sorted(self.snapshot(reset=True).items()):
+            logger.info(
+                "HTTP {}: {count} requests, {errors} errors, {retries} retries, "
+                "{throttled} throttled, {mean_ms:.1f} ms mean, "
+                "{max_ms:.1f} ms max".format(endpoint, **stats)
+            )
+
+
+class HttpClient:
+    """
+    requests.Session wrapper shared by the outbound API callers. It keeps
+    connections alive in a pool, applies a default timeout, retries 429s,
+    5xx responses and connection errors with jittered exponential backoff,
+    and rate limits each bearer token with its own token bucket.
+    """
+
+    def __init__(
+        self,
+        timeout=(3.05, 10),
+        retries=3,
+        backoff=0.5,
+        max_backoff=8,
+        pool_maxsize=10,
+        token_rate=None,
+        token_burst=1,
+        metrics_log_interval=None,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.token_rate = token_rate
+        self.token_burst = token_burst
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=10, pool_maxsize=pool_maxsize
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        self.metrics = EndpointMetrics(metrics_log_interval)
+
+    def limiter(self, token):
+        with self.limiters_lock:
+            if token not in self.limiters:
+                self.limiters[token] = RateLimiter(self.token_rate, self.token_burst)
+            return self.limiters[token]
+
+    def retry_delay(self, attempt, response=None):
+        retry_after = response is not None and response.headers.get("Retry-After")
+        if retry_after:
+            if retry_after.isdigit():
+                return min(int(retry_after), self.max_backoff)
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                return min(max(retry_at - time.time(), 0), self.max_backoff)
+            except (TypeError, ValueError):
+                pass
+        # Full jitter keeps workers that failed together from retrying together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, url, endpoint, token=None, headers=None, **kwargs):
+        """
+        GET url and return the response, retrying as configured. endpoint
+        names the API in the metrics and logs. A token is sent as a bearer
+        Authorization header and rate limited. The last response is returned
+        when retries run out on an error status; connection errors and
+        timeouts are raised.
+        """
+        headers = dict(headers or {})
+        if token is not None:
+            headers["Authorization"] = "Bearer %s" % token
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if token is not None:
+                self.limiter(token).wait()
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                elapsed = time.perf_counter() - started
+                self.metrics.record(endpoint, elapsed, error=True, retried=attempt > 0)
+                if attempt == self.retries:
+                    raise
+                logger.warning("GET {} failed, retrying: {}".format(endpoint, e))
+                time.sleep(self.retry_delay(attempt))
+                continue
+
+            elapsed = time.perf_counter() - started
+            error = response.status_code >= 400
+            self.metrics.record(
+                endpoint,
+                elapsed,
+                error=error,
+                retried=attempt > 0,
+                throttled=response.status_code == 429,
+            )
+            logger.debug(
+                "GET {} {} {:.1f} ms".format(
+                    endpoint, response.status_code, elapsed * 1000
+                )
+            )
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response
+            logger.warning(
+                "GET {} returned {}, retrying".format(endpoint, response.status_code)
+            )
+            time.sleep(self.retry_delay(attempt, response))
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_client():
+    return HttpClient(
+        token_rate=settings.YELP_REQUESTS_PER_SECOND,
+        token_burst=settings.YELP_REQUESTS_BURST,
+        **settings.HTTP_CLIENT,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_request_http_client():
+    """
+    Client of the calls a page waits on. It neither retries nor waits on a
+    rate limit, so a failing API costs the page one short timeout and the
+    caller falls back.
+    """
+    return HttpClient(**settings.REQUEST_HTTP_CLIENT)
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from .http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+
+def job_lock_key(name):
+    return "jobs:{}:lock".format(name)
+
+
+def job_last_run_key(name):
+    return "jobs:{}:last-run".format(name)
+
+
+class Job:
+    """
+    A callable run every `interval` seconds. lock_timeout bounds how long a
+    crashed run can keep the job locked; it defaults to the interval.
+    """
+
+    def __init__(self, name, func, interval, lock_timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.lock_timeout = lock_timeout or interval
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.last_lag = None
+        self.max_duration = 0.0
+        self.max_lag = 0.0
+
+    @classmethod
+    def from_settings(cls, name, options):
+        func = options["func"]
+        if isinstance(func, str):
+            func = import_string(func)
+        return cls(name, func, options["interval"], options.get("lock_timeout"))
+
+    def last_run(self):
+        return cache.get(job_last_run_key(self.name))
+
+    def next_run(self, now):
+        """Wall clock time the job is due at; now if it never ran."""
+        last_run = self.last_run()
+        if last_run is None:
+            return now
+        return last_run + self.interval
+
+    def run(self, due=None):
+        """
+        Run the job unless another worker or process holds its lock, and
+        record its duration and its lag behind the due time. Returns False
+        if the run was skipped.
+        """
+        started = time.time()
+        # The token tells this run's lock apart from one taken by another
+        # process after this run outlived lock_timeout
+        token = uuid.uuid4().hex
+        if not cache.add(job_lock_key(self.name), token, self.lock_timeout):
+            self.skipped += 1
+            logger.info("Job {} is already running, skipped".format(self.name))
+            return False
+
+        lag = max(started - due, 0) if due is not None else 0
+        try:
+            self.func()
+        except Exception as e:
+            self.failures += 1
+            logger.exception("Job {} failed: {}".format(self.name, e))
+        finally:
+            duration = time.time() - started
+            self.runs += 1
+            self.last_duration = duration
+            self.last_lag = lag
+            self.max_duration = max(self.max_duration, duration)
+            self.max_lag = max(self.max_lag, lag)
+            cache.set(job_last_run_key(self.name), started, None)
+            if cache.get(job_lock_key(self.name)) == token:
+                cache.delete(job_lock_key(self.name))
+            else:
+                logger.warning(
+                    "Job {} outlived its lock timeout of {}s".format(
+                        self.name, self.lock_timeout
+                    )
+                )
+            connections.close_all()
+        logger.info(
+            "Job {} finished in {:.2f}s, {:.2f}s behind schedule".format(
+                self.name, duration, lag
+            )
+        )
+        # The outbound API calls made since the last job finished
+        get_http_client().metrics.log_summary()
+        return True
+
+
+class JobRunner:
+    """
+    Runs a set of jobs on their intervals with a pool of worker threads, so
+    a long job never delays the others. A job is never started twice at
+    the same time: the runner skips jobs whose previous run is still going,
+    and Job.run takes a cache lock that is shared between processes.
+    """
+
+    def __init__(self, jobs, max_workers=None, poll_interval=1.0):
+        self.jobs = {job.name: job for job in jobs}
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.JOB_WORKERS
+        )
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.due = {}
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_settings(cls, names=None, **kwargs):
+        jobs = [
+            Job.from_settings(name, options)
+            for name, options in settings.JOBS.items()
+            if not names or name in names
+        ]
+        return cls(jobs, **kwargs)
+
+    def run_pending(self, now=None):
+        """Submit every job that is due and not running. Returns their names."""
+        now = time.time() if now is None else now
+        submitted = []
+        for name, job in self.jobs.items():
+            future = self.running.get(name)
+            if future is not None and not future.done():
+                continue
+            due = self.due.get(name)
+            if due is None:
+                due = self.due[name] = job.next_run(now)
+            if due > now:
+                continue
+            self.running[name] = self.executor.submit(job.run, due)
+            # Runs missed while the clock was down are coalesced into this one
+            self.due[name] = due + job.interval
+            if self.due[name] <= now:
+                self.due[name] = now + job.interval
+            submitted.append(name)
+        return submitted
+
+    def run_forever(self):
+        logger.info("Running jobs: {}".format(", ".join(self.jobs)))
+        try:
+            while not self.stopped.is_set():
+                self.run_pending()
+                self.stopped.wait(self.poll_interval)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def run_once(self):
+        """Run every job once, concurrently, and wait for all of them."""
+        futures = [self.executor.submit(job.run) for job in self.jobs.values()]
+        for future in futures:
+            future.result()
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return [
+            {
+                "name": job.name,
+                "runs": job.runs,
+                "failures": job.failures,
+                "skipped": job.skipped,
+                "last_duration": job.last_duration,
+                "max_duration": job.max_duration,
+                "last_lag": job.last_lag,
+                "max_lag": job.max_lag,
+            }
+            for job in self.jobs.values()
+        ]
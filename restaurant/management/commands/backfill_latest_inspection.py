@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery
+
+from restaurant.models import InspectionRecords, Restaurant
+
+
+class Command(BaseCommand):
+    help = "Point every restaurant at its latest inspection record"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        latest = InspectionRecords.objects.filter(
+            restaurant_name=OuterRef("restaurant_name"),
+            business_address=OuterRef("business_address"),
+            postcode=OuterRef("postcode"),
+        ).order_by("-inspected_on")
+        pointers = list(
+            Restaurant.objects.annotate(
+                latest_id=Subquery(latest.values("restaurant_inspection_id")[:1])
+            )
+            .filter(latest_id__isnull=False)
+            .values_list("id", "latest_id")
+        )
+
+        for start in range(0, len(pointers), batch_size):
+            self.update_batch(pointers[start : start + batch_size])  # noqa: E203
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Backfilled latest inspection for %d restaurants" % len(pointers)
+            )
+        )
+
+    def update_batch(self, pointers):
+        records = InspectionRecords.objects.in_bulk([pk for _, pk in pointers])
+        restaurants = []
+        for restaurant_id, record_id in pointers:
+            record = records[record_id]
+            restaurants.append(
+                Restaurant(
+                    id=restaurant_id,
+                    latest_inspection=record,
+                    inspected_on=record.inspected_on,
+                    is_roadway_compliant=record.is_roadway_compliant,
+                    compliant_status=record.is_roadway_compliant,
+                )
+            )
+        Restaurant.objects.bulk_update(
+            restaurants,
+            [
+                "latest_inspection",
+                "inspected_on",
+                "is_roadway_compliant",
+                "compliant_status",
+            ],
+        )
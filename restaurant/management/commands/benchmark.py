@@ -0,0 +1,380 @@
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from restaurant import utils, views
+from restaurant.benchmark import (
+    benchmark_database,
+    create_indexes,
+    drop_indexes,
+    reset,
+    seed,
+    time_call,
+)
+from restaurant.geo import (
+    DatabaseGeoBackend,
+    bounding_box,
+    get_geo_backend,
+    located_restaurants,
+)
+from restaurant.search import get_search_backend
+from restaurant.models import (
+    InspectionRecords,
+    Restaurant,
+    UserQuestionnaire,
+    YelpRestaurantDetails,
+)
+
+INDEXED_MODELS = [
+    InspectionRecords,
+    Restaurant,
+    UserQuestionnaire,
+    YelpRestaurantDetails,
+]
+
+
+class Command(BaseCommand):
+    help = "Seed a throwaway database and time the hot query paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "suite",
+            choices=["lookups", "index", "search", "browse", "profile", "geo"],
+        )
+        parser.add_argument("--restaurants", type=int, default=50000)
+        parser.add_argument("--inspections", type=int, default=500000)
+        parser.add_argument("--feedback", type=int, default=50000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--sizes",
+            default="10000,100000,1000000",
+            help="Comma separated inspection counts for the index suite",
+        )
+        parser.add_argument(
+            "--delay",
+            type=int,
+            default=200,
+            help="Milliseconds each stubbed upstream takes in the profile suite",
+        )
+        parser.add_argument(
+            "--explain", action="store_true", help="Print the query plan of each case"
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        with benchmark_database():
+            getattr(self, "benchmark_%s" % options["suite"])()
+
+    def seed(self, n_inspections):
+        options = dict(self.options, inspections=n_inspections)
+        self.stdout.write(
+            "Seeding %(restaurants)d restaurants, %(inspections)d inspections, "
+            "%(feedback)d feedback rows..." % options
+        )
+        reset()
+        seed(options["restaurants"], n_inspections, options["feedback"])
+
+    def report(self, name, func, queryset=None):
+        elapsed = time_call(func, self.options["repeat"])
+        self.stdout.write("  {:<40} {:>10.2f} ms".format(name, elapsed))
+        if queryset is not None and self.options["explain"]:
+            for line in queryset.explain().splitlines():
+                self.stdout.write("      " + line)
+
+    def lookup_cases(self):
+        sample = Restaurant.objects.order_by("id")[Restaurant.objects.count() // 2]
+        key = (sample.restaurant_name, sample.business_address, sample.postcode)
+        business_id = sample.business_id
+        return [
+            (
+                "get_latest_inspection_record",
+                lambda: utils.get_latest_inspection_record(*key),
+                InspectionRecords.objects.filter(
+                    restaurant_name=key[0], business_address=key[1], postcode=key[2]
+                ).order_by("-inspected_on"),
+            ),
+            (
+                "query_inspection_record",
+                lambda: utils.query_inspection_record(*key),
+                None,
+            ),
+            (
+                "questionnaire_report",
+                lambda: utils.questionnaire_report(business_id),
+                InspectionRecords.objects.filter(business_id=business_id).order_by(
+                    "inspected_on"
+                ),
+            ),
+            (
+                "get_latest_feedback",
+                lambda: utils.get_latest_feedback(business_id),
+                UserQuestionnaire.objects.filter(
+                    restaurant_business_id=business_id
+                ).order_by("-saved_on"),
+            ),
+            (
+                "get_average_safety_rating",
+                lambda: utils.get_average_safety_rating(business_id),
+                None,
+            ),
+            (
+                "questionnaire_statistics",
+                lambda: utils.questionnaire_statistics(business_id),
+                None,
+            ),
+            (
+                "refresh_questionnaire_aggregate",
+                lambda: utils.refresh_questionnaire_aggregate(business_id),
+                None,
+            ),
+            (
+                "get_filtered_restaurants",
+                lambda: list(
+                    utils.get_filtered_restaurants(
+                        price=["$$"],
+                        neighborhood=["Greenpoint"],
+                        rating=[4.0, 4.5],
+                        compliant="Compliant",
+                        limit=6,
+                    )
+                ),
+                YelpRestaurantDetails.objects.filter(
+                    price__in=["$$"], rating__in=[4.0, 4.5], neighborhood="Greenpoint"
+                ),
+            ),
+            (
+                "get_restaurant_list (compliant)",
+                lambda: utils.get_restaurant_list(1, 6, compliant_filter="Compliant"),
+                Restaurant.objects.filter(compliant_status="Compliant"),
+            ),
+            (
+                "get_compliant_restaurant_list",
+                lambda: utils.get_compliant_restaurant_list(
+                    1, 18, rating_filter=[3, 3.5, 4, 4.5, 5]
+                ),
+                InspectionRecords.objects.order_by("-inspected_on"),
+            ),
+        ]
+
+    def benchmark_lookups(self):
+        self.seed(self.options["inspections"])
+        cases = self.lookup_cases()
+
+        drop_indexes(INDEXED_MODELS)
+        self.stdout.write(self.style.MIGRATE_HEADING("Without indexes"))
+        for case in cases:
+            self.report(*case)
+
+        create_indexes(INDEXED_MODELS)
+        self.stdout.write(self.style.MIGRATE_HEADING("With indexes"))
+        for case in cases:
+            self.report(*case)
+
+    def benchmark_index(self):
+        for size in [int(n) for n in self.options["sizes"].split(",")]:
+            self.seed(size)
+            call_command("backfill_latest_inspection", stdout=self.stdout)
+            self.stdout.write(
+                self.style.MIGRATE_HEADING("%d inspection records" % size)
+            )
+            self.report(
+                "get_compliant_restaurant_list",
+                lambda: utils.get_compliant_restaurant_list(
+                    1,
+                    18,
+                    rating_filter=[3, 3.5, 4, 4.5, 5],
+                    compliant_filter="Compliant",
+                ),
+            )
+            self.report(
+                "refresh_top_compliant_restaurants",
+                lambda: utils.refresh_top_compliant_restaurants(limit=18),
+                utils.top_compliant_candidates()[:18],
+            )
+            self.report(
+                "get_top_compliant_restaurant_list",
+                lambda: utils.get_top_compliant_restaurant_list(18),
+            )
+
+    def keyword_cases(self, keyword):
+        backend = get_search_backend()
+        return [
+            (
+                "%r (icontains)" % keyword,
+                lambda: list(
+                    Restaurant.objects.filter(
+                        restaurant_name__icontains=keyword
+                    ).order_by("-id")[:6]
+                ),
+                Restaurant.objects.filter(restaurant_name__icontains=keyword),
+            ),
+            (
+                "%r (search index)" % keyword,
+                lambda: list(
+                    backend.filter(Restaurant.objects.all(), keyword).order_by(
+                        "search_rank", "-id"
+                    )[:6]
+                ),
+                backend.filter(Restaurant.objects.all(), keyword),
+            ),
+        ]
+
+    def search_cases(self):
+        neighborhoods = ["Greenpoint", "Flatbush"]
+        categories = ["pizza", "sushi"]
+        return [
+            case
+            for keyword in ["harbor", "restaurant 1234"]
+            for case in self.keyword_cases(keyword)
+        ] + [
+            (
+                "neighborhood+category (iregex)",
+                lambda: list(
+                    Restaurant.objects.filter(
+                        business_id__in=YelpRestaurantDetails.objects.filter(
+                            neighborhood__iregex=r"^(" + "|".join(neighborhoods) + ")$",
+                            category__parent_category__iregex=r"^("
+                            + "|".join(categories)
+                            + ")$",
+                        )
+                    ).order_by("-id")[:6]
+                ),
+            ),
+            (
+                "neighborhood+category (keys)",
+                lambda: list(
+                    utils.get_filtered_restaurants(
+                        neighborhood=neighborhoods, category=categories, limit=6
+                    )
+                ),
+            ),
+            (
+                "get_filtered_restaurants (all)",
+                lambda: list(
+                    utils.get_filtered_restaurants(
+                        keyword="harbor",
+                        neighborhood=neighborhoods,
+                        category=categories,
+                        compliant="Compliant",
+                        limit=6,
+                    )
+                ),
+            ),
+        ]
+
+    def benchmark_search(self):
+        self.seed(self.options["inspections"])
+        self.stdout.write(self.style.MIGRATE_HEADING("Restaurant search"))
+        for case in self.search_cases():
+            self.report(*case)
+
+    def benchmark_browse(self):
+        self.seed(self.options["inspections"])
+        deep_page = Restaurant.objects.count() // 6 - 1
+        for sort_option in ["none", "ratedhigh"]:
+            self.stdout.write(
+                self.style.MIGRATE_HEADING("Browse pages sorted by %s" % sort_option)
+            )
+            cursor = utils.search_restaurants(
+                deep_page - 1, 6, sort_option=sort_option
+            )["next_cursor"]
+            for page in [1, deep_page]:
+                # The previous view picked its limit with a full table COUNT,
+                # then counted the filtered rows separately from the page
+                self.report(
+                    "page + counts, page %d" % page,
+                    lambda: (
+                        Restaurant.objects.count(),
+                        utils.restaurants_to_dict(
+                            utils.get_filtered_restaurants(
+                                sort_option=sort_option, page=page - 1, limit=6
+                            )
+                        ),
+                        utils.get_total_restaurant_number(sort_option=sort_option),
+                    ),
+                )
+                self.report(
+                    "search_restaurants, page %d" % page,
+                    lambda: utils.search_restaurants(page, 6, sort_option=sort_option),
+                )
+            self.report(
+                "search_restaurants, cursor to page %d" % deep_page,
+                lambda: utils.search_restaurants(
+                    1, 6, sort_option=sort_option, cursor=cursor
+                ),
+            )
+
+    def benchmark_geo(self):
+        self.seed(0)
+        points = [(40.7580, -73.9855), (40.6782, -73.9442), (40.5, -74.25)]
+        compliant = located_restaurants().filter(compliant_status="Compliant")
+        backends = [DatabaseGeoBackend()]
+        # The spatial index of this database, if it has one
+        if type(get_geo_backend()) is not DatabaseGeoBackend:
+            backends.append(get_geo_backend())
+        for backend in backends:
+            self.stdout.write(self.style.MIGRATE_HEADING(type(backend).__name__))
+            for lat, lng in points:
+                self.report(
+                    "10 nearest to %.4f,%.4f" % (lat, lng),
+                    lambda: backend.nearest(compliant, lat, lng, 10),
+                )
+            box = bounding_box(*points[0], 1)
+            self.report(
+                "1 km box",
+                lambda: list(backend.within(compliant, *box)),
+                backend.within(compliant, *box),
+            )
+
+    def benchmark_profile(self):
+        self.seed(self.options["inspections"])
+        restaurant = Restaurant.objects.order_by("id").first()
+        delay = self.options["delay"] / 1000
+        yelp_info = {
+            "info": utils.default_info_page(restaurant.restaurant_name),
+            "reviews": {"reviews": []},
+        }
+
+        def stub(result, seconds):
+            def source(*args):
+                time.sleep(seconds)
+                return result
+
+            return source
+
+        def profile(view):
+            request = RequestFactory().get("/restaurant/profile/%d/" % restaurant.id)
+            request.user = AnonymousUser()
+            return view(request, restaurant.id)
+
+        async_view = async_to_sync(views.get_restaurant_profile_async)
+        # The slow case holds Yelp for five delays against a two delay timeout
+        timeouts = {
+            "covid": 10 * delay,
+            "inspection": 10,
+            "feedback": 10,
+            "saved": 10,
+            "view": 10,
+        }
+        for title, yelp_delay, yelp_timeout in [
+            ("Upstreams delayed %d ms" % self.options["delay"], delay, 10 * delay),
+            ("Yelp delayed %d ms" % (5 * self.options["delay"]), 5 * delay, 2 * delay),
+        ]:
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            with mock.patch.object(
+                views, "get_covid_data", stub("{}", delay)
+            ), mock.patch.object(
+                views, "query_yelp", stub(yelp_info, yelp_delay)
+            ), override_settings(
+                PROFILE_SOURCE_TIMEOUTS=dict(timeouts, yelp=yelp_timeout)
+            ):
+                self.report(
+                    "get_restaurant_profile",
+                    lambda: profile(views.get_restaurant_profile),
+                )
+                self.report("get_restaurant_profile_async", lambda: profile(async_view))
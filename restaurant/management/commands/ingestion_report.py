@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+
+from restaurant.models import IngestionRun
+
+ROW_FORMAT = "{:>5} {:<19} {:<9} {:>6} {:>5} {:>8} {:>9} {:>8} {:>8}  {}"
+
+
+class Command(BaseCommand):
+    help = "Show the inspection ingestion run history and its throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", type=int, default=20, help="Number of recent runs to show"
+        )
+
+    def handle(self, *args, **options):
+        runs = list(
+            IngestionRun.objects.order_by("-started_on", "-id")[: options["limit"]]
+        )
+        if not runs:
+            self.stdout.write("No ingestion runs recorded")
+            return
+
+        self.stdout.write(
+            ROW_FORMAT.format(
+                "run",
+                "started",
+                "status",
+                "cursor",
+                "pages",
+                "rows",
+                "new insp",
+                "seconds",
+                "rows/s",
+                "error",
+            )
+        )
+        for run in runs:
+            elapsed = run.elapsed()
+            self.stdout.write(
+                ROW_FORMAT.format(
+                    run.pk,
+                    run.started_on.strftime("%Y-%m-%d %H:%M:%S"),
+                    run.status,
+                    run.cursor,
+                    run.pages,
+                    run.rows,
+                    run.inspections_created,
+                    "-" if elapsed is None else "%.1f" % elapsed,
+                    "-" if elapsed is None else "%.0f" % run.rows_per_second(),
+                    run.error[:60],
+                )
+            )
+
+        finished = [run for run in runs if run.elapsed()]
+        rows = sum(run.rows for run in finished)
+        seconds = sum(run.elapsed() for run in finished)
+        self.stdout.write(
+            self.style.SUCCESS(
+                "%d rows in %d finished runs, %.0f rows/sec overall"
+                % (rows, len(finished), rows / seconds if seconds else 0)
+            )
+        )
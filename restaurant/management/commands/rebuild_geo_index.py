@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from restaurant.geo import get_geo_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the restaurant coordinates index from scratch"
+
+    def handle(self, *args, **options):
+        indexed = get_geo_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS("Indexed %d restaurants" % indexed))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from restaurant.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the restaurant keyword search index from scratch"
+
+    def handle(self, *args, **options):
+        indexed = get_search_backend().rebuild()
+        self.stdout.write(self.style.SUCCESS("Indexed %d restaurants" % indexed))
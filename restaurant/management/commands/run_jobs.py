@@ -0,0 +1,73 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from restaurant.jobs import JobRunner
+
+ROW_FORMAT = "{:<16} {:>5} {:>8} {:>7} {:>10} {:>10} {:>9} {:>9}"
+
+
+class Command(BaseCommand):
+    help = "Run the scheduled background jobs (the clock process)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "jobs", nargs="*", help="Jobs to run, all of settings.JOBS by default"
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run each job once, report its metrics and exit",
+        )
+        parser.add_argument("--workers", type=int, default=None)
+
+    def handle(self, *args, **options):
+        unknown = set(options["jobs"]) - set(settings.JOBS)
+        if unknown:
+            raise CommandError("Unknown jobs: %s" % ", ".join(sorted(unknown)))
+
+        runner = JobRunner.from_settings(
+            options["jobs"], max_workers=options["workers"]
+        )
+        if options["once"]:
+            runner.run_once()
+        else:
+            # Let the running jobs finish when the platform stops the process
+            signal.signal(signal.SIGTERM, lambda *args: runner.stop())
+            try:
+                runner.run_forever()
+            except KeyboardInterrupt:
+                runner.stop()
+        self.report(runner.stats())
+
+    def report(self, stats):
+        self.stdout.write(
+            ROW_FORMAT.format(
+                "job",
+                "runs",
+                "failures",
+                "skipped",
+                "last (s)",
+                "max (s)",
+                "lag (s)",
+                "max lag",
+            )
+        )
+        for job in stats:
+            self.stdout.write(
+                ROW_FORMAT.format(
+                    job["name"],
+                    job["runs"],
+                    job["failures"],
+                    job["skipped"],
+                    (
+                        "-"
+                        if job["last_duration"] is None
+                        else "%.2f" % job["last_duration"]
+                    ),
+                    "%.2f" % job["max_duration"],
+                    "-" if job["last_lag"] is None else "%.2f" % job["last_lag"],
+                    "%.2f" % job["max_lag"],
+                )
+            )
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0005_auto_20201123_2038'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='inspected_on',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='is_roadway_compliant',
+            field=models.CharField(blank=True, default=None, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='latest_inspection',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='restaurant.inspectionrecords'),
+        ),
+    ]
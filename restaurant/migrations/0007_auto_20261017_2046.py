@@ -0,0 +1,45 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0006_auto_20261017_2044'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inspectionrecords',
+            index=models.Index(fields=['restaurant_name', 'business_address', 'postcode', '-inspected_on'], name='inspection_restaurant_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inspectionrecords',
+            index=models.Index(fields=['business_id', '-inspected_on'], name='inspection_business_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inspectionrecords',
+            index=models.Index(fields=['-inspected_on'], name='inspection_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurant',
+            index=models.Index(fields=['compliant_status'], name='restaurant_compliant_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userquestionnaire',
+            index=models.Index(fields=['restaurant_business_id', 'saved_on'], name='questionnaire_business_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['rating'], name='yelp_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['price'], name='yelp_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['neighborhood'], name='yelp_neighborhood_idx'),
+        ),
+    ]
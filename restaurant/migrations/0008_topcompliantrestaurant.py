@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0007_auto_20261017_2046'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopCompliantRestaurant',
+            fields=[
+                ('rank', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('rating', models.FloatField(default=0.0)),
+                ('inspected_on', models.DateTimeField(blank=True, default=None, null=True)),
+                ('restaurant', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='top_compliant', to='restaurant.restaurant')),
+            ],
+        ),
+    ]
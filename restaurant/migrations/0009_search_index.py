@@ -0,0 +1,59 @@
+# Generated by Django 3.1.14 on 2026-10-17 20:57
+
+from django.db import migrations, models
+from django.db.models.functions import Lower, Trim
+
+
+def backfill_search_keys(apps, schema_editor):
+    Categories = apps.get_model('restaurant', 'Categories')
+    YelpRestaurantDetails = apps.get_model('restaurant', 'YelpRestaurantDetails')
+    Categories.objects.update(parent_category_key=Trim(Lower('parent_category')))
+    YelpRestaurantDetails.objects.update(neighborhood_key=Trim(Lower('neighborhood')))
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE restaurant_search "
+        "USING fts5(restaurant_name, tokenize='trigram')"
+    )
+    schema_editor.execute(
+        "INSERT INTO restaurant_search (rowid, restaurant_name) "
+        "SELECT id, restaurant_name FROM restaurant_restaurant"
+    )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS restaurant_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0008_topcompliantrestaurant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='categories',
+            name='parent_category_key',
+            field=models.CharField(default=None, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='yelprestaurantdetails',
+            name='neighborhood_key',
+            field=models.CharField(default=None, max_length=200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='categories',
+            index=models.Index(fields=['parent_category_key'], name='category_parent_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['neighborhood_key'], name='yelp_neighborhood_key_idx'),
+        ),
+        migrations.RunPython(backfill_search_keys, migrations.RunPython.noop),
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0009_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionnaireAggregate',
+            fields=[
+                ('restaurant_business_id', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('feedback_count', models.PositiveIntegerField(default=0)),
+                ('safety_level_total', models.PositiveIntegerField(default=0)),
+                ('window_start', models.DateTimeField(blank=True, default=None, null=True)),
+                ('window_count', models.PositiveIntegerField(default=0)),
+                ('window_safety_level_total', models.PositiveIntegerField(default=0)),
+                ('temperature_required_true', models.PositiveIntegerField(default=0)),
+                ('contact_info_required_true', models.PositiveIntegerField(default=0)),
+                ('employee_mask_true', models.PositiveIntegerField(default=0)),
+                ('capacity_compliant_true', models.PositiveIntegerField(default=0)),
+                ('distance_compliant_true', models.PositiveIntegerField(default=0)),
+                ('latest_feedback', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='restaurant.userquestionnaire')),
+            ],
+        ),
+    ]
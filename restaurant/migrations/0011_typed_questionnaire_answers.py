@@ -0,0 +1,105 @@
+from django.db import migrations, models
+
+QUESTIONS = [
+    'temperature_required',
+    'contact_info_required',
+    'employee_mask',
+    'capacity_compliant',
+    'distance_compliant',
+]
+
+
+def parse_answers(apps, schema_editor):
+    UserQuestionnaire = apps.get_model('restaurant', 'UserQuestionnaire')
+    questionnaires = list(UserQuestionnaire.objects.all())
+    for questionnaire in questionnaires:
+        # Answers were compared with "true" in answer before they were typed
+        for question in QUESTIONS:
+            setattr(
+                questionnaire,
+                question + '_typed',
+                'true' in (getattr(questionnaire, question) or ''),
+            )
+        safety_level = (questionnaire.safety_level or '').strip()
+        questionnaire.safety_level_typed = (
+            int(safety_level) if safety_level.isdigit() else 0
+        )
+    UserQuestionnaire.objects.bulk_update(
+        questionnaires,
+        [question + '_typed' for question in QUESTIONS] + ['safety_level_typed'],
+        batch_size=1000,
+    )
+
+
+def format_answers(apps, schema_editor):
+    UserQuestionnaire = apps.get_model('restaurant', 'UserQuestionnaire')
+    questionnaires = list(UserQuestionnaire.objects.all())
+    for questionnaire in questionnaires:
+        for question in QUESTIONS:
+            setattr(
+                questionnaire,
+                question,
+                'true' if getattr(questionnaire, question + '_typed') else 'false',
+            )
+        questionnaire.safety_level = str(questionnaire.safety_level_typed)
+    UserQuestionnaire.objects.bulk_update(
+        questionnaires, QUESTIONS + ['safety_level'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0010_questionnaireaggregate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userquestionnaire',
+            name='safety_level_typed',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ] + [
+        migrations.AddField(
+            model_name='userquestionnaire',
+            name=question + '_typed',
+            field=models.BooleanField(default=False),
+        )
+        for question in QUESTIONS
+    ] + [
+        migrations.RunPython(parse_answers, format_answers),
+        # A default lets the old column be re-added when migrating backwards
+        migrations.AlterField(
+            model_name='userquestionnaire',
+            name='safety_level',
+            field=models.CharField(default='0', max_length=1),
+        ),
+        migrations.RemoveField(
+            model_name='userquestionnaire',
+            name='safety_level',
+        ),
+        migrations.RenameField(
+            model_name='userquestionnaire',
+            old_name='safety_level_typed',
+            new_name='safety_level',
+        ),
+        migrations.AlterField(
+            model_name='userquestionnaire',
+            name='safety_level',
+            field=models.PositiveSmallIntegerField(),
+        ),
+    ] + [
+        operation
+        for question in QUESTIONS
+        for operation in (
+            migrations.RemoveField(
+                model_name='userquestionnaire',
+                name=question,
+            ),
+            migrations.RenameField(
+                model_name='userquestionnaire',
+                old_name=question + '_typed',
+                new_name=question,
+            ),
+        )
+    ]
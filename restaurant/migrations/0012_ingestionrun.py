@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0011_typed_questionnaire_answers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_on', models.DateTimeField(blank=True, default=None, null=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('watermark', models.DateTimeField(blank=True, default=None, null=True)),
+                ('cursor', models.PositiveIntegerField(default=0)),
+                ('pages', models.PositiveIntegerField(default=0)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('inspections_created', models.PositiveIntegerField(default=0)),
+                ('restaurants_created', models.PositiveIntegerField(default=0)),
+                ('restaurants_updated', models.PositiveIntegerField(default=0)),
+                ('seconds', models.FloatField(default=0.0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('resumed_from', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='restaurant.ingestionrun')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ingestionrun',
+            index=models.Index(fields=['-started_on'], name='ingestion_started_idx'),
+        ),
+    ]
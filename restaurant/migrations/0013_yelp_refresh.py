@@ -0,0 +1,27 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0012_ingestionrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yelprestaurantdetails',
+            name='last_refreshed',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='yelprestaurantdetails',
+            name='profile_views',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['last_refreshed'], name='yelp_last_refreshed_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:33
+
+from django.db import migrations, models
+
+
+def create_geo_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE restaurant_geo "
+        "USING rtree(id, min_lat, max_lat, min_lng, max_lng)"
+    )
+    schema_editor.execute(
+        "INSERT INTO restaurant_geo (id, min_lat, max_lat, min_lng, max_lng) "
+        "SELECT r.id, d.latitude, d.latitude, d.longitude, d.longitude "
+        "FROM restaurant_restaurant r "
+        "JOIN restaurant_yelprestaurantdetails d ON r.yelp_detail_id = d.business_id "
+        "WHERE NOT (d.latitude = 0 AND d.longitude = 0)"
+    )
+
+
+def drop_geo_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS restaurant_geo")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0013_yelp_refresh'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='yelprestaurantdetails',
+            index=models.Index(fields=['latitude', 'longitude'], name='yelp_coordinates_idx'),
+        ),
+        migrations.RunPython(create_geo_table, drop_geo_table),
+    ]
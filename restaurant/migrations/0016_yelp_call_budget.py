@@ -0,0 +1,20 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0015_yelp_match_backoff'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='YelpCallBudget',
+            fields=[
+                ('day', models.DateField(primary_key=True, serialize=False)),
+                ('used', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
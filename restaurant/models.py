@@ -1,10 +1,26 @@
+import logging
+
+from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.utils import timezone
 
+logger = logging.getLogger(__name__)
+
 
 class Categories(models.Model):
     category = models.CharField(max_length=200, primary_key=True)
     parent_category = models.CharField(max_length=200, default=None, null=True)
+    # Lowercased parent_category, kept in sync by restaurant.signals, so the
+    # category filter can use an indexed equality lookup.
+    parent_category_key = models.CharField(max_length=200, default=None, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["parent_category_key"], name="category_parent_key_idx"
+            ),
+        ]
 
     def __str__(self):
         return "{} {}".format(self.category, self.parent_category)
@@ -13,6 +29,9 @@ class Categories(models.Model):
 class YelpRestaurantDetails(models.Model):
     business_id = models.CharField(max_length=200, primary_key=True)
     neighborhood = models.CharField(max_length=200, default=None, null=True)
+    # Lowercased neighborhood, kept in sync by restaurant.signals and set by
+    # the bulk ingest, so the neighborhood filter avoids a regex scan.
+    neighborhood_key = models.CharField(max_length=200, default=None, null=True)
     category = models.ManyToManyField(Categories, blank=True)
     price = models.CharField(max_length=200, default=None, null=True)
     rating = models.FloatField(blank=True, default=0.0, null=True)
@@ -23,6 +42,20 @@ class YelpRestaurantDetails(models.Model):
     longitude = models.DecimalField(
         max_digits=17, decimal_places=14, blank=True, default=0
     )
+    # Profile page views, so the background refresher re-fetches the most
+    # viewed restaurants first, and when Yelp was last asked for the details
+    profile_views = models.PositiveIntegerField(default=0)
+    last_refreshed = models.DateTimeField(default=None, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["rating"], name="yelp_rating_idx"),
+            models.Index(fields=["price"], name="yelp_price_idx"),
+            models.Index(fields=["neighborhood"], name="yelp_neighborhood_idx"),
+            models.Index(fields=["neighborhood_key"], name="yelp_neighborhood_key_idx"),
+            models.Index(fields=["last_refreshed"], name="yelp_last_refreshed_idx"),
+            models.Index(fields=["latitude", "longitude"], name="yelp_coordinates_idx"),
+        ]
 
     def __str__(self):
         return "{} {} {} {} {} {} {} {}".format(
@@ -56,9 +89,57 @@ class Restaurant(models.Model):
     compliant_status = models.CharField(
         max_length=200, default=None, blank=True, null=True
     )
+    # Denormalized copy of the newest InspectionRecords row for this restaurant,
+    # maintained at ingest time so card renders do not have to sort inspections.
+    latest_inspection = models.ForeignKey(
+        "InspectionRecords",
+        on_delete=models.SET_NULL,
+        default=None,
+        blank=True,
+        null=True,
+        related_name="+",
+    )
+    inspected_on = models.DateTimeField(default=None, blank=True, null=True)
+    is_roadway_compliant = models.CharField(
+        max_length=200, default=None, blank=True, null=True
+    )
+    # Failed Yelp matches of a restaurant without Yelp details, and when it
+    # may be tried again; each failure doubles the wait
+    yelp_match_attempts = models.PositiveSmallIntegerField(default=0)
+    yelp_match_retry_on = models.DateTimeField(default=None, blank=True, null=True)
 
     class Meta:
         unique_together = (("restaurant_name", "business_address", "postcode"),)
+        indexes = [
+            models.Index(fields=["compliant_status"], name="restaurant_compliant_idx"),
+            models.Index(
+                fields=["yelp_match_retry_on"], name="restaurant_yelp_retry_idx"
+            ),
+        ]
+
+    def set_latest_inspection(self, record):
+        """
+        Point this restaurant at record unless it already references a newer
+        inspection. Returns True if the pointer was moved.
+        """
+        updated = (
+            Restaurant.objects.filter(pk=self.pk)
+            .filter(
+                Q(inspected_on__isnull=True) | Q(inspected_on__lte=record.inspected_on)
+            )
+            .update(
+                latest_inspection=record,
+                inspected_on=record.inspected_on,
+                is_roadway_compliant=record.is_roadway_compliant,
+                compliant_status=record.is_roadway_compliant,
+            )
+        )
+        if updated:
+            self.latest_inspection = record
+            self.inspected_on = record.inspected_on
+            self.is_roadway_compliant = record.is_roadway_compliant
+            self.compliant_status = record.is_roadway_compliant
+        return bool(updated)
 
     def __str__(self):
         return "{} {} {} {} {} {}".format(
@@ -71,6 +152,20 @@ class Restaurant(models.Model):
         )
 
 
+class TopCompliantRestaurant(models.Model):
+    """Materialized list of the best rated compliant restaurants, by rank."""
+
+    rank = models.PositiveIntegerField(primary_key=True)
+    restaurant = models.OneToOneField(
+        Restaurant, on_delete=models.CASCADE, related_name="top_compliant"
+    )
+    rating = models.FloatField(default=0.0)
+    inspected_on = models.DateTimeField(default=None, blank=True, null=True)
+
+    def __str__(self):
+        return "{} {} {}".format(self.rank, self.restaurant_id, self.rating)
+
+
 class InspectionRecords(models.Model):
     restaurant_inspection_id = models.CharField(max_length=200, primary_key=True)
     restaurant_name = models.CharField(max_length=200)
@@ -81,6 +176,24 @@ class InspectionRecords(models.Model):
     inspected_on = models.DateTimeField()
     business_id = models.CharField(max_length=200, default=None, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=[
+                    "restaurant_name",
+                    "business_address",
+                    "postcode",
+                    "-inspected_on",
+                ],
+                name="inspection_restaurant_idx",
+            ),
+            models.Index(
+                fields=["business_id", "-inspected_on"],
+                name="inspection_business_idx",
+            ),
+            models.Index(fields=["-inspected_on"], name="inspection_date_idx"),
+        ]
+
     def __str__(self):
         return "{} {} {} {} {} {} {} {}".format(
             self.restaurant_inspection_id,
@@ -97,13 +210,21 @@ class InspectionRecords(models.Model):
 class UserQuestionnaire(models.Model):
     restaurant_business_id = models.CharField(max_length=200, null=False)
     user_id = models.CharField(max_length=200, null=False, default="")
-    safety_level = models.CharField(max_length=1)
+    safety_level = models.PositiveSmallIntegerField()
     saved_on = models.DateTimeField(default=timezone.now, null=False, blank=True)
-    temperature_required = models.CharField(max_length=5, null=False, default="False")
-    contact_info_required = models.CharField(max_length=5, null=False, default="False")
-    employee_mask = models.CharField(max_length=5, null=False, default="False")
-    capacity_compliant = models.CharField(max_length=5, null=False, default="False")
-    distance_compliant = models.CharField(max_length=5, null=False, default="False")
+    temperature_required = models.BooleanField(default=False)
+    contact_info_required = models.BooleanField(default=False)
+    employee_mask = models.BooleanField(default=False)
+    capacity_compliant = models.BooleanField(default=False)
+    distance_compliant = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["restaurant_business_id", "saved_on"],
+                name="questionnaire_business_idx",
+            ),
+        ]
 
     def __str__(self):
         return "{} {} {} {} {} {} {} {} {}".format(
@@ -119,6 +240,74 @@ class UserQuestionnaire(models.Model):
         )
 
 
+# Yes/no questions of UserQuestionnaire and the prefix of their statistics keys
+QUESTIONNAIRE_QUESTIONS = {
+    "temperature_required": "temp_check",
+    "contact_info_required": "contact_info_required",
+    "employee_mask": "employee_mask",
+    "capacity_compliant": "capacity_compliant",
+    "distance_compliant": "distance_compliant",
+}
+
+
+class QuestionnaireAggregate(models.Model):
+    """
+    Running totals of the UserQuestionnaire rows of one business. The window
+    counters only cover feedback saved since the latest inspection and are
+    recomputed whenever a new inspection arrives.
+    """
+
+    restaurant_business_id = models.CharField(max_length=200, primary_key=True)
+    feedback_count = models.PositiveIntegerField(default=0)
+    safety_level_total = models.PositiveIntegerField(default=0)
+    latest_feedback = models.ForeignKey(
+        UserQuestionnaire,
+        on_delete=models.SET_NULL,
+        default=None,
+        blank=True,
+        null=True,
+        related_name="+",
+    )
+    window_start = models.DateTimeField(default=None, blank=True, null=True)
+    window_count = models.PositiveIntegerField(default=0)
+    window_safety_level_total = models.PositiveIntegerField(default=0)
+    temperature_required_true = models.PositiveIntegerField(default=0)
+    contact_info_required_true = models.PositiveIntegerField(default=0)
+    employee_mask_true = models.PositiveIntegerField(default=0)
+    capacity_compliant_true = models.PositiveIntegerField(default=0)
+    distance_compliant_true = models.PositiveIntegerField(default=0)
+
+    def average_safety_rating(self):
+        if not self.feedback_count:
+            return None
+        return str(round(self.safety_level_total / self.feedback_count, 2))
+
+    def statistics(self):
+        statistics_dict = {"valuable_avg_safety_rating": 0}
+        for question, name in QUESTIONNAIRE_QUESTIONS.items():
+            statistics_dict[name + "_true"] = 0
+            statistics_dict[name + "_false"] = 0
+        if self.window_start is None or not self.window_count:
+            return statistics_dict
+
+        statistics_dict["valuable_avg_safety_rating"] = str(
+            round(self.window_safety_level_total / self.window_count, 2)
+        )
+        for question, name in QUESTIONNAIRE_QUESTIONS.items():
+            true_count = getattr(self, question + "_true")
+            statistics_dict[name + "_true"] = true_count
+            statistics_dict[name + "_false"] = self.window_count - true_count
+        return statistics_dict
+
+    def __str__(self):
+        return "{} {} {} {}".format(
+            self.restaurant_business_id,
+            self.feedback_count,
+            self.window_start,
+            self.window_count,
+        )
+
+
 class Zipcodes(models.Model):
     zipcode = models.CharField(max_length=200, primary_key=True)
     borough = models.CharField(max_length=200, default=None, null=True)
@@ -126,3 +315,126 @@ class Zipcodes(models.Model):
 
     def __str__(self):
         return "{} {} {}".format(self.zipcode, self.borough, self.neighborhood)
+
+
+class IngestionRun(models.Model):
+    """
+    Ledger entry of one inspection ingestion run. The run requests the
+    inspections at or after watermark; cursor is the offset of the next page
+    and only advances in the transaction that commits a page, so an
+    unfinished run can be resumed from it.
+    """
+
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (RUNNING, "Running"),
+        (COMPLETED, "Completed"),
+        (FAILED, "Failed"),
+    ]
+
+    started_on = models.DateTimeField(default=timezone.now)
+    finished_on = models.DateTimeField(default=None, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RUNNING)
+    resumed_from = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        default=None,
+        blank=True,
+        null=True,
+        related_name="+",
+    )
+    watermark = models.DateTimeField(default=None, blank=True, null=True)
+    cursor = models.PositiveIntegerField(default=0)
+    pages = models.PositiveIntegerField(default=0)
+    rows = models.PositiveIntegerField(default=0)
+    inspections_created = models.PositiveIntegerField(default=0)
+    restaurants_created = models.PositiveIntegerField(default=0)
+    restaurants_updated = models.PositiveIntegerField(default=0)
+    # Time spent writing pages, excluding the downloads
+    seconds = models.FloatField(default=0.0)
+    error = models.TextField(default="", blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-started_on"], name="ingestion_started_idx"),
+        ]
+
+    @classmethod
+    def start(cls):
+        """
+        Open a new run. If the previous run did not complete, the new one
+        resumes its watermark and cursor, unless INGESTION_MAX_RESUMES runs
+        in a row already did; otherwise it starts at the newest stored
+        inspection.
+        """
+        previous = cls.objects.order_by("-started_on", "-id").first()
+        if previous is not None and previous.status != cls.COMPLETED:
+            if previous.status == cls.RUNNING:
+                previous.finish(error="Interrupted")
+            if previous.resumes() < settings.INGESTION_MAX_RESUMES:
+                return cls.objects.create(
+                    watermark=previous.watermark,
+                    cursor=previous.cursor,
+                    resumed_from=previous,
+                )
+            logger.error(
+                "Ingestion run {} failed after {} resumes, starting over".format(
+                    previous.pk, settings.INGESTION_MAX_RESUMES
+                )
+            )
+        latest = InspectionRecords.objects.order_by("-inspected_on").first()
+        return cls.objects.create(watermark=latest.inspected_on if latest else None)
+
+    def resumes(self):
+        """Number of failed runs in a row this run resumed from."""
+        resumes, run = 0, self
+        while run.resumed_from_id and resumes < settings.INGESTION_MAX_RESUMES:
+            run = run.resumed_from
+            resumes += 1
+        return resumes
+
+    def record_page(self, cursor, stats):
+        """Advance the cursor past a page whose rows were just written."""
+        self.cursor = cursor
+        self.pages += 1
+        for name in [
+            "rows",
+            "inspections_created",
+            "restaurants_created",
+            "restaurants_updated",
+        ]:
+            setattr(self, name, getattr(self, name) + stats[name])
+        self.seconds += stats["seconds"]
+        self.save()
+
+    def finish(self, error=None):
+        self.status = self.FAILED if error else self.COMPLETED
+        self.error = str(error) if error else ""
+        self.finished_on = timezone.now()
+        self.save()
+
+    def elapsed(self):
+        if self.finished_on is None:
+            return None
+        return (self.finished_on - self.started_on).total_seconds()
+
+    def rows_per_second(self):
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed else 0
+
+    def __str__(self):
+        return "{} {} {} {} {}".format(
+            self.started_on, self.status, self.watermark, self.cursor, self.rows
+        )
+
+
+class YelpCallBudget(models.Model):
+    """Yelp calls taken from the daily background budget, see reserve_yelp_calls."""
+
+    day = models.DateField(primary_key=True)
+    used = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "{} {}".format(self.day, self.used)
@@ -0,0 +1,232 @@
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+
+from user.models import RecommendedRestaurant
+
+from .models import Restaurant, UserQuestionnaire, YelpRestaurantDetails
+from .search import normalize_search_key
+
+logger = logging.getLogger(__name__)
+
+# Score of a candidate restaurant: a bonus if it is in one of the preferred
+# categories, plus its share of the user's category and neighborhood
+# affinity, plus its Yelp rating out of 5
+PREFERENCE_WEIGHT = 3.0
+CATEGORY_WEIGHT = 2.0
+NEIGHBORHOOD_WEIGHT = 1.0
+RATING_WEIGHT = 1.0
+
+# Questionnaire safety levels that count as liking or avoiding a restaurant
+LIKED_SAFETY_LEVEL = 4
+AVOIDED_SAFETY_LEVEL = 2
+
+# Yelp rating below which a restaurant is never recommended
+RECOMMENDATION_MIN_RATING = 3
+
+
+def restaurant_categories(business_ids):
+    """{business id: set of parent category keys} of the given restaurants."""
+    categories = {}
+    for business_id, category in YelpRestaurantDetails.category.through.objects.filter(
+        yelprestaurantdetails_id__in=business_ids
+    ).values_list("yelprestaurantdetails_id", "categories__parent_category_key"):
+        if category:
+            categories.setdefault(business_id, set()).add(category)
+    return categories
+
+
+class UserProfile:
+    """
+    What the recommendations of a user are based on: the parent categories
+    of their preferences, and the categories and neighborhoods of the
+    restaurants they saved or rated safe. Restaurants they rated unsafe are
+    never recommended.
+    """
+
+    def __init__(self, user):
+        self.preferred = {
+            normalize_search_key(parent)
+            for parent in user.preferences.values_list("parent_category", flat=True)
+            if parent
+        }
+        liked = set(
+            user.favorite_restaurants.exclude(business_id=None).values_list(
+                "business_id", flat=True
+            )
+        )
+        self.avoided = set()
+        for business_id, safety_level in UserQuestionnaire.objects.filter(
+            user_id=str(user.pk)
+        ).values_list("restaurant_business_id", "safety_level"):
+            if safety_level >= LIKED_SAFETY_LEVEL:
+                liked.add(business_id)
+            elif safety_level <= AVOIDED_SAFETY_LEVEL:
+                self.avoided.add(business_id)
+        liked -= self.avoided
+
+        self.categories = Counter()
+        for categories in restaurant_categories(liked).values():
+            self.categories.update(categories)
+        self.neighborhoods = Counter(
+            YelpRestaurantDetails.objects.filter(business_id__in=liked)
+            .exclude(neighborhood_key=None)
+            .values_list("neighborhood_key", flat=True)
+        )
+
+    def is_empty(self):
+        return not (self.preferred or self.categories or self.neighborhoods)
+
+    def score(self, categories, neighborhood, rating):
+        score = RATING_WEIGHT * (rating or 0) / 5
+        if categories & self.preferred:
+            score += PREFERENCE_WEIGHT
+        if categories and self.categories:
+            score += CATEGORY_WEIGHT * max(
+                self.categories[c] / sum(self.categories.values()) for c in categories
+            )
+        if neighborhood and self.neighborhoods:
+            score += (
+                NEIGHBORHOOD_WEIGHT
+                * self.neighborhoods[neighborhood]
+                / sum(self.neighborhoods.values())
+            )
+        return score
+
+
+def candidate_restaurants(profile):
+    """
+    The compliant restaurants rated RECOMMENDATION_MIN_RATING or more worth
+    scoring for profile, best rated first and at most RECOMMENDATION_POOL_SIZE
+    of them: those sharing a category or a neighborhood with the profile, or
+    all of them if the profile is empty.
+    """
+    details = YelpRestaurantDetails.objects.filter(
+        rating__gte=RECOMMENDATION_MIN_RATING
+    ).exclude(business_id__in=profile.avoided)
+    if not profile.is_empty():
+        details = details.filter(
+            Q(
+                category__parent_category_key__in=profile.preferred
+                | set(profile.categories)
+            )
+            | Q(neighborhood_key__in=profile.neighborhoods)
+        )
+    return (
+        Restaurant.objects.filter(
+            compliant_status="Compliant", business_id__in=details.values("business_id")
+        )
+        .order_by("-yelp_detail__rating", "id")
+        .values_list(
+            "id",
+            "business_id",
+            "yelp_detail__rating",
+            "yelp_detail__neighborhood_key",
+        )[: settings.RECOMMENDATION_POOL_SIZE]
+    )
+
+
+def score_restaurants(user, limit=None):
+    """Up to limit (score, restaurant id) pairs for user, best first."""
+    limit = limit or settings.RECOMMENDATION_LIST_SIZE
+    profile = UserProfile(user)
+    candidates = list(candidate_restaurants(profile))
+    categories = restaurant_categories(
+        [business_id for _, business_id, _, _ in candidates]
+    )
+    scored = sorted(
+        (
+            (
+                profile.score(categories.get(business_id, set()), neighborhood, rating),
+                restaurant_id,
+            )
+            for restaurant_id, business_id, rating, neighborhood in candidates
+        ),
+        key=lambda scored: (-scored[0], scored[1]),
+    )
+    return scored[:limit]
+
+
+def refresh_user_recommendations(user):
+    """
+    Rebuild the recommendation list of one user. Returns False if it did
+    not change.
+    """
+    # Cleared first, so changes made while scoring mark the list stale again
+    get_user_model().objects.filter(pk=user.pk).update(recommendations_stale=False)
+    top = score_restaurants(user)
+    current = list(
+        RecommendedRestaurant.objects.filter(user=user)
+        .order_by("rank")
+        .values_list("score", "restaurant_id")
+    )
+    if current == top:
+        return False
+    with transaction.atomic():
+        RecommendedRestaurant.objects.filter(user=user).delete()
+        RecommendedRestaurant.objects.bulk_create(
+            RecommendedRestaurant(
+                user=user, rank=rank, restaurant_id=restaurant_id, score=score
+            )
+            for rank, (score, restaurant_id) in enumerate(top, 1)
+        )
+    return True
+
+
+def mark_recommendations_stale(user_ids):
+    """
+    Mark the lists of the given users for a rebuild, which happens when they
+    are next read or in the background, see refresh_stale_recommendations.
+    """
+    get_user_model().objects.filter(pk__in=user_ids).update(recommendations_stale=True)
+
+
+def refresh_stale_recommendations():
+    """Rebuild the stale lists. Returns the number of lists rebuilt."""
+    users = get_user_model().objects.filter(recommendations_stale=True)
+    rebuilt = 0
+    for user in users.iterator():
+        refresh_user_recommendations(user)
+        rebuilt += 1
+    return rebuilt
+
+
+def refresh_all_recommendations():
+    """
+    Rebuild the lists of the users who have one, since restaurant ratings
+    and compliance change under them. Returns the number of lists changed.
+    """
+    users = get_user_model().objects.filter(recommendations__isnull=False).distinct()
+    changed = sum(refresh_user_recommendations(user) for user in users.iterator())
+    logger.info("Refreshed recommendations, {} lists changed".format(changed))
+    return changed
+
+
+def recommended_restaurants(user):
+    """
+    The RecommendedRestaurant rows of the user, building their list first
+    if they have none or it is stale.
+    """
+    recommendations = RecommendedRestaurant.objects.filter(user=user)
+    stale = (
+        get_user_model().objects.filter(pk=user.pk, recommendations_stale=True).exists()
+    )
+    if stale or not recommendations.exists():
+        refresh_user_recommendations(user)
+    return recommendations
+
+
+def user_recommendation_candidates(user, neighborhood=None):
+    """{restaurant id: score} of the user's list, optionally in some neighborhoods."""
+    recommendations = recommended_restaurants(user)
+    if neighborhood:
+        recommendations = recommendations.filter(
+            restaurant__yelp_detail__neighborhood_key__in=[
+                normalize_search_key(n) for n in neighborhood
+            ]
+        )
+    return dict(recommendations.values_list("restaurant_id", "score"))
@@ -0,0 +1,114 @@
+import functools
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import FloatField, Value
+from django.utils.module_loading import import_string
+
+from .models import Restaurant
+
+SEARCH_TABLE = "restaurant_search"
+
+
+def normalize_search_key(value):
+    """Lowercased, trimmed form of value used by the exact-match filter columns."""
+    if value is None:
+        return None
+    return value.strip().lower()
+
+
+class DatabaseSearchBackend:
+    """
+    Plain ORM search: a case-insensitive substring match on the restaurant
+    name. It needs no index, so it works on any database.
+    """
+
+    def filter(self, queryset, keyword):
+        """
+        Restrict queryset to restaurants matching keyword and annotate each
+        row with search_rank, where lower values are better matches.
+        """
+        return queryset.filter(restaurant_name__icontains=keyword).annotate(
+            search_rank=Value(0.0, output_field=FloatField())
+        )
+
+    def index(self, restaurants):
+        pass
+
+    def remove(self, restaurant_ids):
+        pass
+
+    def rebuild(self):
+        return 0
+
+
+class SQLiteSearchBackend(DatabaseSearchBackend):
+    """
+    SQLite FTS5 index over restaurant names using the trigram tokenizer, so
+    substring and prefix searches of three or more characters are served by
+    the index and ranked with bm25. Shorter keywords fall back to the plain
+    substring match.
+    """
+
+    min_length = 3
+
+    def filter(self, queryset, keyword):
+        if len(keyword) < self.min_length:
+            return super().filter(queryset, keyword)
+        query = '"%s"' % keyword.replace('"', '""')
+        # Join the FTS table so the MATCH runs once and bm25 ranks come along
+        return queryset.extra(
+            select={"search_rank": "{}.rank".format(SEARCH_TABLE)},
+            tables=[SEARCH_TABLE],
+            where=[
+                "{}.rowid = {}.id".format(SEARCH_TABLE, Restaurant._meta.db_table),
+                "{} MATCH %s".format(SEARCH_TABLE),
+            ],
+            params=[query],
+        )
+
+    def index(self, restaurants):
+        rows = [(r.id, r.restaurant_name) for r in restaurants if r.id]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "DELETE FROM {} WHERE rowid = %s".format(SEARCH_TABLE),
+                [(pk,) for pk, _ in rows],
+            )
+            cursor.executemany(
+                "INSERT INTO {} (rowid, restaurant_name) VALUES (%s, %s)".format(
+                    SEARCH_TABLE
+                ),
+                rows,
+            )
+
+    def remove(self, restaurant_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "DELETE FROM {} WHERE rowid = %s".format(SEARCH_TABLE),
+                [(pk,) for pk in restaurant_ids],
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(SEARCH_TABLE))
+            cursor.execute(
+                "INSERT INTO {} (rowid, restaurant_name) "
+                "SELECT id, restaurant_name FROM {}".format(
+                    SEARCH_TABLE, Restaurant._meta.db_table
+                )
+            )
+            return cursor.rowcount
+
+
+# Default search backend by database vendor; others use DatabaseSearchBackend
+SEARCH_BACKENDS = {"sqlite": "restaurant.search.SQLiteSearchBackend"}
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_backend():
+    backend = settings.SEARCH_BACKEND or SEARCH_BACKENDS.get(
+        connection.vendor, "restaurant.search.DatabaseSearchBackend"
+    )
+    return import_string(backend)()
@@ -0,0 +1,102 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import (
+    Categories,
+    InspectionRecords,
+    Restaurant,
+    UserQuestionnaire,
+    YelpRestaurantDetails,
+)
+from .geo import get_geo_backend
+from .recommendation import mark_recommendations_stale
+from .search import get_search_backend, normalize_search_key
+from .tiles import invalidate_tiles
+from .utils import (
+    invalidate_favorite_ids,
+    record_questionnaire,
+    refresh_questionnaire_aggregates,
+)
+
+
+@receiver(pre_save, sender=YelpRestaurantDetails)
+def normalize_neighborhood(sender, instance, **kwargs):
+    instance.neighborhood_key = normalize_search_key(instance.neighborhood)
+
+
+@receiver(pre_save, sender=Categories)
+def normalize_parent_category(sender, instance, **kwargs):
+    instance.parent_category_key = normalize_search_key(instance.parent_category)
+
+
+@receiver(post_save, sender=Restaurant)
+def index_restaurant(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index([instance])
+        get_geo_backend().index([instance])
+        invalidate_tiles()
+
+
+@receiver(post_delete, sender=Restaurant)
+def remove_restaurant(sender, instance, **kwargs):
+    get_search_backend().remove([instance.id])
+    get_geo_backend().remove([instance.id])
+    invalidate_tiles()
+
+
+@receiver(post_save, sender=YelpRestaurantDetails)
+def index_coordinates(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_geo_backend().index(Restaurant.objects.filter(yelp_detail=instance))
+        invalidate_tiles()
+
+
+@receiver(post_save, sender=UserQuestionnaire)
+def aggregate_questionnaire(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_questionnaire(instance)
+
+
+@receiver(post_save, sender=InspectionRecords)
+def reset_questionnaire_window(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.business_id:
+        refresh_questionnaire_aggregates([instance.business_id])
+
+
+def changed_users(sender, instance, action, reverse, pk_set, related_name):
+    """Ids of the users whose links changed in a user m2m_changed signal."""
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            return [instance.pk]
+    elif action in ("post_add", "post_remove"):
+        return list(pk_set)
+    elif action == "pre_clear":
+        # The users are unknown once the links are gone
+        return list(
+            sender.objects.filter(**{related_name: instance}).values_list(
+                "dinesafelyuser_id", flat=True
+            )
+        )
+    return []
+
+
+@receiver(m2m_changed, sender=get_user_model().favorite_restaurants.through)
+def reset_favorite_ids(sender, instance, action, reverse, pk_set, **kwargs):
+    user_ids = changed_users(sender, instance, action, reverse, pk_set, "restaurant")
+    if user_ids:
+        invalidate_favorite_ids(user_ids)
+        mark_recommendations_stale(user_ids)
+
+
+@receiver(m2m_changed, sender=get_user_model().preferences.through)
+def reset_preferences(sender, instance, action, reverse, pk_set, **kwargs):
+    user_ids = changed_users(sender, instance, action, reverse, pk_set, "categories")
+    if user_ids:
+        mark_recommendations_stale(user_ids)
+
+
+@receiver(post_save, sender=UserQuestionnaire)
+def rescore_questionnaire_user(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and str(instance.user_id).isdigit():
+        mark_recommendations_stale([int(instance.user_id)])
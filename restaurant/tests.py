@@ -1,13 +1,22 @@
-from django.test import RequestFactory, TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 from django.forms.models import model_to_dict
 from django.test import Client
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs, urlparse
 from unittest import mock
 
+from asgiref.sync import async_to_sync
+
 from django.urls import reverse
 
 from .forms import QuestionnaireForm
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
 from .models import (
     Restaurant,
     InspectionRecords,
@@ -15,8 +24,18 @@ from .models import (
     Zipcodes,
     UserQuestionnaire,
     Categories,
+    TopCompliantRestaurant,
+    QuestionnaireAggregate,
+    IngestionRun,
+    YelpCallBudget,
+)
+from .views import (
+    get_inspection_info,
+    get_landing_page,
+    get_restaurant_profile,
+    get_restaurant_profile_async,
+    load_profile_source,
 )
-from .views import get_inspection_info, get_landing_page, get_restaurant_profile
 from .utils import (
     merge_yelp_info,
     get_restaurant_info_yelp,
@@ -27,12 +46,92 @@ from .utils import (
     get_filtered_restaurants,
     get_latest_feedback,
     get_average_safety_rating,
+    annotate_saved_restaurants,
     check_restaurant_saved,
     questionnaire_report,
     questionnaire_statistics,
+    restaurants_to_dict,
+    get_restaurant_info_yelp_local,
+    default_info_page,
+    get_restaurant_latest_inspection,
+    get_covid_data,
+    refresh_covid_data,
+    COVID_DATA_CACHE_KEY,
+    COVID_DATA_FALLBACK_KEY,
+    response_cache,
+    yelp_cache_key,
+    refresh_top_compliant_restaurants,
+    get_top_compliant_restaurant_list,
+    encode_cursor,
+    search_restaurants,
+    get_questionnaire_aggregate,
+    record_profile_view,
+    recommendation_candidates,
+    refresh_recommendation_buckets,
+    sample_recommendations,
+    refresh_questionnaire_aggregate,
+)
+from .search import (
+    DatabaseSearchBackend,
+    SQLiteSearchBackend,
+    get_search_backend,
+)
+from .geo import (
+    GEO_TABLE,
+    DatabaseGeoBackend,
+    SQLiteGeoBackend,
+    get_geo_backend,
+    located_restaurants,
+    restaurants_in_box,
+)
+from .tiles import tile_bounds, tile_for_point
+from .http_client import (
+    HttpClient,
+    RateLimiter,
+    get_http_client,
+    get_request_http_client,
+)
+from .jobs import Job, JobRunner, job_lock_key
+from .recommendation import (
+    recommended_restaurants,
+    refresh_all_recommendations,
+    refresh_stale_recommendations,
+    refresh_user_recommendations,
+)
+
+from yelprestaurantdetails import (
+    enrich_restaurants,
+    enrich_unmatched_restaurants,
+    get_neighbourhood,
+    parse_yelp_categories,
+    refresh_yelp_details,
+    reserve_yelp_calls,
+    reset_reference_tables,
+    save_yelp_restaurant_details,
+    save_yelp_restaurant_details_bulk,
+    sync_categories,
+)
+from getinspection import (
+    clean_inspection_data,
+    fetch_inspection_pages,
+    ingest_inspections,
+    save_restaurants,
 )
 
 import json
+import pandas as pd
+import requests
+import threading
+import time
+
+
+LOCMEM_CACHES = {
+    alias: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": alias,
+    }
+    for alias in ("default", "responses")
+}
 
 
 def create_restaurant(
@@ -197,24 +296,24 @@ class ModelTests(TestCase):
         questionnaire = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now(),
-            temperature_required="True",
-            contact_info_required="True",
-            employee_mask="True",
-            capacity_compliant="True",
-            distance_compliant="True",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         self.assertIsNotNone(questionnaire)
         self.assertEqual(questionnaire.restaurant_business_id, "WavvLdfdP6g8aZTtbBQHTw")
         self.assertEqual(questionnaire.user_id, "1")
-        self.assertEqual(questionnaire.safety_level, "5")
+        self.assertEqual(questionnaire.safety_level, 5)
         self.assertIsNotNone(questionnaire.saved_on)
-        self.assertEqual(questionnaire.temperature_required, "True")
-        self.assertEqual(questionnaire.contact_info_required, "True")
-        self.assertEqual(questionnaire.employee_mask, "True")
-        self.assertEqual(questionnaire.capacity_compliant, "True")
-        self.assertEqual(questionnaire.distance_compliant, "True")
+        self.assertTrue(questionnaire.temperature_required)
+        self.assertTrue(questionnaire.contact_info_required)
+        self.assertTrue(questionnaire.employee_mask)
+        self.assertTrue(questionnaire.capacity_compliant)
+        self.assertTrue(questionnaire.distance_compliant)
         self.assertEqual(
             str(questionnaire),
             "WavvLdfdP6g8aZTtbBQHTw 1 5 "
@@ -273,13 +372,13 @@ class BaseTest(TestCase):
         self.dummy_user_questionnaire = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now(),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
 
         return super().setUp
@@ -421,6 +520,44 @@ class UserQuestionnaireFormTests(BaseTest):
         form = QuestionnaireForm(self.form_valid)
         self.assertTrue(form.is_valid())
 
+    def test_form_normalizes_answers(self):
+        form = QuestionnaireForm(
+            {
+                "restaurant_business_id": "WavvLdfdP6g8aZTtbBQHTw",
+                "user_id": "1",
+                "safety_level": "4",
+                "temperature_required": "true",
+                "contact_info_required": "false",
+                "employee_mask": "True",
+                "capacity_compliant": "False",
+                "distance_compliant": "false",
+            }
+        )
+        self.assertTrue(form.is_valid())
+        questionnaire = form.save()
+        questionnaire.refresh_from_db()
+        self.assertEqual(questionnaire.safety_level, 4)
+        self.assertIs(questionnaire.temperature_required, True)
+        self.assertIs(questionnaire.contact_info_required, False)
+        self.assertIs(questionnaire.employee_mask, True)
+        self.assertIs(questionnaire.capacity_compliant, False)
+
+    def test_invalid_answers(self):
+        form = dict(
+            restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
+            user_id="1",
+            safety_level="9",
+            temperature_required="maybe",
+            contact_info_required="true",
+            employee_mask="true",
+            capacity_compliant="true",
+            distance_compliant="true",
+        )
+        questionnaire_form = QuestionnaireForm(form)
+        self.assertFalse(questionnaire_form.is_valid())
+        self.assertIn("safety_level", questionnaire_form.errors)
+        self.assertIn("temperature_required", questionnaire_form.errors)
+
     def test_form_submission(self):
         create_restaurant(
             "random_name",
@@ -721,24 +858,24 @@ class RestaurantUtilsTests(TestCase):
         questionnaire_old = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now(),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         questionnaire_new = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now() + timedelta(hours=1),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         latest_feedback = get_latest_feedback("WavvLdfdP6g8aZTtbBQHTw")
         self.assertEqual(latest_feedback, model_to_dict(questionnaire_new))
@@ -748,35 +885,35 @@ class RestaurantUtilsTests(TestCase):
         UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="1",
+            safety_level=1,
             saved_on=datetime.now(),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="2",
+            safety_level=2,
             saved_on=datetime.now() + timedelta(hours=1),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="3",
+            safety_level=3,
             saved_on=datetime.now() + timedelta(hours=2),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         average_safety = get_average_safety_rating("WavvLdfdP6g8aZTtbBQHTw")
         self.assertEqual(average_safety, "2.0")
@@ -800,6 +937,28 @@ class RestaurantUtilsTests(TestCase):
         )
         self.assertTrue(check_restaurant_saved(self.dummy_user, 1))
 
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_annotate_saved_restaurants(self):
+        user = get_user_model().objects.create(username="myuser")
+        first = create_restaurant("first", "address", None, "10001", "first-id")
+        second = create_restaurant("second", "address", None, "10001", "second-id")
+        user.favorite_restaurants.add(first)
+        page = [{"id": first.id}, {"id": second.id}]
+
+        with self.assertNumQueries(1):
+            annotate_saved_restaurants(user, page)
+            annotate_saved_restaurants(user, page)
+        self.assertEqual([r["saved_by_user"] for r in page], [True, False])
+
+        # Changing favorites from either side invalidates the cached ids
+        user.favorite_restaurants.remove(first)
+        second.dinesafelyuser_set.add(user)
+        annotate_saved_restaurants(user, page)
+        self.assertEqual([r["saved_by_user"] for r in page], [False, True])
+        second.dinesafelyuser_set.clear()
+        annotate_saved_restaurants(user, page)
+        self.assertEqual([r["saved_by_user"] for r in page], [False, False])
+
     def test_questionnaire_report(self):
         self.dummy_user = get_user_model().objects.create(
             username="myuser",
@@ -830,13 +989,13 @@ class RestaurantUtilsTests(TestCase):
         self.temp_user_questionnaire = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now(),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         latest_inspection_status, valuable_questionnaire_list = questionnaire_report(
             "WavvLdfdP6g8aZTtbBQHTw"
@@ -874,35 +1033,35 @@ class RestaurantUtilsTests(TestCase):
         self.temp_user_questionnaire_1 = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="5",
+            safety_level=5,
             saved_on=datetime.now(),
-            temperature_required="true",
-            contact_info_required="true",
-            employee_mask="true",
-            capacity_compliant="true",
-            distance_compliant="true",
+            temperature_required=True,
+            contact_info_required=True,
+            employee_mask=True,
+            capacity_compliant=True,
+            distance_compliant=True,
         )
         self.temp_user_questionnaire_2 = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="1",
+            safety_level=1,
             saved_on=datetime.now(),
-            temperature_required="false",
-            contact_info_required="false",
-            employee_mask="false",
-            capacity_compliant="false",
-            distance_compliant="false",
+            temperature_required=False,
+            contact_info_required=False,
+            employee_mask=False,
+            capacity_compliant=False,
+            distance_compliant=False,
         )
         self.temp_user_questionnaire_3 = UserQuestionnaire.objects.create(
             restaurant_business_id="WavvLdfdP6g8aZTtbBQHTw",
             user_id="1",
-            safety_level="3",
+            safety_level=3,
             saved_on=datetime.now(),
-            temperature_required="false",
-            contact_info_required="false",
-            employee_mask="false",
-            capacity_compliant="false",
-            distance_compliant="false",
+            temperature_required=False,
+            contact_info_required=False,
+            employee_mask=False,
+            capacity_compliant=False,
+            distance_compliant=False,
         )
         statistics_dict = questionnaire_statistics("WavvLdfdP6g8aZTtbBQHTw")
         self.assertEqual(statistics_dict["valuable_avg_safety_rating"], "3.0")
@@ -1020,3 +1179,1855 @@ class GetFilteredRestaurantsTests(TestCase):
         )
 
         self.assertEqual(details.business_id, filtered_restaurants[0].business_id)
+
+
+class RestaurantsToDictTests(TestCase):
+    """ Test batch serialization of restaurant pages """
+
+    def create_page(self, size):
+        cat = Categories.objects.create(category="wine_bar", parent_category="bars")
+        for i in range(size):
+            business_id = "business_{}".format(i)
+            details = create_yelp_restaurant_details(
+                business_id, "Upper East Side", "$$", 4.0, None, 40.85, -73.82
+            )
+            details.category.add(cat)
+            create_restaurant(
+                "Restaurant {}".format(i), "address", details, "10040", business_id
+            )
+            create_inspection_records(
+                "old_{}".format(i),
+                "Restaurant {}".format(i),
+                "10040",
+                "address",
+                "Non-Compliant",
+                "No Seating",
+                datetime(2020, 10, 21, 12, 30),
+                business_id,
+            )
+            create_inspection_records(
+                "new_{}".format(i),
+                "Restaurant {}".format(i),
+                "10040",
+                "address",
+                "Compliant",
+                "nan",
+                datetime(2020, 10, 22, 12, 30),
+                business_id,
+            )
+
+    def test_restaurants_to_dict_matches_per_restaurant_lookups(self):
+        self.create_page(3)
+        create_restaurant("No Yelp", "address", None, "10040", None)
+        restaurants = Restaurant.objects.all()
+        data = restaurants_to_dict(restaurants)
+
+        self.assertEqual(len(data), 4)
+        for restaurant, restaurant_dict in zip(restaurants, data):
+            if restaurant.business_id:
+                expected_yelp_info = get_restaurant_info_yelp_local(
+                    restaurant.business_id, restaurant.restaurant_name
+                )
+            else:
+                expected_yelp_info = default_info_page(restaurant.restaurant_name)
+            self.assertEqual(restaurant_dict["yelp_info"], expected_yelp_info)
+            self.assertEqual(
+                restaurant_dict["latest_record"],
+                get_latest_inspection_record(
+                    restaurant.restaurant_name,
+                    restaurant.business_address,
+                    restaurant.postcode,
+                ),
+            )
+        self.assertEqual(data[0]["latest_record"]["is_roadway_compliant"], "Compliant")
+        self.assertEqual(data[0]["yelp_info"]["categories"], [{"title": "bars"}])
+
+    def test_restaurants_to_dict_query_count_independent_of_page_size(self):
+        self.create_page(18)
+        for size in (1, 6, 18):
+            with self.assertNumQueries(4):
+                restaurants_to_dict(Restaurant.objects.all()[:size])
+
+    def test_restaurants_to_dict_uses_latest_inspection_pointer(self):
+        self.create_page(6)
+        call_command("backfill_latest_inspection", stdout=StringIO())
+        with self.assertNumQueries(4):
+            data = restaurants_to_dict(Restaurant.objects.all())
+        self.assertEqual(data[0]["latest_record"]["restaurant_inspection_id"], "new_0")
+
+
+class LatestInspectionPointerTests(TestCase):
+    """ Test the denormalized latest inspection on Restaurant """
+
+    def setUp(self):
+        self.restaurant = create_restaurant(
+            "Tacos El Paisa", "1548 St. Nicholas", None, "10040", "16"
+        )
+        self.older = create_inspection_records(
+            "24111",
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Compliant",
+            "nan",
+            datetime(2020, 10, 21, 12, 30, 30),
+        )
+        self.newer = create_inspection_records(
+            "24112",
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Non-Compliant",
+            "No Seating",
+            datetime(2020, 10, 22, 12, 30, 30),
+        )
+
+    def test_set_latest_inspection_ignores_older_records(self):
+        self.assertTrue(self.restaurant.set_latest_inspection(self.newer))
+        self.assertFalse(self.restaurant.set_latest_inspection(self.older))
+        restaurant = Restaurant.objects.get(pk=self.restaurant.pk)
+        self.assertEqual(restaurant.latest_inspection, self.newer)
+        self.assertEqual(restaurant.inspected_on, self.newer.inspected_on)
+        self.assertEqual(restaurant.is_roadway_compliant, "Non-Compliant")
+        self.assertEqual(restaurant.compliant_status, "Non-Compliant")
+
+    def test_backfill_latest_inspection(self):
+        call_command("backfill_latest_inspection", stdout=StringIO())
+        restaurant = Restaurant.objects.get(pk=self.restaurant.pk)
+        self.assertEqual(restaurant.latest_inspection, self.newer)
+        self.assertEqual(
+            get_restaurant_latest_inspection(restaurant),
+            get_latest_inspection_record(
+                "Tacos El Paisa", "1548 St. Nicholas", "10040"
+            ),
+        )
+
+
+class FakeYelpHandler(BaseHTTPRequestHandler):
+    businesses = {
+        "Tacos El Paisa": {
+            "id": "tacos-el-paisa",
+            "price": "$",
+            "rating": 4.5,
+            "image_url": "https://example.com/tacos.jpg",
+            "coordinates": {"latitude": 40.85, "longitude": -73.93},
+            "location": {"zip_code": "10040"},
+            "categories": [{"alias": "mexican"}],
+        },
+        "Gary Danko": {
+            "id": "gary-danko",
+            "rating": 4.0,
+            "coordinates": {"latitude": 40.75, "longitude": -73.99},
+            "location": {"zip_code": "10040"},
+            "categories": [{"alias": "newamerican"}, {"alias": "mexican"}],
+        },
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith("/matches"):
+            name = parse_qs(url.query)["name"][0]
+            matched = [self.businesses[name]] if name in self.businesses else []
+            body = {"businesses": [{"id": b["id"]} for b in matched]}
+        else:
+            business_id = url.path.rstrip("/").split("/")[-1]
+            body = next(b for b in self.businesses.values() if b["id"] == business_id)
+        content = json.dumps(body).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class YelpEnrichmentTests(TestCase):
+    """ Test the concurrent Yelp enrichment stage against a fake Yelp server """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeYelpHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        api = "http://127.0.0.1:%d/businesses/" % cls.server.server_port
+        cls.yelp_settings = override_settings(
+            YELP_BUSINESS_API=api, YELP_BUSINESS_MATCH_API=api + "matches"
+        )
+        cls.yelp_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.yelp_settings.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        Zipcodes.objects.create(
+            zipcode="10040", borough="Manhattan", neighborhood="Washington Heights"
+        )
+        Categories.objects.create(category="mexican", parent_category="mexican")
+        Categories.objects.create(category="newamerican", parent_category="newamerican")
+        reset_reference_tables()
+
+    def test_enrich_restaurants(self):
+        keys = [
+            ("Tacos El Paisa", "1548 St. Nicholas, Manhattan, NY", "10040"),
+            ("Gary Danko", "800 N Point St, Manhattan, NY", "10040"),
+            ("Unknown Place", "1 Nowhere, Manhattan, NY", "10040"),
+        ]
+        enriched = enrich_restaurants(keys, max_workers=3, requests_per_second=100)
+        self.assertEqual(enriched[keys[0]][0], "tacos-el-paisa")
+        self.assertEqual(enriched[keys[1]][0], "gary-danko")
+        self.assertEqual(enriched[keys[2]], (None, None))
+
+        details = save_yelp_restaurant_details_bulk(enriched)
+        self.assertEqual(set(details), {"tacos-el-paisa", "gary-danko"})
+        tacos = YelpRestaurantDetails.objects.get(business_id="tacos-el-paisa")
+        self.assertEqual(tacos.neighborhood, "Washington Heights")
+        self.assertEqual(tacos.price, "$")
+        self.assertEqual(tacos.rating, 4.5)
+        self.assertEqual(
+            set(details["gary-danko"].category.values_list("category", flat=True)),
+            {"newamerican", "mexican"},
+        )
+
+    def test_reference_tables_are_loaded_once(self):
+        self.assertEqual(get_neighbourhood("10040"), "Washington Heights")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_neighbourhood("10040"), "Washington Heights")
+            self.assertIsNone(get_neighbourhood("99999"))
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    @mock.patch("yelprestaurantdetails.query_yelp")
+    def test_save_details_takes_constant_queries(self, mock_query_yelp):
+        tacos, gary = (
+            {"info": FakeYelpHandler.businesses[name]}
+            for name in ("Tacos El Paisa", "Gary Danko")
+        )
+        mock_query_yelp.return_value = tacos
+        save_yelp_restaurant_details("tacos-el-paisa")
+
+        mock_query_yelp.return_value = gary
+        with self.assertNumQueries(4):
+            details = save_yelp_restaurant_details("gary-danko")
+        self.assertEqual(details.category.count(), 2)
+
+    def test_refresh_yelp_details_writes_changes(self):
+        tacos = create_yelp_restaurant_details(
+            "tacos-el-paisa", "Inwood", "$$", 3.0, None, 40.85, -73.93
+        )
+        gary = create_yelp_restaurant_details(
+            "gary-danko", "Washington Heights", None, 4.0, None, 40.75, -73.99
+        )
+        gary.category.add("newamerican", "mexican")
+        now = datetime(2020, 11, 1, 12)
+
+        stats = refresh_yelp_details(now=now)
+        self.assertEqual(stats, {"refreshed": 2, "changed": 1, "failed": 0})
+        tacos.refresh_from_db()
+        self.assertEqual(tacos.rating, 4.5)
+        self.assertEqual(tacos.price, "$")
+        self.assertEqual(tacos.neighborhood_key, "washington heights")
+        self.assertEqual(tacos.last_refreshed, now)
+        self.assertEqual(
+            list(tacos.category.values_list("category", flat=True)), ["mexican"]
+        )
+        gary.refresh_from_db()
+        self.assertEqual(gary.last_refreshed, now)
+
+        # Nothing is stale until YELP_DETAILS_MAX_AGE has passed
+        self.assertEqual(refresh_yelp_details(now=now)["refreshed"], 0)
+
+    @override_settings(YELP_DAILY_BUDGET=1)
+    def test_refresh_follows_priority_and_budget(self):
+        now = datetime(2020, 11, 1, 12)
+        for business_id in ("gary-danko", "tacos-el-paisa"):
+            create_yelp_restaurant_details(
+                business_id, None, None, 1.0, None, 40.0, -73.0
+            )
+        record_profile_view("tacos-el-paisa")
+
+        self.assertEqual(refresh_yelp_details(now=now)["refreshed"], 1)
+        self.assertEqual(refresh_yelp_details(now=now)["refreshed"], 0)
+        refreshed = YelpRestaurantDetails.objects.filter(last_refreshed=now)
+        self.assertEqual(
+            list(refreshed.values_list("business_id", "profile_views")),
+            [("tacos-el-paisa", 1)],
+        )
+
+    def test_unmatched_restaurants_are_backed_off(self):
+        create_restaurant(
+            "Tacos El Paisa", "1548 St. Nicholas, Manhattan, NY", None, "10040", None
+        )
+        create_restaurant(
+            "Unknown Place", "1 Nowhere, Manhattan, NY", None, "10040", None
+        )
+        now = datetime(2020, 11, 1, 12)
+
+        linked = enrich_unmatched_restaurants(now=now)
+        self.assertEqual([r.business_id for r in linked], ["tacos-el-paisa"])
+        unknown = Restaurant.objects.get(restaurant_name="Unknown Place")
+        self.assertEqual(unknown.yelp_match_attempts, 1)
+        self.assertEqual(unknown.yelp_match_retry_on, now + timedelta(days=1))
+
+        with mock.patch("yelprestaurantdetails.enrich_restaurants") as enrich:
+            self.assertEqual(enrich_unmatched_restaurants(now=now), [])
+            enrich.assert_not_called()
+
+        later = now + timedelta(days=1)
+        self.assertEqual(enrich_unmatched_restaurants(now=later), [])
+        unknown.refresh_from_db()
+        self.assertEqual(unknown.yelp_match_attempts, 2)
+        self.assertEqual(unknown.yelp_match_retry_on, later + timedelta(days=2))
+
+    @override_settings(YELP_DAILY_BUDGET=5)
+    def test_reserve_yelp_calls_stays_within_budget(self):
+        self.assertEqual(reserve_yelp_calls(2, calls_per_item=2), 2)
+        self.assertEqual(reserve_yelp_calls(3, calls_per_item=2), 0)
+        self.assertEqual(reserve_yelp_calls(3), 1)
+        self.assertEqual(reserve_yelp_calls(1), 0)
+
+    @override_settings(YELP_DAILY_BUDGET=5)
+    def test_concurrent_reservations_share_the_budget(self):
+        read_budget = YelpCallBudget.objects.get
+        racing, raced = [4], []
+
+        def read_then_race(**kwargs):
+            budget = read_budget(**kwargs)
+            # Another worker takes calls between this read and the update
+            if racing:
+                raced.append(reserve_yelp_calls(racing.pop()))
+            return budget
+
+        with mock.patch.object(
+            YelpCallBudget.objects, "get", side_effect=read_then_race
+        ):
+            self.assertEqual(reserve_yelp_calls(3), 1)
+        self.assertEqual(raced, [4])
+        self.assertEqual(YelpCallBudget.objects.get().used, 5)
+
+    def test_parse_yelp_categories(self):
+        parents = parse_yelp_categories(
+            [
+                {"alias": "mexican", "parent_aliases": ["restaurants"]},
+                {"alias": "tacos", "parent_aliases": ["mexican"]},
+                {"alias": "restaurants", "parent_aliases": []},
+            ]
+        )
+        self.assertEqual(
+            parents, {"mexican": "mexican", "tacos": "mexican", "restaurants": None}
+        )
+
+    def test_sync_categories(self):
+        parents = {"mexican": "mexican", "tacos": "Mexican", "thai": "thai"}
+        stats = sync_categories(parents)
+        self.assertEqual(stats, {"created": 2, "updated": 0, "deleted": 1})
+        self.assertFalse(Categories.objects.filter(category="newamerican").exists())
+        tacos = Categories.objects.get(category="tacos")
+        self.assertEqual(tacos.parent_category_key, "mexican")
+
+        with self.assertNumQueries(3):
+            stats = sync_categories(parents)
+        self.assertEqual(stats, {"created": 0, "updated": 0, "deleted": 0})
+
+        stats = sync_categories(dict(parents, thai="asian"))
+        self.assertEqual(stats, {"created": 0, "updated": 1, "deleted": 0})
+        self.assertEqual(
+            Categories.objects.get(category="thai").parent_category_key, "asian"
+        )
+
+    def test_rate_limiter_spaces_calls(self):
+        limiter = RateLimiter(50)
+        started = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+class CovidDataCacheTests(TestCase):
+    """ Test the cached COVID positivity data used on the profile page """
+
+    def setUp(self):
+        cache.clear()
+        self.csv_file = pd.DataFrame(
+            {
+                "modzcta": [99999, 10040, 10001],
+                "modzcta_name": ["Citywide", "Washington Heights", "Chelsea"],
+                "percentpositivity_7day": [2.5, 1.2, 0.8],
+                "people_tested": [1000, 100, 200],
+                "people_positive": [25, 1, 2],
+                "median_daily_test_rate": [5.0, 4.0, 3.0],
+                "adequately_tested": ["Yes", "Yes", "No"],
+            }
+        )
+
+    @mock.patch("restaurant.utils.get_csv_from_github")
+    def test_get_covid_data_downloads_once(self, mock_csv):
+        mock_csv.return_value = self.csv_file
+        data = json.loads(get_covid_data())
+        get_covid_data()
+        self.assertEqual(mock_csv.call_count, 1)
+        self.assertEqual(
+            data,
+            {
+                "10040": ["Washington Heights", 1.2, 100, 1, 4.0, "Yes"],
+                "10001": ["Chelsea", 0.8, 200, 2, 3.0, "No"],
+            },
+        )
+
+    @mock.patch("restaurant.utils.get_csv_from_github")
+    def test_failed_refresh_keeps_last_good_copy(self, mock_csv):
+        mock_csv.return_value = self.csv_file
+        good = refresh_covid_data()
+        cache.delete(COVID_DATA_CACHE_KEY)
+
+        mock_csv.side_effect = ConnectionError("GitHub is down")
+        self.assertIsNone(refresh_covid_data())
+        self.assertEqual(get_covid_data(), good)
+
+
+class SynchronousExecutor:
+    def submit(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+
+@mock.patch("restaurant.utils.get_restaurant_reviews_yelp")
+@mock.patch("restaurant.utils.get_restaurant_info_yelp")
+class YelpCacheTests(TestCase):
+    """ Test the Yelp response cache """
+
+    business_id = "WavvLdfdP6g8aZTtbBQHTw"
+
+    def setUp(self):
+        cache.clear()
+        response_cache().clear()
+
+    def test_query_yelp_is_cached(self, mock_info, mock_reviews):
+        mock_info.return_value = MockResponse(json.dumps({"id": "1"}), 200)
+        mock_reviews.return_value = MockResponse(json.dumps({"reviews": []}), 200)
+        first = query_yelp(self.business_id)
+        second = query_yelp(self.business_id)
+        self.assertEqual(first, second)
+        self.assertEqual(mock_info.call_count, 1)
+        self.assertEqual(mock_reviews.call_count, 1)
+
+    def test_missing_business_is_negatively_cached(self, mock_info, mock_reviews):
+        mock_info.return_value = MockResponse(json.dumps({"error": {}}), 404)
+        mock_reviews.return_value = MockResponse(json.dumps({"error": {}}), 404)
+        query_yelp(self.business_id)
+        query_yelp(self.business_id)
+        self.assertEqual(mock_info.call_count, 1)
+
+    def test_server_errors_are_not_cached(self, mock_info, mock_reviews):
+        mock_info.return_value = MockResponse(json.dumps({"error": {}}), 503)
+        mock_reviews.return_value = MockResponse(json.dumps({"reviews": []}), 200)
+        query_yelp(self.business_id)
+        query_yelp(self.business_id)
+        self.assertEqual(mock_info.call_count, 2)
+        self.assertEqual(mock_reviews.call_count, 1)
+
+    def test_misses_are_fetched_concurrently(self, mock_info, mock_reviews):
+        # Each call waits for the other one to be in flight
+        barrier = threading.Barrier(2, timeout=5)
+
+        def respond(content):
+            barrier.wait()
+            return MockResponse(json.dumps(content), 200)
+
+        mock_info.side_effect = lambda business_id, client: respond({"id": business_id})
+        mock_reviews.side_effect = lambda business_id, client: respond({"reviews": []})
+        data = query_yelp(self.business_id)
+        self.assertEqual(data["info"]["id"], self.business_id)
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    @mock.patch("restaurant.utils.YELP_REFRESH_EXECUTOR", SynchronousExecutor())
+    def test_stale_entries_are_served_while_revalidating(self, mock_info, mock_reviews):
+        mock_info.return_value = MockResponse(json.dumps({"rating": 3}), 200)
+        mock_reviews.return_value = MockResponse(json.dumps({"reviews": []}), 200)
+        query_yelp(self.business_id)
+
+        key = yelp_cache_key("info", self.business_id)
+        entry = response_cache().get(key)
+        entry["expires_at"] = 0
+        response_cache().set(key, entry)
+        mock_info.return_value = MockResponse(json.dumps({"rating": 5}), 200)
+
+        self.assertEqual(query_yelp(self.business_id)["info"]["rating"], 3)
+        self.assertEqual(query_yelp(self.business_id)["info"]["rating"], 5)
+        self.assertEqual(mock_info.call_count, 2)
+
+    @override_settings(
+        CACHES={
+            alias: dict(options, OPTIONS={"MAX_ENTRIES": 2})
+            for alias, options in LOCMEM_CACHES.items()
+        }
+    )
+    def test_responses_do_not_cull_default_entries(self, mock_info, mock_reviews):
+        mock_info.return_value = MockResponse(json.dumps({"rating": 3}), 200)
+        mock_reviews.return_value = MockResponse(json.dumps({"reviews": []}), 200)
+        cache.set(COVID_DATA_FALLBACK_KEY, "{}", None)
+        for business_id in ("a", "b", "c"):
+            query_yelp(business_id)
+        self.assertEqual(cache.get(COVID_DATA_FALLBACK_KEY), "{}")
+
+
+class TopCompliantRestaurantTests(TestCase):
+    """ Test the materialized top compliant list """
+
+    def create_compliant_restaurant(self, i, rating, status="Compliant"):
+        business_id = "business_{}".format(i)
+        details = create_yelp_restaurant_details(
+            business_id, "Upper East Side", "$$", rating, None, 40.85, -73.82
+        )
+        restaurant = create_restaurant(
+            "Restaurant {}".format(i), "address", details, "10040", business_id
+        )
+        record = create_inspection_records(
+            "record_{}".format(i),
+            "Restaurant {}".format(i),
+            "10040",
+            "address",
+            status,
+            "nan",
+            datetime(2020, 10, 21, 12, 30) + timedelta(days=i),
+            business_id,
+        )
+        restaurant.set_latest_inspection(record)
+        return restaurant
+
+    def top_ids(self):
+        return list(
+            TopCompliantRestaurant.objects.order_by("rank").values_list(
+                "restaurant_id", flat=True
+            )
+        )
+
+    def setUp(self):
+        self.restaurants = [
+            self.create_compliant_restaurant(i, rating)
+            for i, rating in enumerate([5.0, 4.5, 4.0, 3.5])
+        ]
+        self.create_compliant_restaurant(4, 5.0, status="Non-Compliant")
+        self.create_compliant_restaurant(5, 2.5)
+
+    def test_full_rebuild(self):
+        self.assertTrue(refresh_top_compliant_restaurants(limit=3))
+        self.assertEqual(self.top_ids(), [r.id for r in self.restaurants[:3]])
+        self.assertFalse(refresh_top_compliant_restaurants(limit=3))
+
+    def test_incremental_refresh_promotes_changed_restaurant(self):
+        refresh_top_compliant_restaurants(limit=3)
+        promoted = self.restaurants[3]
+        YelpRestaurantDetails.objects.filter(pk=promoted.business_id).update(rating=4.8)
+        self.assertTrue(refresh_top_compliant_restaurants([promoted.id], limit=3))
+        self.assertEqual(
+            self.top_ids(),
+            [self.restaurants[0].id, promoted.id, self.restaurants[1].id],
+        )
+
+    def test_incremental_refresh_rebuilds_when_entry_drops_out(self):
+        refresh_top_compliant_restaurants(limit=3)
+        dropped = self.restaurants[0]
+        record = create_inspection_records(
+            "record_dropped",
+            dropped.restaurant_name,
+            "10040",
+            "address",
+            "Non-Compliant",
+            "No Seating",
+            datetime(2021, 1, 1),
+            dropped.business_id,
+        )
+        dropped.set_latest_inspection(record)
+        self.assertTrue(refresh_top_compliant_restaurants([dropped.id], limit=3))
+        self.assertEqual(self.top_ids(), [r.id for r in self.restaurants[1:]])
+
+    def test_incremental_refresh_rebuilds_when_entry_moves_down(self):
+        refresh_top_compliant_restaurants(limit=3)
+        demoted = self.restaurants[0]
+        YelpRestaurantDetails.objects.filter(pk=demoted.business_id).update(rating=3.0)
+        self.assertTrue(refresh_top_compliant_restaurants([demoted.id], limit=3))
+        self.assertEqual(self.top_ids(), [r.id for r in self.restaurants[1:]])
+
+    def test_get_top_compliant_restaurant_list(self):
+        restaurant_list = get_top_compliant_restaurant_list(3)
+        self.assertEqual(
+            [r["id"] for r in restaurant_list],
+            [r.id for r in self.restaurants[:3]],
+        )
+        self.assertEqual(TopCompliantRestaurant.objects.count(), 3)
+        with self.assertNumQueries(4):
+            get_top_compliant_restaurant_list(3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RecommendationSamplerTests(TestCase):
+    """ Test the chatbot recommendation sampler """
+
+    places = [
+        # name, neighborhood, category, rating, compliant status
+        ("Tacos", "Inwood", "tacos", 4.0, "Compliant"),
+        ("Burritos", "Inwood", "tacos", 3.0, "Compliant"),
+        ("Pizza", "Inwood", "pizza", 5.0, "Compliant"),
+        ("Pasta", "Chelsea", "pizza", 4.5, "Compliant"),
+        ("Closed", "Inwood", "tacos", 5.0, "Non-Compliant"),
+        ("Poor", "Inwood", "tacos", 2.5, "Compliant"),
+    ]
+
+    def setUp(self):
+        cache.clear()
+        response_cache().clear()
+        Categories.objects.create(category="tacos", parent_category="Mexican")
+        Categories.objects.create(category="pizza", parent_category="Italian")
+        self.ids = {}
+        for name, neighborhood, category, rating, status in self.places:
+            details = create_yelp_restaurant_details(
+                name, neighborhood, "$$", rating, None, 40.85, -73.93
+            )
+            details.category.add(category)
+            restaurant = create_restaurant(name, "address", details, "10034", name)
+            Restaurant.objects.filter(pk=restaurant.pk).update(compliant_status=status)
+            self.ids[name] = restaurant.id
+
+    def candidate_names(self, category=None, neighborhood=None):
+        names = {pk: name for name, pk in self.ids.items()}
+        return sorted(
+            names[pk] for pk in recommendation_candidates(category, neighborhood)
+        )
+
+    def test_candidates_come_from_the_buckets(self):
+        refresh_recommendation_buckets()
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                self.candidate_names(), ["Burritos", "Pasta", "Pizza", "Tacos"]
+            )
+            self.assertEqual(
+                self.candidate_names(["mexican"], ["Inwood"]), ["Burritos", "Tacos"]
+            )
+            self.assertEqual(
+                self.candidate_names(["Mexican", "Italian"], ["inwood"]),
+                ["Burritos", "Pizza", "Tacos"],
+            )
+            self.assertEqual(self.candidate_names(None, ["Chelsea"]), ["Pasta"])
+            self.assertEqual(self.candidate_names(["Mexican"], ["Chelsea"]), [])
+
+    def test_buckets_are_built_on_demand(self):
+        self.assertEqual(self.candidate_names(["Italian"]), ["Pasta", "Pizza"])
+
+    def test_sample_recommendations(self):
+        for weight_by_rating in (False, True):
+            restaurants = sample_recommendations(
+                ["Mexican", "Italian"], ["Inwood"], 2, weight_by_rating
+            )
+            self.assertEqual(len(restaurants), 2)
+            self.assertEqual(len({r["id"] for r in restaurants}), 2)
+            for restaurant in restaurants:
+                self.assertIn(
+                    restaurant["restaurant_name"], ["Tacos", "Burritos", "Pizza"]
+                )
+                self.assertIn("yelp_info", restaurant)
+                self.assertIn("latest_record", restaurant)
+
+        self.assertEqual(len(sample_recommendations(["Italian"], None, 3)), 2)
+
+    def test_chatbot_keyword_recommends_three(self):
+        response = self.client.post(
+            reverse("restaurant:chatbottest"),
+            json.dumps(
+                {"category": [], "location": ["Inwood"], "is_preference": False}
+            ),
+            content_type="application/json",
+        )
+        restaurants = response.json()["restaurants"]
+        self.assertEqual(len(restaurants), 3)
+        self.assertTrue(
+            {r["restaurant_name"] for r in restaurants}
+            <= {"Tacos", "Burritos", "Pizza"}
+        )
+
+
+class RecommendationEngineTests(TestCase):
+    """ Test the precomputed per user recommendation lists """
+
+    places = [
+        # name, neighborhood, category, rating, compliant status
+        ("Tacos", "Inwood", "tacos", 3.0, "Compliant"),
+        ("Burritos", "Chelsea", "tacos", 3.5, "Compliant"),
+        ("Pizza", "Inwood", "pizza", 4.0, "Compliant"),
+        ("Sushi", "Chelsea", "sushi", 5.0, "Compliant"),
+        ("Ramen", "Chelsea", "sushi", 4.5, "Compliant"),
+        ("Closed", "Inwood", "tacos", 5.0, "Non-Compliant"),
+        ("Poor", "Inwood", "tacos", 2.5, "Compliant"),
+    ]
+
+    def setUp(self):
+        for category, parent in [
+            ("tacos", "Mexican"),
+            ("pizza", "Italian"),
+            ("sushi", "Japanese"),
+        ]:
+            Categories.objects.create(category=category, parent_category=parent)
+        self.restaurants = {}
+        for name, neighborhood, category, rating, status in self.places:
+            details = create_yelp_restaurant_details(
+                name, neighborhood, "$$", rating, None, 40.85, -73.93
+            )
+            details.category.add(category)
+            restaurant = create_restaurant(name, "address", details, "10034", name)
+            Restaurant.objects.filter(pk=restaurant.pk).update(compliant_status=status)
+            self.restaurants[name] = restaurant
+        self.user = get_user_model().objects.create(username="myuser")
+
+    def recommended_names(self):
+        return [
+            r.restaurant.restaurant_name
+            for r in recommended_restaurants(self.user)
+            .select_related("restaurant")
+            .order_by("rank")
+        ]
+
+    def test_without_history_the_best_rated_come_first(self):
+        self.assertEqual(
+            self.recommended_names(), ["Sushi", "Ramen", "Pizza", "Burritos", "Tacos"]
+        )
+
+    def test_preferences_favorites_and_questionnaires_are_scored(self):
+        self.user.preferences.add("tacos")
+        self.assertEqual(
+            self.recommended_names()[:2], ["Burritos", "Tacos"], "preferred first"
+        )
+
+        # A saved pizza place makes Inwood and Italian food relevant
+        self.user.favorite_restaurants.add(self.restaurants["Pizza"])
+        self.assertEqual(self.recommended_names(), ["Tacos", "Pizza", "Burritos"])
+
+        # Rating a restaurant unsafe removes it; rating one safe adds its kind
+        UserQuestionnaire.objects.create(
+            restaurant_business_id="Tacos", user_id=str(self.user.pk), safety_level=1
+        )
+        UserQuestionnaire.objects.create(
+            restaurant_business_id="Ramen", user_id=str(self.user.pk), safety_level=5
+        )
+        self.assertEqual(
+            self.recommended_names(), ["Burritos", "Sushi", "Ramen", "Pizza"]
+        )
+
+    def test_lists_are_only_rebuilt_when_they_change(self):
+        recommended_restaurants(self.user)
+        self.assertFalse(refresh_user_recommendations(self.user))
+        Restaurant.objects.filter(pk=self.restaurants["Sushi"].pk).update(
+            compliant_status="Non-Compliant"
+        )
+        self.assertEqual(refresh_all_recommendations(), 1)
+        self.assertNotIn("Sushi", self.recommended_names())
+
+    def test_changes_mark_the_list_stale(self):
+        recommended_restaurants(self.user)
+        with mock.patch("restaurant.recommendation.score_restaurants") as score:
+            self.user.favorite_restaurants.add(self.restaurants["Pizza"])
+            UserQuestionnaire.objects.create(
+                restaurant_business_id="Tacos",
+                user_id=str(self.user.pk),
+                safety_level=1,
+            )
+            score.assert_not_called()
+        self.assertIn(
+            self.restaurants["Tacos"].id,
+            self.user.recommendations.values_list("restaurant_id", flat=True),
+        )
+        self.assertEqual(refresh_stale_recommendations(), 1)
+        self.assertNotIn(
+            self.restaurants["Tacos"].id,
+            self.user.recommendations.values_list("restaurant_id", flat=True),
+        )
+        self.assertEqual(refresh_stale_recommendations(), 0)
+
+    def test_recommended_sort_reads_the_list(self):
+        recommended_restaurants(self.user)
+        first = search_restaurants(limit=2, sort_option="recommended", user=self.user)
+        self.assertEqual(
+            [r["restaurant_name"] for r in first["restaurants"]], ["Sushi", "Ramen"]
+        )
+        self.assertEqual(first["total"], 5)
+        second = search_restaurants(
+            limit=2,
+            sort_option="recommended",
+            user=self.user,
+            cursor=first["next_cursor"],
+        )
+        self.assertEqual(
+            [r["restaurant_name"] for r in second["restaurants"]],
+            ["Pizza", "Burritos"],
+        )
+        inwood = search_restaurants(
+            neighbourhoods_filter=["Inwood"], sort_option="recommended", user=self.user
+        )
+        self.assertEqual(
+            [r["restaurant_name"] for r in inwood["restaurants"]], ["Pizza", "Tacos"]
+        )
+
+    def test_chatbot_recommends_from_the_user_list(self):
+        self.user.preferences.add("tacos")
+        self.user.favorite_restaurants.add(self.restaurants["Pizza"])
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("restaurant:chatbottest"),
+            json.dumps({"category": [], "location": ["Inwood"], "is_preference": True}),
+            content_type="application/json",
+        )
+        self.assertEqual(
+            sorted(r["restaurant_name"] for r in response.json()["restaurants"]),
+            ["Pizza", "Tacos"],
+        )
+
+
+class RestaurantSearchTests(TestCase):
+    """ Test the restaurant search index and normalized filters """
+
+    def setUp(self):
+        cat = Categories.objects.create(category="wine_bar", parent_category="Bars")
+        self.restaurants = {}
+        for i, name in enumerate(
+            ["Harbor House", "Golden Harbor Seafood Restaurant", "Lucky Noodle"]
+        ):
+            business_id = "business_{}".format(i)
+            details = create_yelp_restaurant_details(
+                business_id, "Upper East Side", "$$", 4.0, None, 40.85, -73.82
+            )
+            details.category.add(cat)
+            self.restaurants[name] = create_restaurant(
+                name, "address", details, "10040", business_id
+            )
+
+    def search(self, keyword, **kwargs):
+        return [
+            r.restaurant_name
+            for r in get_filtered_restaurants(keyword=keyword, limit=6, **kwargs)
+        ]
+
+    def test_backend_follows_database_vendor(self):
+        self.addCleanup(get_search_backend.cache_clear)
+        for vendor, backend in [
+            ("sqlite", SQLiteSearchBackend),
+            ("postgresql", DatabaseSearchBackend),
+        ]:
+            get_search_backend.cache_clear()
+            with mock.patch("restaurant.search.connection") as connection:
+                connection.vendor = vendor
+                self.assertIs(type(get_search_backend()), backend)
+
+    def test_keyword_search_is_ranked(self):
+        self.assertEqual(
+            self.search("harbor"), ["Harbor House", "Golden Harbor Seafood Restaurant"]
+        )
+        self.assertEqual(self.search("ARBO"), self.search("harbor"))
+        self.assertEqual(self.search("pizza"), [])
+
+    def test_short_keyword_falls_back_to_substring_match(self):
+        self.assertEqual(
+            sorted(self.search("oo")),
+            ["Golden Harbor Seafood Restaurant", "Lucky Noodle"],
+        )
+
+    def test_index_follows_restaurant_changes(self):
+        restaurant = self.restaurants["Lucky Noodle"]
+        restaurant.restaurant_name = "Lucky Dumpling"
+        restaurant.save()
+        self.assertEqual(self.search("noodle"), [])
+        self.assertEqual(self.search("dumpling"), ["Lucky Dumpling"])
+        restaurant.delete()
+        self.assertEqual(self.search("dumpling"), [])
+
+    def test_rebuild_search_index(self):
+        Restaurant.objects.filter(restaurant_name="Lucky Noodle").update(
+            restaurant_name="Lucky Dumpling"
+        )
+        self.assertEqual(self.search("dumpling"), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.search("dumpling"), ["Lucky Dumpling"])
+
+    def test_database_backend_matches_index(self):
+        restaurants = Restaurant.objects.all()
+        self.assertEqual(
+            set(DatabaseSearchBackend().filter(restaurants, "harbor")),
+            set(get_search_backend().filter(restaurants, "harbor")),
+        )
+
+    def test_filters_use_normalized_keys(self):
+        self.assertEqual(
+            YelpRestaurantDetails.objects.get(pk="business_0").neighborhood_key,
+            "upper east side",
+        )
+        self.assertEqual(
+            len(
+                get_filtered_restaurants(
+                    neighborhood=["upper EAST side"], category=["bars"], limit=6
+                )
+            ),
+            3,
+        )
+        self.assertEqual(
+            len(get_filtered_restaurants(neighborhood=["Upper West Side"], limit=6)),
+            0,
+        )
+
+
+class GeoIndexTests(TestCase):
+    """ Test the coordinates index and the nearby restaurants endpoint """
+
+    # (name, latitude, longitude, compliant status); Times Square first
+    places = [
+        ("Times Square Diner", 40.7580, -73.9855, "Compliant"),
+        ("Bryant Park Cafe", 40.7536, -73.9832, "Compliant"),
+        ("Herald Square Deli", 40.7497, -73.9877, "Non-Compliant"),
+        ("Union Square Grill", 40.7359, -73.9911, "Compliant"),
+        ("Brooklyn Pizza", 40.6782, -73.9442, "Compliant"),
+    ]
+
+    def setUp(self):
+        for i, (name, lat, lng, status) in enumerate(self.places):
+            business_id = "geo_{}".format(i)
+            details = create_yelp_restaurant_details(
+                business_id, None, "$", 4.0, None, lat, lng
+            )
+            restaurant = create_restaurant(
+                name, "address", details, "10036", business_id
+            )
+            restaurant.compliant_status = status
+            restaurant.save()
+
+    def nearby(self, **params):
+        response = self.client.get(reverse("restaurant:nearby"), params)
+        self.assertEqual(response.status_code, 200)
+        return [r["restaurant_name"] for r in response.json()["restaurants"]]
+
+    def test_backend_follows_database_vendor(self):
+        self.addCleanup(get_geo_backend.cache_clear)
+        for vendor, backend in [
+            ("sqlite", SQLiteGeoBackend),
+            ("postgresql", DatabaseGeoBackend),
+        ]:
+            get_geo_backend.cache_clear()
+            with mock.patch("restaurant.geo.connection") as connection:
+                connection.vendor = vendor
+                self.assertIs(type(get_geo_backend()), backend)
+
+    def test_box_limit_counts_exact_matches_only(self):
+        # A north edge between the rounded down index entry of Times Square
+        # and its real latitude: the index returns it, the box excludes it
+        restaurant = Restaurant.objects.get(restaurant_name="Times Square Diner")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT min_lat FROM {} WHERE id = %s".format(GEO_TABLE),
+                [restaurant.id],
+            )
+            (min_lat,) = cursor.fetchone()
+        north = (min_lat + 40.7580) / 2
+        box = restaurants_in_box(40.70, -74.0, north, -73.98, limit=1)
+        self.assertEqual([r["restaurant_name"] for r in box], ["Bryant Park Cafe"])
+
+    def test_nearest_compliant_restaurants(self):
+        self.assertEqual(
+            self.nearby(lat=40.7580, lng=-73.9855, k=3),
+            ["Times Square Diner", "Bryant Park Cafe", "Union Square Grill"],
+        )
+        # The search widens until it finds enough restaurants
+        self.assertEqual(
+            self.nearby(lat=40.7580, lng=-73.9855, k=10)[-1], "Brooklyn Pizza"
+        )
+
+    def test_restaurants_in_bounding_box(self):
+        self.assertEqual(
+            self.nearby(bbox="40.74,-74.0,40.76,-73.98"),
+            ["Times Square Diner", "Bryant Park Cafe"],
+        )
+
+    def test_invalid_queries(self):
+        url = reverse("restaurant:nearby")
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {"lat": 95, "lng": 0}).status_code, 400)
+        self.assertEqual(
+            self.client.get(url, {"bbox": "40.76,-74.0,40.74,-73.98"}).status_code,
+            400,
+        )
+
+    def test_index_follows_coordinate_changes(self):
+        details = YelpRestaurantDetails.objects.get(business_id="geo_4")
+        details.latitude, details.longitude = 40.7590, -73.9860
+        details.save()
+        self.assertEqual(
+            self.nearby(lat=40.7590, lng=-73.9860, k=1), ["Brooklyn Pizza"]
+        )
+        Restaurant.objects.get(restaurant_name="Brooklyn Pizza").delete()
+        self.assertEqual(
+            self.nearby(lat=40.7580, lng=-73.9855, k=1), ["Times Square Diner"]
+        )
+
+    def test_rebuild_geo_index(self):
+        YelpRestaurantDetails.objects.filter(business_id="geo_4").update(
+            latitude=40.7590, longitude=-73.9860
+        )
+        self.assertEqual(
+            self.nearby(lat=40.7590, lng=-73.9860, k=1), ["Times Square Diner"]
+        )
+        call_command("rebuild_geo_index", stdout=StringIO())
+        self.assertEqual(
+            self.nearby(lat=40.7590, lng=-73.9860, k=1), ["Brooklyn Pizza"]
+        )
+
+    def test_database_backend_matches_index(self):
+        restaurants = located_restaurants()
+        box = (40.74, -74.0, 40.76, -73.98)
+        self.assertEqual(
+            set(DatabaseGeoBackend().within(restaurants, *box)),
+            set(get_geo_backend().within(restaurants, *box)),
+        )
+        self.assertEqual(
+            DatabaseGeoBackend().nearest(restaurants, 40.7580, -73.9855, 4),
+            get_geo_backend().nearest(restaurants, 40.7580, -73.9855, 4),
+        )
+
+
+class RestaurantTileTests(TestCase):
+    """ Test the GeoJSON map tiles """
+
+    places = GeoIndexTests.places
+    setUp = GeoIndexTests.setUp
+
+    def tile(self, z, lat=40.7580, lng=-73.9855, headers=None, **params):
+        x, y = tile_for_point(lat, lng, z)
+        return self.client.get(
+            reverse("restaurant:tile", args=[z, x, y]), params, **(headers or {})
+        )
+
+    def features(self, z, **params):
+        response = self.tile(z, **params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["features"]
+
+    def test_tile_bounds(self):
+        south, west, north, east = tile_bounds(0, 0, 0)
+        self.assertAlmostEqual(north, 85.0511, places=4)
+        self.assertEqual((west, east), (-180, 180))
+        x, y = tile_for_point(40.7580, -73.9855, 16)
+        south, west, north, east = tile_bounds(16, x, y)
+        self.assertTrue(south <= 40.7580 <= north and west <= -73.9855 <= east)
+
+    def test_tile_points(self):
+        features = self.features(16)
+        self.assertEqual(
+            [f["properties"]["name"] for f in features], ["Times Square Diner"]
+        )
+        self.assertEqual(features[0]["geometry"]["coordinates"], [-73.9855, 40.758])
+
+    def test_low_zoom_tiles_are_clustered(self):
+        features = self.features(9)
+        clusters = [f for f in features if f["properties"].get("cluster")]
+        self.assertTrue(clusters)
+        self.assertEqual(
+            sum(f["properties"].get("point_count", 1) for f in features), 5
+        )
+        compliant = self.features(9, All="Compliant")
+        self.assertEqual(
+            sum(f["properties"].get("point_count", 1) for f in compliant), 4
+        )
+        squares = self.features(9, keyword="square")
+        self.assertEqual(sum(f["properties"].get("point_count", 1) for f in squares), 3)
+
+    def test_tile_etag(self):
+        response = self.tile(16)
+        etag = response["ETag"]
+        self.assertEqual(
+            self.tile(16, headers={"HTTP_IF_NONE_MATCH": etag}).status_code, 304
+        )
+
+        restaurant = Restaurant.objects.get(restaurant_name="Times Square Diner")
+        restaurant.restaurant_name = "Times Square Grill"
+        restaurant.save()
+        response = self.tile(16, headers={"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(
+            response.json()["features"][0]["properties"]["name"], "Times Square Grill"
+        )
+
+    def test_invalid_tile(self):
+        response = self.client.get(reverse("restaurant:tile", args=[2, 4, 0]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_browse_map_loads_tiles(self):
+        response = self.client.get(reverse("restaurant:browse"))
+        self.assertContains(response, 'id="browseMap"')
+        self.assertContains(response, reverse("restaurant:tile", args=[0, 0, 0]))
+
+
+class SearchRestaurantsTests(TestCase):
+    """ Test the unified browse search with in-query counts and keyset cursors """
+
+    def setUp(self):
+        ratings = [4.0, 4.5, 4.0, None, 3.0, 4.0, 5.0]
+        for i, rating in enumerate(ratings):
+            business_id = "business_{}".format(i)
+            details = create_yelp_restaurant_details(
+                business_id, "Upper East Side", "$$", rating, None, 40.85, -73.82
+            )
+            create_restaurant(
+                "Restaurant {}".format(i), "address", details, "10040", business_id
+            )
+
+    def test_page_and_total_in_one_query(self):
+        with mock.patch("restaurant.utils.restaurants_to_dict", side_effect=list):
+            with self.assertNumQueries(1):
+                result = search_restaurants(1, 3, sort_option="ratedhigh")
+        self.assertEqual(result["total"], 7)
+        self.assertEqual(len(result["restaurants"]), 3)
+
+    def test_past_the_last_page(self):
+        result = search_restaurants(5, 3, price_filter=["$$"])
+        self.assertEqual(result["restaurants"], [])
+        self.assertEqual(result["total"], 7)
+        self.assertEqual(search_restaurants(1, 3, price_filter=["$"])["total"], 0)
+
+    def test_keyset_pages_match_offset_order(self):
+        for sort_option in ["ratedhigh", "ratedlow", "none"]:
+            expected = [r.id for r in get_filtered_restaurants(sort_option=sort_option)]
+            seen = []
+            result = search_restaurants(1, 2, sort_option=sort_option)
+            while True:
+                seen.extend(r["id"] for r in result["restaurants"])
+                self.assertEqual(result["total"], 7)
+                if not result["next_cursor"]:
+                    break
+                result = search_restaurants(
+                    1, 2, sort_option=sort_option, cursor=result["next_cursor"]
+                )
+            self.assertEqual(seen, expected)
+
+    def test_keyword_results_have_no_cursor(self):
+        result = search_restaurants(1, 2, keyword="restaurant")
+        self.assertEqual(result["total"], 7)
+        self.assertIsNone(result["next_cursor"])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            search_restaurants(1, 2, sort_option="ratedhigh", cursor="not-a-cursor")
+        response = Client().post(
+            "/restaurant/search_filter/restaurants_list/2",
+            {"form_sort": "ratedhigh", "cursor": "not-a-cursor"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_values_must_match_their_fields(self):
+        for values in ([[1], 5], [{"a": 1}, 5], [4.0, "5"], [True, 5], ["4", 5]):
+            with self.assertRaises(ValueError):
+                search_restaurants(
+                    1, 2, sort_option="ratedhigh", cursor=encode_cursor(values)
+                )
+        response = Client().post(
+            "/restaurant/search_filter/restaurants_list/2",
+            {"form_sort": "ratedhigh", "cursor": encode_cursor([[1], 5])},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.content, b"Invalid cursor")
+
+        result = search_restaurants(
+            1, 2, sort_option="ratedhigh", cursor=encode_cursor([None, 3])
+        )
+        self.assertEqual(result["total"], 7)
+
+    def test_invalid_page(self):
+        for page in ("two", "0"):
+            response = Client().post(
+                "/restaurant/search_filter/restaurants_list/" + page,
+                {"form_sort": "ratedhigh"},
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.content, b"Invalid page")
+
+
+class QuestionnaireAggregateTests(TestCase):
+    """ Test the incrementally maintained questionnaire aggregates """
+
+    business_id = "WavvLdfdP6g8aZTtbBQHTw"
+
+    def create_questionnaire(self, safety_level, answer, saved_on):
+        return UserQuestionnaire.objects.create(
+            restaurant_business_id=self.business_id,
+            user_id="1",
+            safety_level=safety_level,
+            saved_on=saved_on,
+            temperature_required=answer,
+            contact_info_required=answer,
+            employee_mask=answer,
+            capacity_compliant=True,
+            distance_compliant=False,
+        )
+
+    def create_inspection(self, inspection_id, inspected_on):
+        return create_inspection_records(
+            inspection_id,
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Compliant",
+            "nan",
+            inspected_on,
+            self.business_id,
+        )
+
+    def aggregate_values(self):
+        return model_to_dict(QuestionnaireAggregate.objects.get(pk=self.business_id))
+
+    def setUp(self):
+        self.create_questionnaire(1, False, datetime(2020, 10, 1))
+        self.create_inspection("24111", datetime(2020, 10, 21))
+        self.create_questionnaire(5, True, datetime(2020, 10, 22))
+        self.create_questionnaire(3, False, datetime(2020, 10, 23))
+        self.latest = self.create_questionnaire(4, True, datetime(2020, 10, 24))
+
+    def test_incremental_updates_match_recomputation(self):
+        incremental = self.aggregate_values()
+        refresh_questionnaire_aggregate(self.business_id)
+        self.assertEqual(incremental, self.aggregate_values())
+        self.assertEqual(incremental["feedback_count"], 4)
+        self.assertEqual(incremental["window_count"], 3)
+        self.assertEqual(incremental["latest_feedback"], self.latest.pk)
+
+    def test_statistics(self):
+        aggregate = get_questionnaire_aggregate(self.business_id)
+        self.assertEqual(aggregate.average_safety_rating(), "3.25")
+        statistics = aggregate.statistics()
+        self.assertEqual(statistics["valuable_avg_safety_rating"], "4.0")
+        self.assertEqual(statistics["temp_check_true"], 2)
+        self.assertEqual(statistics["temp_check_false"], 1)
+        self.assertEqual(statistics["capacity_compliant_true"], 3)
+        self.assertEqual(statistics["distance_compliant_false"], 3)
+
+    def test_new_inspection_resets_window(self):
+        self.create_inspection("24112", datetime(2020, 10, 24))
+        aggregate = get_questionnaire_aggregate(self.business_id)
+        self.assertEqual(aggregate.window_start, datetime(2020, 10, 24))
+        self.assertEqual(aggregate.window_count, 1)
+        self.assertEqual(aggregate.feedback_count, 4)
+        self.assertEqual(aggregate.statistics()["valuable_avg_safety_rating"], "4.0")
+
+    def test_form_save_updates_aggregate(self):
+        form = QuestionnaireForm(
+            {
+                "restaurant_business_id": self.business_id,
+                "user_id": "1",
+                "safety_level": "2",
+                "temperature_required": "true",
+                "contact_info_required": "true",
+                "employee_mask": "true",
+                "capacity_compliant": "true",
+                "distance_compliant": "true",
+            }
+        )
+        self.assertTrue(form.is_valid())
+        questionnaire = form.save()
+        aggregate = get_questionnaire_aggregate(self.business_id)
+        self.assertEqual(aggregate.feedback_count, 5)
+        self.assertEqual(aggregate.window_count, 4)
+        self.assertEqual(aggregate.distance_compliant_true, 1)
+        self.assertEqual(aggregate.latest_feedback, questionnaire)
+
+    def test_profile_reads_one_row(self):
+        get_questionnaire_aggregate(self.business_id)
+        with self.assertNumQueries(1):
+            aggregate = get_questionnaire_aggregate(self.business_id)
+            aggregate.statistics()
+            aggregate.average_safety_rating()
+            self.assertEqual(aggregate.latest_feedback, self.latest)
+
+    def test_business_without_feedback(self):
+        self.assertIsNone(get_average_safety_rating("unknown"))
+        self.assertIsNone(get_latest_feedback(None))
+        self.assertEqual(questionnaire_statistics("unknown")["temp_check_true"], 0)
+
+
+def slow(result, delay):
+    def source(*args):
+        time.sleep(delay)
+        return result
+
+    return source
+
+
+YELP_INFO = {
+    "info": {"id": "16", "name": "Tacos El Paisa", "rating": 4},
+    "reviews": {"reviews": []},
+}
+
+
+class AsyncRestaurantProfileTests(TransactionTestCase):
+    """ Test the concurrent restaurant profile view """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.restaurant = create_restaurant(
+            restaurant_name="Tacos El Paisa",
+            business_address="1548 St. Nicholas",
+            yelp_detail=None,
+            postcode="10040",
+            business_id="16",
+        )
+
+    def get_profile(self, restaurant_id):
+        request = self.factory.get("restaurant:profile")
+        request.user = AnonymousUser()
+        return async_to_sync(get_restaurant_profile_async)(request, restaurant_id)
+
+    def test_sources_run_concurrently(self):
+        with mock.patch("restaurant.views.get_covid_data", slow("{}", 0.3)), mock.patch(
+            "restaurant.views.query_yelp", slow(YELP_INFO, 0.3)
+        ):
+            started = time.perf_counter()
+            response = self.get_profile(self.restaurant.id)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Tacos El Paisa")
+        self.assertLess(elapsed, 0.55)
+
+    @override_settings(PROFILE_SOURCE_TIMEOUTS={})
+    def test_source_without_timeout_setting_uses_default(self):
+        load = async_to_sync(load_profile_source)
+        self.assertEqual(load("unlisted", lambda: 5, fallback=0), 5)
+
+    @override_settings(
+        PROFILE_SOURCE_TIMEOUTS={
+            "covid": 1,
+            "yelp": 0.1,
+            "inspection": 1,
+            "feedback": 1,
+            "saved": 1,
+            "view": 1,
+        }
+    )
+    def test_slow_source_renders_partial_page(self):
+        with mock.patch("restaurant.views.get_covid_data", slow("{}", 0)), mock.patch(
+            "restaurant.views.query_yelp", slow(YELP_INFO, 1)
+        ):
+            started = time.perf_counter()
+            response = self.get_profile(self.restaurant.id)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(elapsed, 0.8)
+        self.assertContains(response, "fake_info")
+
+    @override_settings(
+        PROFILE_SOURCE_TIMEOUTS={
+            "covid": 1,
+            "yelp": 1,
+            "inspection": 0.1,
+            "feedback": 1,
+            "saved": 1,
+            "view": 1,
+        }
+    )
+    def test_slow_database_source_does_not_hold_the_page(self):
+        with mock.patch("restaurant.views.get_covid_data", slow("{}", 0)), mock.patch(
+            "restaurant.views.query_yelp", slow(YELP_INFO, 0)
+        ), mock.patch("restaurant.views.get_restaurant_latest_inspection", slow({}, 1)):
+            started = time.perf_counter()
+            response = self.get_profile(self.restaurant.id)
+            elapsed = time.perf_counter() - started
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(elapsed, 0.8)
+
+    def test_failing_source_renders_partial_page(self):
+        with mock.patch("restaurant.views.get_covid_data", slow("{}", 0)), mock.patch(
+            "restaurant.views.query_yelp", side_effect=ValueError("bad payload")
+        ):
+            response = self.get_profile(self.restaurant.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "fake_info")
+
+    def test_invalid_restaurant(self):
+        response = self.get_profile(-1)
+        self.assertEqual(response.status_code, 404)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    hits = {}
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        hits = self.hits[path] = self.hits.get(path, 0) + 1
+        status, headers = 200, {}
+        if path == "/flaky" and hits < 3:
+            status = 503
+        elif path == "/throttled" and hits < 2:
+            status, headers = 429, {"Retry-After": "0"}
+        elif path == "/broken":
+            status = 500
+        elif path == "/slow":
+            time.sleep(0.5)
+        content = json.dumps(
+            {"authorization": self.headers.get("Authorization")}
+        ).encode("utf8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpClientTests(TestCase):
+    """Test the shared retrying HTTP client against a local server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        FlakyHandler.hits.clear()
+        self.client = HttpClient(backoff=0, retries=3)
+
+    def test_retries_server_errors(self):
+        response = self.client.get(self.url + "/flaky", "test.flaky")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FlakyHandler.hits["/flaky"], 3)
+        metrics = self.client.metrics.snapshot()["test.flaky"]
+        self.assertEqual(metrics["count"], 3)
+        self.assertEqual(metrics["errors"], 2)
+        self.assertEqual(metrics["retries"], 2)
+
+    def test_honours_retry_after(self):
+        response = self.client.get(self.url + "/throttled", "test.throttled")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(FlakyHandler.hits["/throttled"], 2)
+        self.assertEqual(
+            self.client.metrics.snapshot()["test.throttled"]["throttled"], 1
+        )
+
+    def test_metrics_summary_is_logged_and_reset(self):
+        self.client.get(self.url + "/flaky", "test.flaky")
+        with self.assertLogs("restaurant.http_client", "INFO") as logs:
+            self.client.metrics.log_summary()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn(
+            "HTTP test.flaky: 3 requests, 2 errors, 2 retries", logs.output[0]
+        )
+        self.assertEqual(self.client.metrics.snapshot(), {})
+
+    def test_metrics_summary_is_logged_on_interval(self):
+        client = HttpClient(backoff=0, metrics_log_interval=0)
+        with self.assertLogs("restaurant.http_client", "INFO") as logs:
+            client.get(self.url + "/ok", "test.ok")
+        self.assertIn("HTTP test.ok: 1 requests", logs.output[0])
+        self.assertEqual(client.metrics.snapshot(), {})
+
+    def test_request_client_fails_fast(self):
+        get_request_http_client.cache_clear()
+        self.addCleanup(get_request_http_client.cache_clear)
+        response = get_request_http_client().get(self.url + "/broken", "test.broken")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(FlakyHandler.hits["/broken"], 1)
+
+    def test_returns_last_error_response(self):
+        response = self.client.get(self.url + "/broken", "test.broken")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(FlakyHandler.hits["/broken"], 4)
+
+    def test_default_timeout(self):
+        client = HttpClient(timeout=0.1, retries=1, backoff=0)
+        with self.assertRaises(requests.Timeout):
+            client.get(self.url + "/slow", "test.slow")
+        self.assertEqual(client.metrics.snapshot()["test.slow"]["errors"], 2)
+
+    def test_rate_limits_each_token(self):
+        client = HttpClient(token_rate=50, token_burst=1)
+        started = time.monotonic()
+        for _ in range(4):
+            response = client.get(self.url + "/ok", "test.ok", token="abc")
+        client.get(self.url + "/ok", "test.ok", token="other")
+        self.assertGreaterEqual(time.monotonic() - started, 0.06)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(json.loads(response.content)["authorization"], "Bearer abc")
+        self.assertEqual(set(client.limiters), {"abc", "other"})
+
+
+class StubSocrataClient:
+    """ Serves a fixed list of rows with Socrata $offset/$limit paging """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.requests = []
+
+    def get(self, url, name, params=None, **kwargs):
+        self.requests.append(params)
+        offset, limit = params["$offset"], params["$limit"]
+        page = self.rows[offset : offset + limit]  # noqa: E203
+        return mock.Mock(json=mock.Mock(return_value=page))
+
+
+class FetchInspectionPagesTests(TestCase):
+    """ Test the Socrata paging of the inspection ingestion """
+
+    rows = [{"restaurantinspectionid": str(i)} for i in range(5)]
+
+    def fetch(self, rows, **kwargs):
+        client = StubSocrataClient(rows)
+        pages = list(fetch_inspection_pages(page_size=2, client=client, **kwargs))
+        return pages, [params["$offset"] for params in client.requests], client
+
+    def test_offset_advances_until_a_short_page(self):
+        pages, offsets, _ = self.fetch(self.rows)
+        self.assertEqual(
+            [(offset, len(rows)) for offset, rows in pages], [(2, 2), (4, 2), (5, 1)]
+        )
+        self.assertEqual(offsets, [0, 2, 4])
+        self.assertEqual(
+            [row for _, rows in pages for row in rows], self.rows, "no row twice"
+        )
+
+    def test_stops_on_an_empty_page(self):
+        pages, offsets, _ = self.fetch(self.rows[:4])
+        self.assertEqual([offset for offset, _ in pages], [2, 4])
+        self.assertEqual(offsets, [0, 2, 4])
+
+        pages, offsets, _ = self.fetch([])
+        self.assertEqual((pages, offsets), ([], [0]))
+
+    def test_resumes_from_a_saved_cursor(self):
+        where = "inspectedon >= '2020-10-21T12:30:30.000'"
+        pages, offsets, client = self.fetch(self.rows, offset=3, where=where)
+        self.assertEqual(
+            [(offset, rows) for offset, rows in pages], [(5, self.rows[3:])]
+        )
+        self.assertEqual(offsets, [3, 5])
+        self.assertEqual(client.requests[0]["$where"], where)
+        self.assertEqual(
+            client.requests[0]["$order"], "inspectedon, restaurantinspectionid"
+        )
+
+
+@mock.patch(
+    "getinspection.enrich_restaurants",
+    lambda keys: {key: (None, None) for key in keys},
+)
+class SaveRestaurantsTests(TestCase):
+    """ Test the bulk upsert of an inspections page """
+
+    def setUp(self):
+        self.restaurant = create_restaurant(
+            "Tacos El Paisa", "1548 St. Nicholas", None, "10040", None
+        )
+        record = create_inspection_records(
+            "24111",
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Compliant",
+            "nan",
+            datetime(2020, 10, 21, 12, 30, 30),
+        )
+        self.restaurant.set_latest_inspection(record)
+
+    def save(self, inspection_id, inspected_on, status="Non-Compliant"):
+        row = {
+            "restaurantinspectionid": inspection_id,
+            "restaurantname": "Tacos El Paisa",
+            "businessaddress": "1548 St. Nicholas",
+            "postcode": "10040",
+            "isroadwaycompliant": status,
+            "skippedreason": "nan",
+            "inspectedon": inspected_on,
+        }
+        return save_restaurants(*clean_inspection_data(pd.DataFrame([row])))
+
+    def test_existing_restaurant_gets_newer_inspection(self):
+        stats = self.save("24112", "2020-10-22T12:30:30.000")
+        self.assertEqual(
+            (
+                stats["inspections_created"],
+                stats["restaurants_created"],
+                stats["restaurants_updated"],
+            ),
+            (1, 0, 1),
+        )
+        restaurant = Restaurant.objects.get()
+        self.assertEqual(restaurant.pk, self.restaurant.pk)
+        self.assertEqual(restaurant.latest_inspection_id, "24112")
+        self.assertEqual(restaurant.inspected_on, datetime(2020, 10, 22, 12, 30, 30))
+        self.assertEqual(restaurant.compliant_status, "Non-Compliant")
+
+    def test_older_inspection_keeps_the_pointer(self):
+        stats = self.save("24110", "2020-10-20T12:30:30.000")
+        self.assertEqual(
+            (stats["inspections_created"], stats["restaurants_updated"]), (1, 0)
+        )
+        self.assertEqual(InspectionRecords.objects.count(), 2)
+        restaurant = Restaurant.objects.get()
+        self.assertEqual(restaurant.latest_inspection_id, "24111")
+        self.assertEqual(restaurant.inspected_on, datetime(2020, 10, 21, 12, 30, 30))
+        self.assertEqual(restaurant.compliant_status, "Compliant")
+
+    def test_stored_inspection_is_skipped(self):
+        stats = self.save("24111", "2020-10-21T12:30:30.000")
+        self.assertEqual(
+            (stats["inspections_created"], stats["restaurants_updated"]), (0, 0)
+        )
+        self.assertEqual(InspectionRecords.objects.count(), 1)
+        record = InspectionRecords.objects.get()
+        self.assertEqual(record.is_roadway_compliant, "Compliant")
+        self.assertEqual(Restaurant.objects.get().latest_inspection_id, "24111")
+
+
+class IngestionRunTests(TestCase):
+    """ Test the inspection ingestion ledger """
+
+    stats = {
+        "rows": 10,
+        "inspections_created": 8,
+        "restaurants_created": 2,
+        "restaurants_updated": 5,
+        "seconds": 0.5,
+    }
+
+    def test_first_run_starts_from_scratch(self):
+        run = IngestionRun.start()
+        self.assertIsNone(run.watermark)
+        self.assertEqual(run.cursor, 0)
+        self.assertEqual(run.status, IngestionRun.RUNNING)
+
+    def test_watermark_is_newest_inspection(self):
+        IngestionRun.start().finish()
+        create_inspection_records(
+            "24111",
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Compliant",
+            "nan",
+            datetime(2020, 10, 21, 12, 30, 30),
+        )
+        run = IngestionRun.start()
+        self.assertEqual(run.watermark, datetime(2020, 10, 21, 12, 30, 30))
+        self.assertEqual(run.cursor, 0)
+        self.assertIsNone(run.resumed_from)
+
+    def test_resumes_unfinished_run(self):
+        interrupted = IngestionRun.start()
+        interrupted.watermark = datetime(2020, 10, 1)
+        interrupted.record_page(5000, self.stats)
+        interrupted.record_page(10000, self.stats)
+
+        run = IngestionRun.start()
+        interrupted.refresh_from_db()
+        self.assertEqual(interrupted.status, IngestionRun.FAILED)
+        self.assertEqual(interrupted.error, "Interrupted")
+        self.assertEqual(interrupted.pages, 2)
+        self.assertEqual(interrupted.rows, 20)
+        self.assertEqual(run.resumed_from, interrupted)
+        self.assertEqual(run.watermark, datetime(2020, 10, 1))
+        self.assertEqual(run.cursor, 10000)
+
+    def test_failed_run_is_resumed(self):
+        failed = IngestionRun.start()
+        failed.record_page(5000, self.stats)
+        failed.finish(error=ValueError("bad page"))
+        self.assertEqual(failed.error, "bad page")
+        self.assertEqual(IngestionRun.start().cursor, 5000)
+
+    def test_ingestion_report(self):
+        run = IngestionRun.start()
+        run.record_page(5000, self.stats)
+        run.finish()
+        out = StringIO()
+        call_command("ingestion_report", stdout=out)
+        self.assertIn("completed", out.getvalue())
+        self.assertIn("10 rows in 1 finished runs", out.getvalue())
+
+    def test_resumes_are_capped(self):
+        create_inspection_records(
+            "24111",
+            "Tacos El Paisa",
+            "10040",
+            "1548 St. Nicholas",
+            "Compliant",
+            "nan",
+            datetime(2020, 10, 21, 12, 30, 30),
+        )
+        failed = IngestionRun.start()
+        failed.record_page(5000, self.stats)
+        failed.finish(error=ValueError("bad page"))
+        for resumes in range(1, 4):
+            failed = IngestionRun.start()
+            self.assertEqual((failed.cursor, failed.resumes()), (5000, resumes))
+            failed.finish(error=ValueError("bad page"))
+
+        with self.assertLogs("restaurant.models", "ERROR"):
+            run = IngestionRun.start()
+        self.assertIsNone(run.resumed_from)
+        self.assertEqual(run.cursor, 0)
+        self.assertEqual(run.watermark, datetime(2020, 10, 21, 12, 30, 30))
+
+    @staticmethod
+    def inspection_rows(*days):
+        """Socrata rows of one restaurant, from (id offset, October day) pairs."""
+        return [
+            {
+                "restaurantinspectionid": str(24111 + i),
+                "restaurantname": "Tacos El Paisa",
+                "businessaddress": "1548 St. Nicholas",
+                "postcode": "10040",
+                "isroadwaycompliant": "Compliant",
+                "skippedreason": "nan",
+                "inspectedon": "2020-10-%dT12:30:30.000" % day,
+            }
+            for i, day in days
+        ]
+
+    @mock.patch("getinspection.enrich_restaurants")
+    @mock.patch("getinspection.fetch_inspection_pages")
+    def test_overlapping_pages_are_ingested_once(self, mock_pages, mock_enrich):
+        mock_enrich.side_effect = lambda keys: {key: (None, None) for key in keys}
+        mock_pages.return_value = iter([(2, self.inspection_rows((0, 20), (1, 22)))])
+        ingest_inspections(IngestionRun.start())
+
+        # The inclusive watermark fetches the newest stored inspection again,
+        # along with a new one sharing its timestamp and an older one
+        mock_pages.return_value = iter(
+            [(3, self.inspection_rows((1, 22), (2, 22), (3, 21)))]
+        )
+        run = ingest_inspections(IngestionRun.start())
+        self.assertEqual(
+            mock_pages.call_args[0][0], "inspectedon >= '2020-10-22T12:30:30.000'"
+        )
+        self.assertEqual((run.rows, run.inspections_created), (3, 2))
+        self.assertEqual(InspectionRecords.objects.count(), 4)
+        self.assertEqual(Restaurant.objects.count(), 1)
+        restaurant = Restaurant.objects.get()
+        self.assertEqual(restaurant.latest_inspection_id, "24113")
+        self.assertEqual(restaurant.inspected_on, datetime(2020, 10, 22, 12, 30, 30))
+
+        mock_pages.return_value = iter([(2, self.inspection_rows((2, 22), (1, 22)))])
+        run = ingest_inspections(IngestionRun.start())
+        self.assertEqual(run.inspections_created, 0)
+        restaurant.refresh_from_db()
+        self.assertEqual(restaurant.latest_inspection_id, "24113")
+
+    @mock.patch("getinspection.enrich_restaurants")
+    @mock.patch("getinspection.fetch_inspection_pages")
+    def test_ingest_inspections(self, mock_pages, mock_enrich):
+        rows = self.inspection_rows((0, 20), (1, 21), (2, 22))
+        mock_pages.return_value = iter([(2, rows[:2]), (3, rows[2:])])
+        mock_enrich.side_effect = lambda keys: {key: (None, None) for key in keys}
+
+        run = ingest_inspections(IngestionRun.start())
+        self.assertEqual(run.status, IngestionRun.COMPLETED)
+        self.assertEqual((run.pages, run.cursor, run.rows), (2, 3, 3))
+        self.assertEqual(run.restaurants_created, 1)
+        self.assertEqual(InspectionRecords.objects.count(), 3)
+        restaurant = Restaurant.objects.get(restaurant_name="Tacos El Paisa")
+        self.assertEqual(restaurant.latest_inspection_id, "24113")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class JobTests(TestCase):
+    """ Test the background job runner """
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def job(self, func=None, interval=60):
+        return Job("test", func or (lambda: self.calls.append(1)), interval)
+
+    def test_run_records_duration_and_lag(self):
+        job = self.job()
+        self.assertTrue(job.run(due=time.time() - 5))
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(job.runs, 1)
+        self.assertGreaterEqual(job.last_lag, 5)
+        self.assertIsNotNone(job.last_duration)
+        self.assertIsNotNone(job.last_run())
+        self.assertIsNone(cache.get(job_lock_key("test")))
+
+    def test_run_logs_http_metrics(self):
+        metrics = get_http_client().metrics
+        metrics.snapshot(reset=True)
+        job = self.job(lambda: metrics.record("test.job", 0.01))
+        with self.assertLogs("restaurant.http_client", "INFO") as logs:
+            job.run()
+        self.assertIn("HTTP test.job: 1 requests", logs.output[0])
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_locked_job_is_skipped(self):
+        cache.add(job_lock_key("test"), True)
+        job = self.job()
+        self.assertFalse(job.run())
+        self.assertEqual(self.calls, [])
+        self.assertEqual(job.skipped, 1)
+
+    def test_failure_is_counted_and_unlocks(self):
+        def fail():
+            raise ValueError("boom")
+
+        job = self.job(fail)
+        self.assertTrue(job.run())
+        self.assertEqual((job.runs, job.failures), (1, 1))
+        self.assertIsNone(cache.get(job_lock_key("test")))
+
+    def test_lock_taken_over_after_timeout_is_kept(self):
+        def outlive_lock():
+            # The lock expired and another process took it
+            cache.set(job_lock_key("test"), "other")
+
+        job = self.job(outlive_lock)
+        with self.assertLogs("restaurant.jobs", "WARNING"):
+            self.assertTrue(job.run())
+        self.assertEqual(cache.get(job_lock_key("test")), "other")
+
+    def test_run_pending_follows_interval(self):
+        runner = JobRunner([self.job()], max_workers=1)
+        self.assertEqual(runner.run_pending(now=1000), ["test"])
+        runner.running["test"].result()
+        self.assertEqual(runner.run_pending(now=1030), [])
+        # Runs missed while the clock was down are coalesced into one
+        self.assertEqual(runner.run_pending(now=1200), ["test"])
+        runner.running["test"].result()
+        self.assertEqual(runner.run_pending(now=1230), [])
+        self.assertEqual(runner.run_pending(now=1260), ["test"])
+        runner.running["test"].result()
+        self.assertEqual(len(self.calls), 3)
+
+    def test_running_job_is_not_resubmitted(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        runner = JobRunner([self.job(slow, interval=1)], max_workers=2)
+        runner.run_pending(now=1000)
+        started.wait(5)
+        self.assertEqual(runner.run_pending(now=1010), [])
+        release.set()
+        runner.running["test"].result()
+        self.assertEqual(runner.run_pending(now=1010), ["test"])
+
+    def test_run_jobs_once(self):
+        out = StringIO()
+        with self.settings(JOBS={"noop": {"func": "time.time", "interval": 60}}):
+            call_command("run_jobs", "noop", "--once", stdout=out)
+        self.assertIn("noop", out.getvalue())
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import (
+    Avg,
+    Count,
+    ExpressionWrapper,
+    F,
+    FloatField,
+    IntegerField,
+    Min,
+)
+from django.db.models.functions import Cast
+from django.urls import reverse
+
+from .geo import get_geo_backend
+from .models import Restaurant
+from .utils import build_restaurant_query, response_cache
+
+TILE_VERSION_KEY = "tiles:version"
+
+
+def tile_bounds(z, x, y):
+    """(south, west, north, east) of the Web Mercator tile z/x/y."""
+    n = 2 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return latitude(y + 1), x / n * 360 - 180, latitude(y), (x + 1) / n * 360 - 180
+
+
+def tile_for_point(lat, lng, z):
+    """(x, y) of the zoom z tile containing the point."""
+    n = 2 ** z
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= settings.GEO_TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_version():
+    version = cache.get(TILE_VERSION_KEY)
+    if version is None:
+        cache.add(TILE_VERSION_KEY, 1, None)
+        version = cache.get(TILE_VERSION_KEY, 1)
+    return version
+
+
+def invalidate_tiles():
+    """
+    Retire every cached tile. Called whenever restaurants, their compliance
+    or their Yelp details change; tiles are rebuilt on their next request.
+    """
+    try:
+        cache.incr(TILE_VERSION_KEY)
+    except ValueError:
+        cache.add(TILE_VERSION_KEY, 1, None)
+
+
+def tile_cache_key(z, x, y, filters):
+    digest = hashlib.md5(json.dumps(filters, sort_keys=True).encode("utf8")).hexdigest()
+    return "tiles:{}:{}/{}/{}:{}".format(tile_version(), z, x, y, digest)
+
+
+def point_feature(restaurant):
+    detail = restaurant.yelp_detail
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [float(detail.longitude), float(detail.latitude)],
+        },
+        "properties": {
+            "id": restaurant.id,
+            "name": restaurant.restaurant_name,
+            "address": restaurant.business_address,
+            "compliant_status": restaurant.compliant_status,
+            "rating": detail.rating,
+            "price": detail.price,
+            "url": reverse("restaurant:profile", args=[restaurant.id]),
+        },
+    }
+
+
+def cluster_feature(cell):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [float(cell["lng"]), float(cell["lat"])],
+        },
+        "properties": {"cluster": True, "point_count": cell["count"]},
+    }
+
+
+def cluster_restaurants(restaurants, south, west, north, east):
+    """
+    Group restaurants into a GEO_TILE_CLUSTER_GRID square grid over the tile
+    in SQL. Cells holding one restaurant are returned as that restaurant.
+    """
+    grid = settings.GEO_TILE_CLUSTER_GRID
+
+    def cell(field, low, high):
+        # CAST truncates, which floors the non negative offsets in the tile
+        offset = ExpressionWrapper(
+            (F(field) - low) * (grid / (high - low)), output_field=FloatField()
+        )
+        return Cast(offset, IntegerField())
+
+    cells = list(
+        restaurants.order_by()
+        .annotate(
+            cell_x=cell("yelp_detail__longitude", west, east),
+            cell_y=cell("yelp_detail__latitude", south, north),
+        )
+        .values("cell_x", "cell_y")
+        .annotate(
+            count=Count("id"),
+            lat=Avg("yelp_detail__latitude"),
+            lng=Avg("yelp_detail__longitude"),
+            first_id=Min("id"),
+        )
+    )
+    singles = Restaurant.objects.select_related("yelp_detail").in_bulk(
+        [c["first_id"] for c in cells if c["count"] == 1]
+    )
+    return [
+        point_feature(singles[c["first_id"]]) if c["count"] == 1 else cluster_feature(c)
+        for c in sorted(cells, key=lambda c: c["first_id"])
+    ]
+
+
+def build_tile(z, x, y, filters):
+    """
+    GeoJSON FeatureCollection of the restaurants matching filters, the
+    build_restaurant_query arguments, inside tile z/x/y. Up to
+    GEO_TILE_CLUSTER_MAX_ZOOM nearby restaurants are merged into clusters.
+    """
+    south, west, north, east = tile_bounds(z, x, y)
+    restaurants, _ = build_restaurant_query(**filters)
+    restaurants = get_geo_backend().within(restaurants, south, west, north, east)
+    if z <= settings.GEO_TILE_CLUSTER_MAX_ZOOM:
+        features = cluster_restaurants(restaurants, south, west, north, east)
+    else:
+        features = [
+            point_feature(restaurant)
+            for restaurant in restaurants.select_related("yelp_detail").order_by("id")[
+                : settings.GEO_TILE_MAX_POINTS
+            ]
+        ]
+    return {"type": "FeatureCollection", "features": features}
+
+
+def get_tile(z, x, y, filters):
+    """
+    Return (content, etag) of tile z/x/y, from the cache when it is still
+    current. The ETag is a digest of the content.
+    """
+    key = tile_cache_key(z, x, y, filters)
+    entry = response_cache().get(key)
+    if entry is None:
+        content = json.dumps(build_tile(z, x, y, filters)).encode("utf8")
+        entry = {
+            "content": content,
+            "etag": '"{}"'.format(hashlib.md5(content).hexdigest()),
+        }
+        response_cache().set(key, entry, settings.GEO_TILE_TTL)
+    return entry["content"], entry["etag"]
@@ -4,12 +4,20 @@ from restaurant import views
 
 app_name = "restaurant"
 urlpatterns = [
-    path("profile/<restaurant_id>/", views.get_restaurant_profile, name="profile"),
+    path(
+        "profile/<restaurant_id>/", views.get_restaurant_profile_async, name="profile"
+    ),
     path(
         "inspection_records/<restaurant_id>",
         views.get_inspection_info,
         name="inspection_history",
     ),
+    path("nearby", views.get_nearby_restaurants, name="nearby"),
+    path(
+        "tiles/<int:z>/<int:x>/<int:y>.geojson",
+        views.get_restaurant_tile,
+        name="tile",
+    ),
     path("", views.get_landing_page, name="browse"),
     path("<page>", views.get_landing_page, name="browse"),
     path(
@@ -1,25 +1,53 @@
 from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import (
+    Count,
+    F,
+    IntegerField,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    Window,
+)
 from django.forms.models import model_to_dict
 from .models import (
+    QUESTIONNAIRE_QUESTIONS,
     InspectionRecords,
+    QuestionnaireAggregate,
     Restaurant,
+    TopCompliantRestaurant,
     YelpRestaurantDetails,
     UserQuestionnaire,
 )
-import requests
+from .http_client import get_http_client
+from .recommendation import (
+    RECOMMENDATION_MIN_RATING,
+    recommended_restaurants,
+    user_recommendation_candidates,
+)
+from .search import get_search_backend, normalize_search_key
+from concurrent.futures import ThreadPoolExecutor
+import base64
 import json
 import logging
+import random
 import pandas as pd
 import io
+import time
 
 logger = logging.getLogger(__name__)
 
 
-def get_restaurant_info_yelp(business_id):
-    access_token = settings.YELP_ACCESS_TOKEN_BUSINESS_ID
-    headers = {"Authorization": "bearer %s" % access_token}
+def get_restaurant_info_yelp(business_id, client=None):
+    client = client or get_http_client()
     url = settings.YELP_BUSINESS_API + business_id
-    return requests.get(url, headers=headers)
+    return client.get(
+        url, "yelp.business", token=settings.YELP_ACCESS_TOKEN_BUSINESS_ID
+    )
 
 
 def default_info_page(restaurant_name):
@@ -31,11 +59,7 @@ def default_info_page(restaurant_name):
     }
 
 
-def get_restaurant_info_yelp_local(business_id, restaurant_name):
-    yelp_detail_set = YelpRestaurantDetails.objects.filter(business_id=business_id)[0:1]
-    if yelp_detail_set.count() == 0:
-        return json.loads(get_restaurant_info_yelp(business_id).content)
-    yelp_detail = yelp_detail_set[0]
+def format_yelp_detail(yelp_detail, restaurant_name):
     yelp_dict = model_to_dict(yelp_detail) if yelp_detail else None
     if yelp_dict:
         # Format the info
@@ -55,11 +79,17 @@ def get_restaurant_info_yelp_local(business_id, restaurant_name):
     return yelp_dict
 
 
-def get_restaurant_reviews_yelp(business_id):
-    access_token = settings.YELP_ACCESS_TOKEN_REVIEW
-    headers = {"Authorization": "bearer %s" % access_token}
+def get_restaurant_info_yelp_local(business_id, restaurant_name):
+    yelp_detail_set = YelpRestaurantDetails.objects.filter(business_id=business_id)[0:1]
+    if yelp_detail_set.count() == 0:
+        return json.loads(get_yelp_payloads(business_id, ["info"])["info"].content)
+    return format_yelp_detail(yelp_detail_set[0], restaurant_name)
+
+
+def get_restaurant_reviews_yelp(business_id, client=None):
+    client = client or get_http_client()
     url = settings.YELP_BUSINESS_API + business_id + "/reviews"
-    return requests.get(url, headers=headers)
+    return client.get(url, "yelp.reviews", token=settings.YELP_ACCESS_TOKEN_REVIEW)
 
 
 def merge_yelp_info(restaurant_info, restaurant_reviews):
@@ -75,13 +105,124 @@ def merge_yelp_info(restaurant_info, restaurant_reviews):
     }
 
 
-def query_yelp(business_id):
+class CachedYelpResponse:
+    def __init__(self, content, status_code):
+        self.content = content
+        self.status_code = status_code
+
+
+YELP_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+
+def response_cache():
+    """
+    The cache of the entries that are rebuilt on demand, kept apart from the
+    default cache so that culling them never evicts a lock, see CACHES.
+    """
+    return caches["responses"]
+
+
+def yelp_cache_key(kind, business_id):
+    return "yelp:{}:{}".format(kind, business_id)
+
+
+def fetch_yelp_response(kind, business_id, client=None):
+    if kind == "reviews":
+        return get_restaurant_reviews_yelp(business_id, client)
+    return get_restaurant_info_yelp(business_id, client)
+
+
+def cache_yelp_response(kind, business_id, response):
+    """
+    Cache a Yelp response. 404s are cached for the shorter "missing" TTL;
+    other errors (429, 5xx) are returned but not cached.
+    """
+    if response.status_code == 200:
+        ttl = settings.YELP_CACHE_TTL[kind]
+    elif response.status_code == 404:
+        ttl = settings.YELP_CACHE_TTL["missing"]
+    else:
+        return CachedYelpResponse(response.content, response.status_code)
+
+    entry = {
+        "content": response.content,
+        "status_code": response.status_code,
+        "expires_at": time.time() + ttl,
+    }
+    response_cache().set(
+        yelp_cache_key(kind, business_id), entry, ttl + settings.YELP_CACHE_STALE_TTL
+    )
+    return CachedYelpResponse(entry["content"], entry["status_code"])
+
+
+def revalidate_yelp_response(kind, business_id):
+    # Only one worker refreshes a given entry at a time
+    lock_key = yelp_cache_key(kind, business_id) + ":refreshing"
+    if not cache.add(lock_key, True, 60):
+        return None
+
+    def refresh():
+        try:
+            response = fetch_yelp_response(kind, business_id)
+            cache_yelp_response(kind, business_id, response)
+        except Exception as e:
+            logger.warning(
+                "Error while refreshing Yelp {} for {}: {}".format(kind, business_id, e)
+            )
+        finally:
+            cache.delete(lock_key)
+            connections.close_all()
+
+    return YELP_REFRESH_EXECUTOR.submit(refresh)
+
+
+def get_yelp_payloads(business_id, kinds=("info", "reviews"), client=None):
+    """
+    Return {kind: response} for business_id from the cache. Stale entries are
+    served immediately and refreshed in the background; misses are fetched
+    from Yelp concurrently with client.
+    """
+    entries = response_cache().get_many(
+        [yelp_cache_key(kind, business_id) for kind in kinds]
+    )
+    responses = {}
+    missing = []
+    for kind in kinds:
+        entry = entries.get(yelp_cache_key(kind, business_id))
+        if entry is None:
+            missing.append(kind)
+            continue
+        if entry["expires_at"] < time.time():
+            revalidate_yelp_response(kind, business_id)
+        responses[kind] = CachedYelpResponse(entry["content"], entry["status_code"])
+
+    if len(missing) > 1:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            fetched = dict(
+                zip(
+                    missing,
+                    executor.map(
+                        lambda kind: fetch_yelp_response(kind, business_id, client),
+                        missing,
+                    ),
+                )
+            )
+    else:
+        fetched = {
+            kind: fetch_yelp_response(kind, business_id, client) for kind in missing
+        }
+
+    for kind, response in fetched.items():
+        responses[kind] = cache_yelp_response(kind, business_id, response)
+    return responses
+
+
+def query_yelp(business_id, client=None):
     if not business_id:
         return None
-    restaurant_info = get_restaurant_info_yelp(business_id)
-    restaurant_reviews = get_restaurant_reviews_yelp(business_id)
+    responses = get_yelp_payloads(business_id, client=client)
 
-    data = merge_yelp_info(restaurant_info, restaurant_reviews)
+    data = merge_yelp_info(responses["info"], responses["reviews"])
     return data
 
 
@@ -92,13 +233,69 @@ def get_latest_inspection_record(business_name, business_address, postcode):
         postcode=postcode,
     ).order_by("-inspected_on")
     if len(records) >= 1:
-        record = model_to_dict(records[0])
-        record["inspected_on"] = record["inspected_on"].strftime("%Y-%m-%d %I:%M %p")
-        return record
+        return format_inspection_record(records[0])
 
     return None
 
 
+def format_inspection_record(record):
+    inspection_record = model_to_dict(record)
+    inspection_record["inspected_on"] = inspection_record["inspected_on"].strftime(
+        "%Y-%m-%d %I:%M %p"
+    )
+    return inspection_record
+
+
+def get_restaurant_latest_inspection(restaurant):
+    if restaurant.latest_inspection_id:
+        return format_inspection_record(restaurant.latest_inspection)
+    return get_latest_inspection_record(
+        restaurant.restaurant_name, restaurant.business_address, restaurant.postcode
+    )
+
+
+def get_latest_inspection_records(restaurants):
+    """
+    Return {restaurant id: latest record dict} for all the given restaurants.
+    Restaurants carrying a latest_inspection pointer are resolved by primary
+    key; the rest (not yet backfilled) share a single fallback query.
+    """
+    latest_records = {}
+    pointers = {
+        r.id: r.latest_inspection_id for r in restaurants if r.latest_inspection_id
+    }
+    if pointers:
+        records = InspectionRecords.objects.in_bulk(pointers.values())
+        for restaurant_id, record_id in pointers.items():
+            if record_id in records:
+                latest_records[restaurant_id] = format_inspection_record(
+                    records[record_id]
+                )
+
+    missing = {
+        (r.restaurant_name, r.business_address, r.postcode): r.id
+        for r in restaurants
+        if r.id not in latest_records
+    }
+    if not missing:
+        return latest_records
+
+    key_filter = Q()
+    for name, address, postcode in missing:
+        key_filter |= Q(
+            restaurant_name=name, business_address=address, postcode=postcode
+        )
+
+    for record in InspectionRecords.objects.filter(key_filter).order_by(
+        "-inspected_on"
+    ):
+        key = (record.restaurant_name, record.business_address, record.postcode)
+        restaurant_id = missing.get(key)
+        if restaurant_id is not None and restaurant_id not in latest_records:
+            latest_records[restaurant_id] = format_inspection_record(record)
+    return latest_records
+
+
 def query_inspection_record(business_name, business_address, postcode):
     records = InspectionRecords.objects.filter(
         restaurant_name=business_name,
@@ -107,39 +304,208 @@ def query_inspection_record(business_name, business_address, postcode):
     ).order_by("-inspected_on")
     result = []
     for record in records:
-        inspection_record = model_to_dict(record)
-        inspection_record["inspected_on"] = inspection_record["inspected_on"].strftime(
-            "%Y-%m-%d %I:%M %p"
-        )
-        result.append(inspection_record)
+        result.append(format_inspection_record(record))
 
     return result
 
 
 def restaurants_to_dict(restaurants):
+    """
+    Serialize a page of restaurants with their Yelp info and latest inspection.
+    Yelp details, their categories and the latest inspections are loaded for
+    the whole page at once, so the query count does not grow with page size.
+    """
+    restaurants = list(restaurants)
+    business_ids = [r.business_id for r in restaurants if r.business_id]
+    yelp_details = {}
+    if business_ids:
+        yelp_details = {
+            detail.business_id: detail
+            for detail in YelpRestaurantDetails.objects.filter(
+                business_id__in=business_ids
+            ).prefetch_related("category")
+        }
+    latest_records = get_latest_inspection_records(restaurants)
+
     result = []
     for restaurant in restaurants:
         restaurant_dict = model_to_dict(restaurant)
-        restaurant_dict["yelp_info"] = (
-            get_restaurant_info_yelp_local(
-                restaurant.business_id, restaurant.restaurant_name
+        if not restaurant.business_id:
+            restaurant_dict["yelp_info"] = None
+        elif restaurant.business_id in yelp_details:
+            restaurant_dict["yelp_info"] = format_yelp_detail(
+                yelp_details[restaurant.business_id], restaurant.restaurant_name
+            )
+        else:
+            restaurant_dict["yelp_info"] = json.loads(
+                get_yelp_payloads(restaurant.business_id, ["info"])["info"].content
             )
-            if restaurant.business_id
-            else None
-        )
 
         if not restaurant_dict["yelp_info"]:
             restaurant_dict["yelp_info"] = default_info_page(restaurant.restaurant_name)
 
-        latest_inspection_record = get_latest_inspection_record(
-            restaurant.restaurant_name, restaurant.business_address, restaurant.postcode
-        )
-        restaurant_dict["latest_record"] = latest_inspection_record
+        restaurant_dict["latest_record"] = latest_records.get(restaurant.id)
         result.append(restaurant_dict)
     return result
 
 
-def get_total_restaurant_number(
+SORT_OPTIONS = {
+    "ratedhigh": ("yelp_detail__rating", True),
+    "ratedlow": ("yelp_detail__rating", False),
+    "pricehigh": ("yelp_detail__price", True),
+    "pricelow": ("yelp_detail__price", False),
+}
+
+
+def build_restaurant_query(
+    keyword=None,
+    price=None,
+    neighborhood=None,
+    rating=None,
+    category=None,
+    compliant=None,
+    sort_option=None,
+    favorite_filter=None,
+    user=None,
+):
+    """
+    Build the unsliced queryset behind the browse filters. Returns the
+    queryset and its ordering as a list of (field, descending) pairs that
+    always ends with the primary key, so every page boundary is well defined.
+    """
+    filters = {}
+    if price:
+        filters["price__in"] = price
+    if neighborhood:
+        filters["neighborhood_key__in"] = [
+            normalize_search_key(n) for n in neighborhood
+        ]
+    if rating:
+        filters["rating__in"] = rating
+    if category:
+        filters["category__parent_category_key__in"] = [
+            normalize_search_key(c) for c in category
+        ]
+
+    keyword_filter = {}
+    if compliant == "Compliant":
+        keyword_filter["compliant_status"] = compliant
+
+    ordering = []
+    if sort_option in SORT_OPTIONS:
+        ordering.append(SORT_OPTIONS[sort_option])
+    elif keyword:
+        # Keyword searches list the best matches first
+        ordering.append(("search_rank", False))
+
+    if user and user.is_authenticated and sort_option == "recommended":
+        keyword_filter["compliant_status"] = "Compliant"
+        ordering = [("recommended_rank", False)]
+        if favorite_filter:
+            restaurants = user.favorite_restaurants.all()
+        else:
+            restaurants = Restaurant.objects.all()
+        if filters:
+            restaurants = restaurants.filter(
+                business_id__in=YelpRestaurantDetails.objects.filter(**filters)
+            )
+        # The precomputed list is read through its (user, restaurant) index
+        recommendations = recommended_restaurants(user)
+        restaurants = restaurants.filter(
+            id__in=recommendations.values("restaurant_id")
+        ).annotate(
+            recommended_rank=Subquery(
+                recommendations.filter(restaurant=OuterRef("pk")).values("rank")
+            )
+        )
+    elif favorite_filter:
+        if not (user and user.is_authenticated):
+            return Restaurant.objects.none(), [("id", True)]
+        restaurants = user.favorite_restaurants.filter(
+            business_id__in=YelpRestaurantDetails.objects.filter(**filters)
+        )
+    else:
+        restaurants = Restaurant.objects.filter(
+            business_id__in=YelpRestaurantDetails.objects.filter(**filters)
+        )
+
+    restaurants = restaurants.filter(**keyword_filter)
+    if keyword:
+        restaurants = get_search_backend().filter(restaurants, keyword)
+    return restaurants, ordering + [("id", True)]
+
+
+def order_restaurants(restaurants, ordering):
+    """
+    Apply an ordering from build_restaurant_query. NULLs sort last when
+    descending and first when ascending on every database, which the keyset
+    cursors rely on.
+    """
+    order_by = []
+    for field, descending in ordering:
+        if field == "search_rank":
+            order_by.append("-search_rank" if descending else "search_rank")
+        elif descending:
+            order_by.append(F(field).desc(nulls_last=True))
+        else:
+            order_by.append(F(field).asc(nulls_first=True))
+    return restaurants.order_by(*order_by)
+
+
+def keyset_filter(ordering, values):
+    """Q matching the rows that sort strictly after values under ordering."""
+    after = Q(pk__in=[])
+    equal = Q()
+    for (field, descending), value in zip(ordering, values):
+        if value is None:
+            if not descending:
+                after |= equal & Q(**{field + "__isnull": False})
+            equal &= Q(**{field + "__isnull": True})
+        else:
+            if descending:
+                after |= equal & (
+                    Q(**{field + "__lt": value}) | Q(**{field + "__isnull": True})
+                )
+            else:
+                after |= equal & Q(**{field + "__gt": value})
+            equal &= Q(**{field: value})
+    return after
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+# JSON types a cursor may hold for each keyset ordering field
+CURSOR_VALUE_TYPES = {
+    "id": (int,),
+    "yelp_detail__rating": (int, float),
+    "yelp_detail__price": (str,),
+    "recommended_rank": (int,),
+}
+
+
+def decode_cursor(cursor, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    for (field, _), value in zip(ordering, values):
+        if value is None:
+            continue
+        # bool is an int to isinstance but never a valid position
+        if isinstance(value, bool) or not isinstance(
+            value, CURSOR_VALUE_TYPES.get(field, ())
+        ):
+            raise ValueError("Invalid cursor: {}".format(cursor))
+    return values
+
+
+def search_restaurants(
+    page=1,
+    limit=6,
     keyword=None,
     neighbourhoods_filter=None,
     categories_filter=None,
@@ -149,35 +515,99 @@ def get_total_restaurant_number(
     sort_option=None,
     favorite_filter=None,
     user=None,
+    cursor=None,
 ):
-    if (
-        keyword
-        or neighbourhoods_filter
-        or categories_filter
-        or price_filter
-        or rating_filter
-        or compliant_filter
-        or sort_option
-        or favorite_filter
-    ):
-        restaurants = get_filtered_restaurants(
-            keyword,
-            price_filter,
-            neighbourhoods_filter,
-            rating_filter,
-            categories_filter,
-            compliant_filter,
-            0,
-            None,
-            sort_option,
-            favorite_filter,
-            user,
+    """
+    Return one page of the browse results as {"restaurants", "total",
+    "next_cursor"}. The page and the total come back from a single query.
+    Orderings on model fields also hand out a keyset cursor for the next page,
+    which avoids large OFFSETs on deep pages; keyword ranked results are
+    paginated by page number only.
+    """
+    limit = int(limit)
+    restaurants, ordering = build_restaurant_query(
+        keyword,
+        price_filter,
+        neighbourhoods_filter,
+        rating_filter,
+        categories_filter,
+        compliant_filter,
+        sort_option,
+        favorite_filter,
+        user,
+    )
+    keyset = all(field != "search_rank" for field, _ in ordering)
+
+    if keyset:
+        # An uncorrelated subquery is evaluated once and still lets the page
+        # query stop after LIMIT rows; it also ignores the cursor condition.
+        total_count = Subquery(
+            restaurants.order_by()
+            .annotate(group=Value(1, output_field=IntegerField()))
+            .values("group")
+            .annotate(total=Count("id"))
+            .values("total")
+        )
+    else:
+        # Ranking reads every match anyway, so a window count is free
+        total_count = Window(expression=Count("id"))
+    page_restaurants = restaurants.annotate(total_count=total_count)
+
+    offset = (int(page) - 1) * limit
+    if keyset:
+        page_restaurants = page_restaurants.annotate(
+            **{"cursor_%d" % i: F(field) for i, (field, _) in enumerate(ordering)}
         )
-        return restaurants.count()
+        if cursor:
+            page_restaurants = page_restaurants.filter(
+                keyset_filter(ordering, decode_cursor(cursor, ordering))
+            )
+            offset = 0
+    page_restaurants = order_restaurants(page_restaurants, ordering)
+    rows = list(page_restaurants[offset : offset + limit])  # noqa: E203
+
+    if rows:
+        total = rows[0].total_count
+    elif offset or cursor:
+        total = restaurants.count()
+    else:
+        total = 0
 
-    return Restaurant.objects.filter(
-        business_id__in=YelpRestaurantDetails.objects.all()
-    ).count()
+    next_cursor = None
+    if keyset and rows and len(rows) == limit:
+        next_cursor = encode_cursor(
+            [getattr(rows[-1], "cursor_%d" % i) for i in range(len(ordering))]
+        )
+    return {
+        "restaurants": restaurants_to_dict(rows),
+        "total": total,
+        "next_cursor": next_cursor,
+    }
+
+
+def get_total_restaurant_number(
+    keyword=None,
+    neighbourhoods_filter=None,
+    categories_filter=None,
+    price_filter=None,
+    rating_filter=None,
+    compliant_filter=None,
+    sort_option=None,
+    favorite_filter=None,
+    user=None,
+):
+    restaurants, _ = build_restaurant_query(
+        keyword,
+        price_filter,
+        neighbourhoods_filter,
+        rating_filter,
+        categories_filter,
+        compliant_filter,
+        sort_option,
+        favorite_filter,
+        user,
+    )
+    return restaurants.count()
 
 
 def get_restaurant_list(
@@ -193,40 +623,19 @@ def get_restaurant_list(
     favorite_filter=None,
     user=None,
 ):
-    page = int(page) - 1
-    offset = int(page) * int(limit)
-
-    if (
-        keyword
-        or neighbourhoods_filter
-        or categories_filter
-        or price_filter
-        or rating_filter
-        or compliant_filter
-        or sort_option
-        or favorite_filter
-    ):
-        restaurants = get_filtered_restaurants(
-            keyword,
-            price_filter,
-            neighbourhoods_filter,
-            rating_filter,
-            categories_filter,
-            compliant_filter,
-            page,
-            limit,
-            sort_option,
-            favorite_filter,
-            user,
-        )
-        return restaurants_to_dict(restaurants)
-    else:
-        restaurants = Restaurant.objects.filter(
-            business_id__in=YelpRestaurantDetails.objects.all()
-        )[
-            offset : offset + int(limit)  # noqa: E203
-        ]
-        return restaurants_to_dict(restaurants)
+    return search_restaurants(
+        page,
+        limit,
+        keyword,
+        neighbourhoods_filter,
+        categories_filter,
+        price_filter,
+        rating_filter,
+        compliant_filter,
+        sort_option,
+        favorite_filter,
+        user,
+    )["restaurants"]
 
 
 def get_filtered_restaurants(
@@ -242,249 +651,251 @@ def get_filtered_restaurants(
     favorite_filter=None,
     user=None,
 ):
-    filters = {}
-
+    restaurants, ordering = build_restaurant_query(
+        keyword,
+        price,
+        neighborhood,
+        rating,
+        category,
+        compliant,
+        sort_option,
+        favorite_filter,
+        user,
+    )
+    restaurants = order_restaurants(restaurants, ordering)
     if not limit:
-        limit = Restaurant.objects.all().count()
-
+        return restaurants
     offset = page * int(limit)
-    if price:
-        filters["price__in"] = price
-    if neighborhood:
-        filters["neighborhood__iregex"] = r"^(" + "|".join(neighborhood) + ")$"
-    if rating:
-        filters["rating__in"] = rating
-    if category:
-        filters["category__parent_category__iregex"] = r"^(" + "|".join(category) + ")$"
+    return restaurants[offset : offset + int(limit)]  # noqa: E203
 
-    keyword_filter = {}
-    if keyword:
-        keyword_filter["restaurant_name__icontains"] = keyword
-    if compliant == "Compliant":
-        keyword_filter["compliant_status__iexact"] = compliant
-
-    value = None
-    if sort_option:
-        if sort_option == "ratedhigh":
-            value = "-yelp_detail__rating"
-        elif sort_option == "ratedlow":
-            value = "yelp_detail__rating"
-        elif sort_option == "pricehigh":
-            value = "-yelp_detail__price"
-        elif sort_option == "pricelow":
-            value = "yelp_detail__price"
 
-    if user and user.is_authenticated and sort_option == "recommended":
-        preferred_categories = []
-        keyword_filter["compliant_status__iexact"] = "Compliant"
-        if not user.preferences.all():
-            restaurants = (
-                Restaurant.objects.filter(
-                    business_id__in=YelpRestaurantDetails.objects.all()
-                )
-                .distinct()
-                .filter(**keyword_filter)
-                .order_by("-yelp_detail__rating")[offset : offset + int(limit)]
-            )
-            return restaurants
+def get_latest_feedback(business_id):
+    latest_feedback = get_questionnaire_aggregate(business_id).latest_feedback
+    if latest_feedback:
+        return model_to_dict(latest_feedback)
 
-        for c in user.preferences.all():
-            preferred_categories.append(c.parent_category)
+    return None
 
-        filters["category__parent_category__in"] = preferred_categories
 
-        value = "-yelp_detail__rating"
-        if favorite_filter:
-            filtered_restaurants = user.favorite_restaurants.all()
-            filtered_restaurants = (
-                filtered_restaurants.filter(
-                    business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-                )
-                .distinct()
-                .filter(**keyword_filter)
-                .order_by(value)[offset : offset + int(limit)]
-            )
-        else:
-            filtered_restaurants = (
-                Restaurant.objects.filter(
-                    business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-                )
-                .distinct()
-                .filter(**keyword_filter)
-                .order_by(value)[offset : offset + int(limit)]
-            )
+def get_average_safety_rating(business_id):
+    return get_questionnaire_aggregate(business_id).average_safety_rating()
 
-        return filtered_restaurants
-
-    if favorite_filter:
-        if user.is_authenticated:
-            if value:
-                filtered_restaurants = user.favorite_restaurants.all()
-                filtered_restaurants = (
-                    filtered_restaurants.filter(
-                        business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-                    )
-                    .order_by(value)
-                    .distinct()
-                    .filter(**keyword_filter)[offset : offset + int(limit)]
-                )
-            else:
-                filtered_restaurants = user.favorite_restaurants.all()
-                filtered_restaurants = (
-                    filtered_restaurants.filter(
-                        business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-                    )
-                    .distinct()
-                    .filter(**keyword_filter)
-                    .order_by("-id")[offset : offset + int(limit)]
-                )
 
-    elif value:
-        filtered_restaurants = (
-            Restaurant.objects.filter(
-                business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-            )
-            .order_by(value)
-            .distinct()
-            .filter(**keyword_filter)[offset : offset + int(limit)]
+def get_csv_from_github(client=None):
+    client = client or get_http_client()
+    download = client.get(settings.COVID_DATA_URL, "covid.csv").content
+    return pd.read_csv(io.StringIO(download.decode("utf-8")))
+
+
+COVID_DATA_CACHE_KEY = "covid:last7days-by-modzcta"
+COVID_DATA_FALLBACK_KEY = COVID_DATA_CACHE_KEY + ":last-good"
+COVID_DATA_COLUMNS = [
+    "modzcta_name",
+    "percentpositivity_7day",
+    "people_tested",
+    "people_positive",
+    "median_daily_test_rate",
+    "adequately_tested",
+]
+
+
+def shape_covid_data(csv_file):
+    # The first row holds the citywide totals, not a zip code
+    csv_file = csv_file.iloc[1:]
+    return dict(
+        zip(
+            csv_file["modzcta"].tolist(),
+            csv_file[COVID_DATA_COLUMNS].to_numpy().tolist(),
         )
-    else:
-        filtered_restaurants = (
-            Restaurant.objects.filter(
-                business_id__in=YelpRestaurantDetails.objects.filter(**filters)
-            )
-            .distinct()
-            .filter(**keyword_filter)
-            .order_by("-id")[offset : offset + int(limit)]
+    )
+
+
+def refresh_covid_data(client=None):
+    """
+    Download the positivity CSV and cache it as a ready to render JSON string
+    of {zip: stats}. On failure the last good copy is left in place.
+    """
+    try:
+        data = json.dumps(
+            shape_covid_data(get_csv_from_github(client)), cls=DjangoJSONEncoder
         )
+    except Exception as e:
+        logger.error("Error while refreshing COVID data: {}".format(e))
+        return None
+    cache.set(COVID_DATA_CACHE_KEY, data, settings.COVID_DATA_TTL)
+    cache.set(COVID_DATA_FALLBACK_KEY, data, None)
+    return data
 
-    return filtered_restaurants
 
+def get_covid_data(client=None):
+    data = cache.get(COVID_DATA_CACHE_KEY)
+    if data is None:
+        data = refresh_covid_data(client) or cache.get(COVID_DATA_FALLBACK_KEY, "{}")
+    return data
 
-def get_latest_feedback(business_id):
-    all_feedback_list = UserQuestionnaire.objects.filter(
-        restaurant_business_id=business_id,
-    ).order_by("-saved_on")
-    if len(all_feedback_list) >= 1:
-        latest_feedback = model_to_dict(all_feedback_list[0])
-        return latest_feedback
 
-    return None
+def record_profile_view(business_id):
+    """Count a profile page view towards the Yelp refresh priority."""
+    if business_id:
+        YelpRestaurantDetails.objects.filter(business_id=business_id).update(
+            profile_views=F("profile_views") + 1
+        )
 
 
-def get_average_safety_rating(business_id):
-    all_feedback_list = UserQuestionnaire.objects.filter(
-        restaurant_business_id=business_id,
-    )
-    if len(all_feedback_list) >= 1:
-        total = 0
-        for feedback in all_feedback_list:
-            total += int(feedback.safety_level)
-        average_safety_rating = str(round(total / len(all_feedback_list), 2))
-        return average_safety_rating
-    return None
+def check_restaurant_saved(user, restaurant_id):
+    return user.favorite_restaurants.filter(id=restaurant_id).exists()
 
 
-def get_csv_from_github():
-    url = "https://raw.githubusercontent.com/nychealth/coronavirus-data/master/latest/last7days-by-modzcta.csv"  # noqa: E501
-    download = requests.get(url).content
-    return pd.read_csv(io.StringIO(download.decode("utf-8")))
+def favorite_ids_key(user_id):
+    return "favorites:{}".format(user_id)
 
 
-def check_restaurant_saved(user, restaurant_id):
-    return len(user.favorite_restaurants.all().filter(id=restaurant_id)) > 0
+def get_favorite_ids(user):
+    """
+    The set of the user's favorite restaurant ids, cached until the
+    favorites change.
+    """
+    key = favorite_ids_key(user.pk)
+    favorite_ids = cache.get(key)
+    if favorite_ids is None:
+        favorite_ids = frozenset(user.favorite_restaurants.values_list("id", flat=True))
+        cache.set(key, favorite_ids, settings.FAVORITES_CACHE_TTL)
+    return favorite_ids
+
+
+def invalidate_favorite_ids(user_ids):
+    cache.delete_many([favorite_ids_key(user_id) for user_id in user_ids])
+
+
+def annotate_saved_restaurants(user, restaurants):
+    """Set saved_by_user on each restaurant dict from one favorites lookup."""
+    favorite_ids = get_favorite_ids(user)
+    for restaurant in restaurants:
+        restaurant["saved_by_user"] = restaurant["id"] in favorite_ids
+    return restaurants
 
 
 def questionnaire_report(restaurant_business_id):
-    inspection_results = list(
-        InspectionRecords.objects.filter(business_id=restaurant_business_id).order_by(
-            "inspected_on"
-        )
+    latest_inspection = (
+        InspectionRecords.objects.filter(business_id=restaurant_business_id)
+        .order_by("-inspected_on")
+        .first()
     )
-    if len(inspection_results) >= 1:
-        latest_inspection = inspection_results[0]
-        latest_inspection_time = latest_inspection.inspected_on
-        latest_inspection_status = latest_inspection.is_roadway_compliant
-
+    if latest_inspection:
         valuable_questionnaire_list = list(
             UserQuestionnaire.objects.filter(
                 restaurant_business_id=restaurant_business_id,
-                saved_on__gte=latest_inspection_time,
+                saved_on__gte=latest_inspection.inspected_on,
             ).order_by("saved_on")
         )
 
-        return latest_inspection_status, valuable_questionnaire_list
+        return latest_inspection.is_roadway_compliant, valuable_questionnaire_list
     return None
 
 
 def questionnaire_statistics(restaurant_business_id):
-    if questionnaire_report(restaurant_business_id):
-        latest_inspection_status, valuable_questionnaire_list = questionnaire_report(
-            restaurant_business_id
+    return get_questionnaire_aggregate(restaurant_business_id).statistics()
+
+
+def refresh_questionnaire_aggregate(business_id):
+    """
+    Recompute the aggregate of business_id from its questionnaires in one
+    query, with the window anchored at its latest inspection.
+    """
+    feedback = UserQuestionnaire.objects.filter(restaurant_business_id=business_id)
+    latest_inspection = (
+        InspectionRecords.objects.filter(business_id=business_id)
+        .order_by("-inspected_on")
+        .first()
+    )
+    window_start = latest_inspection.inspected_on if latest_inspection else None
+    # Without an inspection the window is empty, which no row can match
+    window = Q(saved_on__gte=window_start) if window_start else Q(pk__isnull=True)
+    totals = feedback.aggregate(
+        feedback_count=Count("id"),
+        safety_level_total=Sum("safety_level"),
+        window_count=Count("id", filter=window),
+        window_safety_level_total=Sum("safety_level", filter=window),
+        **{
+            question + "_true": Count("id", filter=window & Q(**{question: True}))
+            for question in QUESTIONNAIRE_QUESTIONS
+        },
+    )
+
+    defaults = {field: value or 0 for field, value in totals.items()}
+    defaults["latest_feedback"] = feedback.order_by("-saved_on").first()
+    defaults["window_start"] = window_start
+    aggregate, _ = QuestionnaireAggregate.objects.update_or_create(
+        restaurant_business_id=business_id, defaults=defaults
+    )
+    return aggregate
+
+
+def refresh_questionnaire_aggregates(business_ids):
+    """Reset the windows of the businesses that received a new inspection."""
+    for business_id in QuestionnaireAggregate.objects.filter(
+        restaurant_business_id__in=set(business_ids)
+    ).values_list("restaurant_business_id", flat=True):
+        refresh_questionnaire_aggregate(business_id)
+
+
+def record_questionnaire(questionnaire):
+    """Fold a newly saved questionnaire into its business' aggregate."""
+    business_id = questionnaire.restaurant_business_id
+    aggregates = QuestionnaireAggregate.objects.filter(
+        restaurant_business_id=business_id
+    )
+    safety_level = questionnaire.safety_level
+    with transaction.atomic():
+        if not aggregates.update(
+            feedback_count=F("feedback_count") + 1,
+            safety_level_total=F("safety_level_total") + safety_level,
+        ):
+            refresh_questionnaire_aggregate(business_id)
+            return
+        aggregates.filter(window_start__lte=questionnaire.saved_on).update(
+            window_count=F("window_count") + 1,
+            window_safety_level_total=F("window_safety_level_total") + safety_level,
+            **{
+                question
+                + "_true": F(question + "_true")
+                + int(getattr(questionnaire, question))
+                for question in QUESTIONNAIRE_QUESTIONS
+            },
         )
-        total_valuable_count = len(valuable_questionnaire_list)
-        if total_valuable_count >= 1:
-            total_safety_rating = 0
-            temp_check_true = 0
-            contact_info_required_true = 0
-            employee_mask_true = 0
-            capacity_compliant_true = 0
-            distance_compliant_true = 0
-
-            for questionnaire in valuable_questionnaire_list:
-                total_safety_rating += int(questionnaire.safety_level)
-                temp_check_true += (
-                    1 if questionnaire.temperature_required.__contains__("true") else 0
-                )
-                contact_info_required_true += (
-                    1 if questionnaire.contact_info_required.__contains__("true") else 0
-                )
-                employee_mask_true += (
-                    1 if questionnaire.employee_mask.__contains__("true") else 0
-                )
-                capacity_compliant_true += (
-                    1 if questionnaire.capacity_compliant.__contains__("true") else 0
-                )
-                distance_compliant_true += (
-                    1 if questionnaire.distance_compliant.__contains__("true") else 0
-                )
-            valuable_avg_safety_rating = str(
-                round(total_safety_rating / total_valuable_count, 2)
-            )
+        aggregates.filter(
+            Q(latest_feedback__isnull=True)
+            | Q(latest_feedback__saved_on__lte=questionnaire.saved_on)
+        ).update(latest_feedback=questionnaire)
 
-            statistics_dict = {
-                "valuable_avg_safety_rating": valuable_avg_safety_rating,
-                "temp_check_true": temp_check_true,
-                "temp_check_false": total_valuable_count - temp_check_true,
-                "contact_info_required_true": contact_info_required_true,
-                "contact_info_required_false": total_valuable_count
-                - contact_info_required_true,
-                "employee_mask_true": employee_mask_true,
-                "employee_mask_false": total_valuable_count - employee_mask_true,
-                "capacity_compliant_true": capacity_compliant_true,
-                "capacity_compliant_false": total_valuable_count
-                - capacity_compliant_true,
-                "distance_compliant_true": distance_compliant_true,
-                "distance_compliant_false": total_valuable_count
-                - distance_compliant_true,
-            }
 
-            return statistics_dict
-    statistics_dict = {
-        "valuable_avg_safety_rating": 0,
-        "temp_check_true": 0,
-        "temp_check_false": 0,
-        "contact_info_required_true": 0,
-        "contact_info_required_false": 0,
-        "employee_mask_true": 0,
-        "employee_mask_false": 0,
-        "capacity_compliant_true": 0,
-        "capacity_compliant_false": 0,
-        "distance_compliant_true": 0,
-        "distance_compliant_false": 0,
-    }
+def get_questionnaire_aggregate(business_id):
+    """
+    Return the QuestionnaireAggregate of business_id in one row fetch,
+    building it on first use.
+    """
+    if not business_id:
+        return QuestionnaireAggregate()
+    aggregate = (
+        QuestionnaireAggregate.objects.select_related("latest_feedback")
+        .filter(restaurant_business_id=business_id)
+        .first()
+    )
+    if aggregate is None:
+        aggregate = refresh_questionnaire_aggregate(business_id)
+    return aggregate
+
 
-    return statistics_dict
+def get_questionnaire_summary(business_id):
+    """
+    Return (latest feedback dict, average safety rating, statistics dict)
+    for the profile page of business_id.
+    """
+    aggregate = get_questionnaire_aggregate(business_id)
+    feedback = None
+    if aggregate.latest_feedback:
+        feedback = model_to_dict(aggregate.latest_feedback)
+    return feedback, aggregate.average_safety_rating(), aggregate.statistics()
 
 
 def get_compliant_restaurant_list(
@@ -521,3 +932,204 @@ def get_compliant_restaurant_list(
         offset : offset + int(limit)  # noqa: E203
     ]
     return restaurants_to_dict(restaurants)
+
+
+TOP_COMPLIANT_MIN_RATING = 3
+
+
+def top_compliant_candidates():
+    return (
+        Restaurant.objects.filter(
+            compliant_status="Compliant",
+            yelp_detail__rating__gte=TOP_COMPLIANT_MIN_RATING,
+        )
+        .select_related("yelp_detail")
+        .order_by("-yelp_detail__rating", F("inspected_on").desc(nulls_last=True), "id")
+    )
+
+
+def top_compliant_key(rating, inspected_on, restaurant_id):
+    """Sort key matching the ordering of top_compliant_candidates()."""
+    return (
+        -rating,
+        -(inspected_on.timestamp() if inspected_on else 0),
+        restaurant_id,
+    )
+
+
+def rank_top_compliant(restaurants, limit):
+    ranked = sorted(
+        restaurants,
+        key=lambda r: top_compliant_key(r.yelp_detail.rating, r.inspected_on, r.id),
+    )
+    return ranked[:limit]
+
+
+def refresh_top_compliant_restaurants(changed_ids=None, limit=18):
+    """
+    Rebuild the materialized top compliant list. When changed_ids is given
+    only those restaurants are re-ranked against the current list; a full
+    rebuild happens only if one of the current entries dropped out or moved
+    down, since its replacement could be any restaurant outside the list.
+    """
+    current = list(TopCompliantRestaurant.objects.order_by("rank"))
+    top = None
+    if changed_ids is not None and len(current) >= limit:
+        changed_ids = set(changed_ids)
+        changed = {
+            r.id: r for r in top_compliant_candidates().filter(id__in=changed_ids)
+        }
+        entries = {entry.restaurant_id: entry for entry in current}
+        demoted = any(
+            restaurant_id not in changed
+            or top_compliant_key(
+                changed[restaurant_id].yelp_detail.rating,
+                changed[restaurant_id].inspected_on,
+                restaurant_id,
+            )
+            > top_compliant_key(entry.rating, entry.inspected_on, restaurant_id)
+            for restaurant_id, entry in entries.items()
+            if restaurant_id in changed_ids
+        )
+        if not demoted:
+            candidates = {
+                r.id: r
+                for r in Restaurant.objects.select_related("yelp_detail").filter(
+                    id__in=entries
+                )
+            }
+            candidates.update(changed)
+            top = rank_top_compliant(candidates.values(), limit)
+    if top is None:
+        top = list(top_compliant_candidates()[:limit])
+
+    if [(r.id, r.yelp_detail.rating, r.inspected_on) for r in top] == [
+        (entry.restaurant_id, entry.rating, entry.inspected_on) for entry in current
+    ]:
+        return False
+    with transaction.atomic():
+        TopCompliantRestaurant.objects.all().delete()
+        TopCompliantRestaurant.objects.bulk_create(
+            TopCompliantRestaurant(
+                rank=rank,
+                restaurant=restaurant,
+                rating=restaurant.yelp_detail.rating,
+                inspected_on=restaurant.inspected_on,
+            )
+            for rank, restaurant in enumerate(top, 1)
+        )
+    return True
+
+
+def get_top_compliant_restaurant_list(limit=18):
+    top_restaurants = Restaurant.objects.filter(top_compliant__isnull=False).order_by(
+        "top_compliant__rank"
+    )
+    restaurants = list(top_restaurants[:limit])
+    if not restaurants and refresh_top_compliant_restaurants(limit=limit):
+        restaurants = list(top_restaurants[:limit])
+    return restaurants_to_dict(restaurants)
+
+
+RECOMMENDATION_VERSION_KEY = "recommendations:version"
+
+
+def recommendation_bucket_key(version, category, neighborhood):
+    return "recommendations:{}:{}:{}".format(
+        version, category or "*", neighborhood or "*"
+    )
+
+
+def refresh_recommendation_buckets():
+    """
+    Precompute the chatbot candidates: the compliant restaurants rated
+    RECOMMENDATION_MIN_RATING or more, as (id, rating) lists bucketed by
+    parent category key and neighborhood key. "*" buckets hold every
+    category or neighborhood. A new version is written before it replaces
+    the current one, so readers never see a half built set.
+    """
+    details = {
+        business_id: (rating, neighborhood_key)
+        for business_id, rating, neighborhood_key in YelpRestaurantDetails.objects.filter(
+            rating__gte=RECOMMENDATION_MIN_RATING
+        ).values_list(
+            "business_id", "rating", "neighborhood_key"
+        )
+    }
+    categories = {}
+    for business_id, category in YelpRestaurantDetails.category.through.objects.filter(
+        yelprestaurantdetails_id__in=details
+    ).values_list("yelprestaurantdetails_id", "categories__parent_category_key"):
+        if category:
+            categories.setdefault(business_id, set()).add(category)
+
+    buckets = {}
+    for restaurant_id, business_id in Restaurant.objects.filter(
+        compliant_status="Compliant", business_id__in=details
+    ).values_list("id", "business_id"):
+        rating, neighborhood = details[business_id]
+        for category in categories.get(business_id, set()) | {None}:
+            for bucket_neighborhood in {neighborhood, None}:
+                buckets.setdefault((category, bucket_neighborhood), []).append(
+                    (restaurant_id, rating)
+                )
+
+    version = int(time.time() * 1000)
+    response_cache().set_many(
+        {
+            recommendation_bucket_key(version, *bucket): candidates
+            for bucket, candidates in buckets.items()
+        },
+        settings.RECOMMENDATION_BUCKET_TTL,
+    )
+    cache.set(RECOMMENDATION_VERSION_KEY, version, settings.RECOMMENDATION_BUCKET_TTL)
+    return len(buckets)
+
+
+def recommendation_candidates(category=None, neighborhood=None):
+    """
+    {restaurant id: rating} of the candidates matching any of the given
+    categories and any of the given neighborhoods.
+    """
+    version = cache.get(RECOMMENDATION_VERSION_KEY)
+    if version is None:
+        refresh_recommendation_buckets()
+        version = cache.get(RECOMMENDATION_VERSION_KEY)
+    keys = [
+        recommendation_bucket_key(version, c, n)
+        for c in [normalize_search_key(c) for c in category or []] or [None]
+        for n in [normalize_search_key(n) for n in neighborhood or []] or [None]
+    ]
+    candidates = {}
+    for bucket in response_cache().get_many(keys).values():
+        candidates.update(bucket)
+    return candidates
+
+
+def sample_recommendations(
+    category=None, neighborhood=None, number=3, weight_by_rating=False, user=None
+):
+    """
+    Pick up to number random restaurants from the precomputed candidate
+    buckets, serialized like restaurants_to_dict. With weight_by_rating a
+    restaurant's chance of being picked grows with its rating. Given a user,
+    the picks come from their recommendation list instead, weighted by score,
+    and category is ignored.
+    """
+    if user is not None:
+        candidates = user_recommendation_candidates(user, neighborhood)
+        weight_by_rating = True
+    else:
+        candidates = recommendation_candidates(category, neighborhood)
+    if weight_by_rating:
+        # Weighted sampling without replacement: keep the number largest
+        # random() ** (1 / weight) keys
+        picked = sorted(
+            candidates,
+            key=lambda pk: random.random() ** (1 / max(candidates[pk], 1e-6)),
+            reverse=True,
+        )[:number]
+    else:
+        picked = random.sample(list(candidates), min(number, len(candidates)))
+    restaurants = Restaurant.objects.in_bulk(picked)
+    return restaurants_to_dict(restaurants[pk] for pk in picked if pk in restaurants)
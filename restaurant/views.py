@@ -3,32 +3,40 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import render
 from django.http import JsonResponse, HttpResponseRedirect, HttpResponseBadRequest
 from django.urls import reverse
-import random
+from django.db import close_old_connections
+from asgiref.sync import sync_to_async
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
 from .models import Restaurant
 
 from django.views.decorators.csrf import csrf_exempt
 from .forms import (
+    NearbyRestaurantsForm,
     QuestionnaireForm,
     SearchFilterForm,
 )
+from .geo import nearby_restaurants, restaurants_in_box
+from .http_client import get_request_http_client
+from .tiles import get_tile, is_valid_tile
 from .utils import (
     query_yelp,
     query_inspection_record,
-    get_latest_inspection_record,
-    get_restaurant_list,
-    get_latest_feedback,
-    get_average_safety_rating,
-    get_total_restaurant_number,
+    get_restaurant_latest_inspection,
+    annotate_saved_restaurants,
     check_restaurant_saved,
-    get_csv_from_github,
-    questionnaire_statistics,
-    get_filtered_restaurants,
-    restaurants_to_dict,
+    get_covid_data,
+    get_questionnaire_summary,
+    default_info_page,
+    record_profile_view,
+    sample_recommendations,
+    search_restaurants,
 )
 
 from django.http import HttpResponse
 from django.http import HttpResponseNotFound
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 import json
@@ -37,6 +45,31 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def build_profile_context(
+    restaurant_id,
+    covid_data,
+    yelp_info,
+    latest_inspection,
+    questionnaire_summary,
+    saved_restaurants=None,
+):
+    feedback, average_safety_rating, statistics_dict = questionnaire_summary
+    parameter_dict = {
+        "google_key": settings.GOOGLE_MAP_KEY,
+        "google_map_id": settings.GOOGLE_MAP_ID,
+        "data": covid_data,
+        "yelp_info": yelp_info,
+        "lasted_inspection": latest_inspection,
+        "restaurant_id": restaurant_id,
+        "latest_feedback": feedback,
+        "average_safety_rating": average_safety_rating,
+        "statistics_dict": statistics_dict,
+    }
+    if saved_restaurants is not None:
+        parameter_dict["saved_restaurants"] = saved_restaurants
+    return parameter_dict
+
+
 def get_restaurant_profile(request, restaurant_id):
 
     if request.method == "POST" and "questionnaire_form" in request.POST:
@@ -48,58 +81,19 @@ def get_restaurant_profile(request, restaurant_id):
             return HttpResponseRedirect(url)
 
     try:
-        csv_file = get_csv_from_github()
-        result = {}
-        for idx, row in csv_file.iterrows():
-            if idx == 0:
-                continue
-            result[row["modzcta"]] = [
-                row["modzcta_name"],
-                row["percentpositivity_7day"],
-                row["people_tested"],
-                row["people_positive"],
-                row["median_daily_test_rate"],
-                row["adequately_tested"],
-            ]
-
         restaurant = Restaurant.objects.get(pk=restaurant_id)
-        response_yelp = query_yelp(restaurant.business_id)
-        latest_inspection = get_latest_inspection_record(
-            restaurant.restaurant_name, restaurant.business_address, restaurant.postcode
-        )
-        feedback = get_latest_feedback(restaurant.business_id)
-        average_safety_rating = get_average_safety_rating(restaurant.business_id)
-
-        statistics_dict = questionnaire_statistics(restaurant.business_id)
+        record_profile_view(restaurant.business_id)
+        saved_restaurants = None
         if request.user.is_authenticated:
-            user = request.user
-            parameter_dict = {
-                "google_key": settings.GOOGLE_MAP_KEY,
-                "google_map_id": settings.GOOGLE_MAP_ID,
-                "data": json.dumps(result, cls=DjangoJSONEncoder),
-                "yelp_info": response_yelp,
-                "lasted_inspection": latest_inspection,
-                "restaurant_id": restaurant_id,
-                "latest_feedback": feedback,
-                "average_safety_rating": average_safety_rating,
-                "saved_restaurants": len(
-                    user.favorite_restaurants.all().filter(id=restaurant_id)
-                )
-                > 0,
-                "statistics_dict": statistics_dict,
-            }
-        else:
-            parameter_dict = {
-                "google_key": settings.GOOGLE_MAP_KEY,
-                "google_map_id": settings.GOOGLE_MAP_ID,
-                "data": json.dumps(result, cls=DjangoJSONEncoder),
-                "yelp_info": response_yelp,
-                "lasted_inspection": latest_inspection,
-                "restaurant_id": restaurant_id,
-                "latest_feedback": feedback,
-                "average_safety_rating": average_safety_rating,
-                "statistics_dict": statistics_dict,
-            }
+            saved_restaurants = check_restaurant_saved(request.user, restaurant_id)
+        parameter_dict = build_profile_context(
+            restaurant_id,
+            get_covid_data(get_request_http_client()),
+            query_yelp(restaurant.business_id, get_request_http_client()),
+            get_restaurant_latest_inspection(restaurant),
+            get_questionnaire_summary(restaurant.business_id),
+            saved_restaurants,
+        )
 
         return render(request, "restaurant_detail.html", parameter_dict)
     except Restaurant.DoesNotExist:
@@ -109,6 +103,115 @@ def get_restaurant_profile(request, restaurant_id):
         )
 
 
+def close_old_connections_around(func):
+    """
+    Run func between two close_old_connections calls, as Django does around
+    a request, so the executor threads keep their database connections up
+    to CONN_MAX_AGE instead of connecting for every source.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return wrapper
+
+
+# Threads for the profile sources. A dedicated pool means a source that timed
+# out is never joined when the request's event loop shuts down.
+PROFILE_SOURCE_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+# Seconds to wait on a source missing from PROFILE_SOURCE_TIMEOUTS
+DEFAULT_PROFILE_SOURCE_TIMEOUT = 2.0
+
+
+async def load_profile_source(name, func, *args, fallback=None):
+    """
+    Run the sync profile source func(*args) and return its result, or
+    fallback if it fails or takes longer than PROFILE_SOURCE_TIMEOUTS[name].
+    Sources run on PROFILE_SOURCE_EXECUTOR with their own database
+    connection, so one that times out keeps running there without holding
+    up the rest of the request.
+    """
+    timeout = settings.PROFILE_SOURCE_TIMEOUTS.get(name, DEFAULT_PROFILE_SOURCE_TIMEOUT)
+    call = asyncio.get_running_loop().run_in_executor(
+        PROFILE_SOURCE_EXECUTOR, close_old_connections_around(func), *args
+    )
+    try:
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Profile source {} timed out".format(name))
+    except Exception as e:
+        logger.error("Error while loading profile source {}: {}".format(name, e))
+    return fallback
+
+
+def get_profile_user(request):
+    return request.user if request.user.is_authenticated else None
+
+
+async def get_restaurant_profile_async(request, restaurant_id):
+    """
+    Async get_restaurant_profile. The independent lookups run concurrently
+    and each one that fails or times out is left out of the page instead of
+    holding the response.
+    """
+    if request.method == "POST" and "questionnaire_form" in request.POST:
+        return await sync_to_async(get_restaurant_profile)(request, restaurant_id)
+
+    try:
+        restaurant = await sync_to_async(Restaurant.objects.get)(pk=restaurant_id)
+    except Restaurant.DoesNotExist:
+        logger.warning("Restaurant ID could not be found: {}".format(restaurant_id))
+        return HttpResponseNotFound(
+            "Restaurant ID {} does not exist".format(restaurant_id)
+        )
+    user = await sync_to_async(get_profile_user)(request)
+
+    sources = [
+        load_profile_source(
+            "covid", get_covid_data, get_request_http_client(), fallback="{}"
+        ),
+        load_profile_source(
+            "yelp",
+            query_yelp,
+            restaurant.business_id,
+            get_request_http_client(),
+            fallback={
+                "info": default_info_page(restaurant.restaurant_name),
+                "reviews": {"reviews": []},
+            },
+        ),
+        load_profile_source(
+            "inspection", get_restaurant_latest_inspection, restaurant, fallback={}
+        ),
+        load_profile_source(
+            "feedback",
+            get_questionnaire_summary,
+            restaurant.business_id,
+            fallback=get_questionnaire_summary(None),
+        ),
+    ]
+    if user is not None:
+        sources.append(
+            load_profile_source(
+                "saved", check_restaurant_saved, user, restaurant_id, fallback=False
+            )
+        )
+    _, *results = await asyncio.gather(
+        load_profile_source("view", record_profile_view, restaurant.business_id),
+        *sources,
+    )
+
+    parameter_dict = build_profile_context(restaurant_id, *results)
+    return await sync_to_async(render)(
+        request, "restaurant_detail.html", parameter_dict
+    )
+
+
 def get_inspection_info(request, restaurant_id):
     try:
         restaurant = Restaurant.objects.get(pk=restaurant_id)
@@ -131,44 +234,39 @@ def get_inspection_info(request, restaurant_id):
 
 
 def get_restaurants_list(request, page):
+    if not str(page).isdigit() or int(page) < 1:
+        return HttpResponseBadRequest("Invalid page")
     if request.method == "POST":
         form = SearchFilterForm(request.POST)
         if form.is_valid():
-            restaurant_list = get_restaurant_list(
-                page,
-                6,
-                form.cleaned_data.get("keyword"),
-                form.cleaned_data.get("neighbourhood"),
-                form.cleaned_data.get("category"),
-                form.get_price_filter(),
-                form.get_rating_filter(),
-                form.get_compliant_filter(),
-                form.cleaned_data.get("form_sort"),
-                form.cleaned_data.get("fav"),
-                request.user,
-            )
+            try:
+                result = search_restaurants(
+                    page,
+                    6,
+                    form.cleaned_data.get("keyword"),
+                    form.cleaned_data.get("neighbourhood"),
+                    form.cleaned_data.get("category"),
+                    form.get_price_filter(),
+                    form.get_rating_filter(),
+                    form.get_compliant_filter(),
+                    form.cleaned_data.get("form_sort"),
+                    form.cleaned_data.get("fav"),
+                    request.user,
+                    form.cleaned_data.get("cursor"),
+                )
+            except ValueError as e:
+                logger.warning(e)
+                return HttpResponseBadRequest("Invalid cursor")
+            restaurant_list = result["restaurants"]
 
             if request.user.is_authenticated:
-                for restaurant in restaurant_list:
-                    restaurant["saved_by_user"] = check_restaurant_saved(
-                        request.user, restaurant["id"]
-                    )
-
-            restaurant_number = get_total_restaurant_number(
-                form.cleaned_data.get("keyword"),
-                form.cleaned_data.get("neighbourhood"),
-                form.cleaned_data.get("category"),
-                form.get_price_filter(),
-                form.get_rating_filter(),
-                form.get_compliant_filter(),
-                form.cleaned_data.get("form_sort"),
-                form.cleaned_data.get("fav"),
-                request.user,
-            )
+                annotate_saved_restaurants(request.user, restaurant_list)
+
             parameter_dict = {
-                "restaurant_number": restaurant_number,
+                "restaurant_number": result["total"],
                 "restaurant_list": json.dumps(restaurant_list, cls=DjangoJSONEncoder),
                 "page": page,
+                "next_cursor": result["next_cursor"],
             }
             return JsonResponse(parameter_dict)
         else:
@@ -176,6 +274,56 @@ def get_restaurants_list(request, page):
     return HttpResponse("cnm")
 
 
+def get_nearby_restaurants(request):
+    """
+    JSON list of the k compliant restaurants nearest to ?lat=&lng=, or of the
+    compliant restaurants inside ?bbox=south,west,north,east.
+    """
+    form = NearbyRestaurantsForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    if form.cleaned_data["bbox"]:
+        restaurants = restaurants_in_box(
+            *form.cleaned_data["bbox"], limit=form.cleaned_data["limit"] or 500
+        )
+    else:
+        restaurants = nearby_restaurants(
+            form.cleaned_data["lat"],
+            form.cleaned_data["lng"],
+            form.cleaned_data["k"] or 10,
+        )
+    return JsonResponse({"restaurants": restaurants})
+
+
+def get_restaurant_tile(request, z, x, y):
+    """
+    GeoJSON tile z/x/y of the restaurants matching the browse filters given
+    as query parameters. Responds 304 when the client's ETag is current.
+    """
+    if not is_valid_tile(z, x, y):
+        return HttpResponseNotFound("No such tile")
+    form = SearchFilterForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+
+    filters = {
+        "keyword": form.cleaned_data.get("keyword"),
+        "price": form.get_price_filter(),
+        "neighborhood": form.cleaned_data.get("neighbourhood"),
+        "rating": form.get_rating_filter(),
+        "category": form.cleaned_data.get("category"),
+        "compliant": form.get_compliant_filter(),
+    }
+    content, etag = get_tile(z, x, y, filters)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type="application/geo+json")
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=settings.GEO_TILE_MAX_AGE)
+    return response
+
+
 def get_landing_page(request, page=1):
     return render(request, "browse.html")
 
@@ -204,28 +352,19 @@ def chatbot_keyword(request):
         try:
             data = json.loads(request.body)
 
-            # If user chose to be recommended by preference
-            # category list is the preference list.
-            if request.user and data["is_preference"]:
-                data["category"] = [
-                    category.category for category in request.user.preferences.all()
-                ]
-
-            restaurants = get_filtered_restaurants(
-                limit=Restaurant.objects.all().count(),
+            # Pick 3 random compliant restaurants rated 3 or more to recommend,
+            # or from the user's own recommendations if they asked for them
+            user = None
+            if data["is_preference"] and request.user.is_authenticated:
+                user = request.user
+            restaurants = sample_recommendations(
                 category=data["category"],
                 neighborhood=data["location"],
-                rating=[3.0, 3.5, 4.0, 4.5, 5.0],
-                compliant="Compliant",
+                number=3,
+                user=user,
             )
 
-            # If number > 3, we pick 3 random restaurants in that list to recommend to user.
-            total_number = restaurants.count()
-            if total_number > 3:
-                idx = random.sample(range(0, total_number), 3)
-                restaurants = [restaurants[i] for i in idx]
-
-            response = {"restaurants": restaurants_to_dict(restaurants)}
+            response = {"restaurants": restaurants}
             return JsonResponse(response)
         except AttributeError as e:
             return HttpResponseBadRequest(e)
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('restaurant', '0014_geo_index'),
+        ('user', '0002_dinesafelyuser_preferences'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendedRestaurant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveIntegerField()),
+                ('score', models.FloatField(default=0.0)),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended', to='restaurant.restaurant')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommendations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='recommendedrestaurant',
+            constraint=models.UniqueConstraint(fields=('user', 'rank'), name='recommendation_user_rank_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='recommendedrestaurant',
+            constraint=models.UniqueConstraint(fields=('user', 'restaurant'), name='recommendation_user_restaurant_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0003_recommendedrestaurant'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dinesafelyuser',
+            name='recommendations_stale',
+            field=models.BooleanField(default=False),
+        ),
+    ]
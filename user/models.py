@@ -6,3 +6,35 @@ from restaurant.models import Restaurant, Categories
 class DineSafelyUser(AbstractUser):
     favorite_restaurants = models.ManyToManyField(Restaurant, blank=True)
     preferences = models.ManyToManyField(Categories, blank=True)
+    # Set when the favorites, preferences or questionnaires behind the
+    # recommendation list changed since it was built
+    recommendations_stale = models.BooleanField(default=False)
+
+
+class RecommendedRestaurant(models.Model):
+    """Precomputed top recommendations of a user, by rank."""
+
+    user = models.ForeignKey(
+        DineSafelyUser, on_delete=models.CASCADE, related_name="recommendations"
+    )
+    restaurant = models.ForeignKey(
+        Restaurant, on_delete=models.CASCADE, related_name="recommended"
+    )
+    rank = models.PositiveIntegerField()
+    score = models.FloatField(default=0.0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "rank"], name="recommendation_user_rank_uniq"
+            ),
+            models.UniqueConstraint(
+                fields=["user", "restaurant"],
+                name="recommendation_user_restaurant_uniq",
+            ),
+        ]
+
+    def __str__(self):
+        return "{} {} {} {}".format(
+            self.user_id, self.rank, self.restaurant_id, self.score
+        )
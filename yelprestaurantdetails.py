@@ -1,29 +1,71 @@
 import os
 import django
-import requests
+import functools
 import json
 import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dinesafelysite.settings")
 django.setup()
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
 from restaurant.models import (
     Zipcodes,
     YelpRestaurantDetails,
     Categories,
     Restaurant,
     InspectionRecords,
+    YelpCallBudget,
+)
+from restaurant.geo import get_geo_backend
+from restaurant.http_client import HttpClient, get_http_client
+from restaurant.search import normalize_search_key
+from restaurant.tiles import invalidate_tiles
+from restaurant.utils import (
+    cache_yelp_response,
+    query_yelp,
+    get_restaurant_info_yelp,
+    refresh_top_compliant_restaurants,
 )
-from restaurant.utils import query_yelp
 
 logger = logging.getLogger(__name__)
 
 
+def match_on_yelp(restaurant_name, restaurant_location, client=None):
+    location_list = restaurant_location.split(", ")
+    address1 = location_list[0]
+    city = "New York"
+    state = "NY"
+    country = "US"
+
+    client = client or get_http_client()
+    url = settings.YELP_BUSINESS_MATCH_API
+    params = {
+        "name": restaurant_name,
+        "address1": address1,
+        "city": city,
+        "state": state,
+        "country": country,
+    }
+
+    response = client.get(
+        url,
+        "yelp.match",
+        token=settings.YELP_ACCESS_TOKEN_BUSINESS_SEARCH,
+        params=params,
+    )
+    return response.text.encode("utf8")
+
+
 def map_zipcode_to_neighbourhood():
     nyc_neigbourhoods_api = "https://data.beta.nyc/en/api/3/action/datastore_search?resource_id=7caac650-d082-4aea-9f9b-3681d568e8a5&limit=200"
 
-    response = requests.get(nyc_neigbourhoods_api)
+    response = get_http_client().get(nyc_neigbourhoods_api, "nyc.neighbourhoods")
     data = json.loads(response.content)
     neighbourhood_data = data["result"]["records"]
 
@@ -41,47 +83,128 @@ def map_zipcode_to_neighbourhood():
                     zip["zip"], e
                 )
             )
+    reset_reference_tables()
+
+
+def parse_yelp_categories(categories):
+    """
+    Return {alias: parent category} for Yelp's category list. Restaurant
+    cuisines are their own parent; other categories take their first parent.
+    """
+    parents = {}
+    for c in categories:
+        alias = c["alias"]
+        parent = None
+        if c["parent_aliases"] and c["parent_aliases"][0] == "restaurants":
+            parent = alias
+        elif c["parent_aliases"]:
+            parent = c["parent_aliases"][0]
+        parents[alias] = parent
+    return parents
+
+
+def sync_categories(parents, batch_size=500):
+    """
+    Make the Categories table match {alias: parent category}: diff it against
+    the stored rows and apply the inserts, updates and deletes with bulk
+    operations in one transaction. Returns the number of rows in each.
+    """
+    with transaction.atomic():
+        existing = Categories.objects.in_bulk()
+        created = []
+        updated = []
+        for alias, parent in parents.items():
+            category = existing.get(alias)
+            if category is None:
+                created.append(
+                    Categories(
+                        category=alias,
+                        parent_category=parent,
+                        parent_category_key=normalize_search_key(parent),
+                    )
+                )
+            elif category.parent_category != parent:
+                category.parent_category = parent
+                category.parent_category_key = normalize_search_key(parent)
+                updated.append(category)
+        deleted = [alias for alias in existing if alias not in parents]
+
+        Categories.objects.bulk_create(created, batch_size=batch_size)
+        Categories.objects.bulk_update(
+            updated, ["parent_category", "parent_category_key"], batch_size=batch_size
+        )
+        for start in range(0, len(deleted), batch_size):
+            Categories.objects.filter(
+                category__in=deleted[start : start + batch_size]  # noqa: E203
+            ).delete()
+    reset_reference_tables()
+    if created or updated or deleted:
+        invalidate_tiles()
+    return {"created": len(created), "updated": len(updated), "deleted": len(deleted)}
 
 
 def save_yelp_categories():
-    access_token = settings.YELP_ACCESS_TOKEN_CATEGORY
-    headers = {"Authorization": "bearer %s" % access_token}
-    url = settings.YELP_CATEGORY_API
-    response = requests.get(url, headers=headers)
-    categories = json.loads(response.content)
+    """
+    Sync the Categories table with Yelp's category list. Running it again
+    without changes on Yelp's side writes nothing.
+    """
+    started = time.perf_counter()
+    response = get_http_client().get(
+        settings.YELP_CATEGORY_API,
+        "yelp.categories",
+        token=settings.YELP_ACCESS_TOKEN_CATEGORY,
+    )
+    response.raise_for_status()
+    parents = parse_yelp_categories(json.loads(response.content)["categories"])
+    if not parents:
+        # Never wipe the table because of an empty response
+        logger.error("Yelp returned no categories, keeping the stored ones")
+        return None
 
-    for c in categories["categories"]:
-        try:
-            alias = c["alias"]
-            parent = None
+    stats = sync_categories(parents)
+    logger.info(
+        "Synced {} Yelp categories in {:.2f}s: {created} created, "
+        "{updated} updated, {deleted} deleted".format(
+            len(parents), time.perf_counter() - started, **stats
+        )
+    )
+    return stats
 
-            if c["parent_aliases"] and c["parent_aliases"][0] == "restaurants":
-                parent = alias
-            elif c["parent_aliases"]:
-                parent = c["parent_aliases"][0]
 
-            cat = Categories(category=alias, parent_category=parent)
-            cat.save()
-            print(alias, parent)
-        except Exception as e:
-            logger.error("Error while getting categories for  Restaurant: {}".format(e))
+@functools.lru_cache(maxsize=None)
+def category_table():
+    """
+    {alias: Categories} of every Yelp category, loaded once per process and
+    cleared by save_yelp_categories when it rewrites the table.
+    """
+    return Categories.objects.in_bulk()
+
+
+@functools.lru_cache(maxsize=None)
+def neighbourhood_table():
+    """
+    {zipcode: neighborhood}, loaded once per process and cleared by
+    map_zipcode_to_neighbourhood when it rewrites the table.
+    """
+    return dict(Zipcodes.objects.values_list("zipcode", "neighborhood"))
 
-            continue
+
+def reset_reference_tables():
+    """Drop the memoized tables so the next lookup reloads them."""
+    category_table.cache_clear()
+    neighbourhood_table.cache_clear()
 
 
 def get_neighbourhood(zip):
-    area = Zipcodes.objects.get(zipcode=zip)
-    if area:
-        return area.neighborhood
-    else:
-        return None
+    return neighbourhood_table().get(zip)
 
 
 def get_restaurant_category_yelp(alias):
-    access_token = settings.YELP_ACCESS_TOKEN_CATEGORY
-    headers = {"Authorization": "bearer %s" % access_token}
-    url = settings.YELP_CATEGORY_API + alias
-    response = requests.get(url, headers=headers)
+    response = get_http_client().get(
+        settings.YELP_CATEGORY_API + alias,
+        "yelp.category",
+        token=settings.YELP_ACCESS_TOKEN_CATEGORY,
+    )
     return json.loads(response.content)
 
 
@@ -96,8 +219,10 @@ def get_cuisine(categories):
         #     return c["alias"]
         # else:
         #     return category["category"]["parent_aliases"][0]
-        cuisine = Categories.objects.get(category=c["alias"])
-        # print(cuisine)
+        cuisine = category_table().get(c["alias"])
+        if cuisine is None:
+            logger.warning("Unknown Yelp category: {}".format(c["alias"]))
+            continue
         cuisines.append(cuisine)
     return cuisines
 
@@ -143,6 +268,22 @@ def validate_fields(restaurant_info):
     return restaurant_data
 
 
+def build_yelp_restaurant_details(business_id, restaurant_info):
+    restaurant_data = validate_fields(restaurant_info)
+    details = YelpRestaurantDetails(
+        business_id=business_id,
+        neighborhood=restaurant_data["neighborhood"],
+        neighborhood_key=normalize_search_key(restaurant_data["neighborhood"]),
+        price=restaurant_data["price"],
+        rating=restaurant_data["rating"],
+        img_url=restaurant_data["img_url"],
+        latitude=restaurant_data["latitude"],
+        longitude=restaurant_data["longitude"],
+        last_refreshed=datetime.now(),
+    )
+    return details, restaurant_data["category"] or []
+
+
 def save_yelp_restaurant_details(business_id):
 
     # for r in Restaurant.objects.all():
@@ -150,25 +291,12 @@ def save_yelp_restaurant_details(business_id):
         if business_id:
             restaurant_info = query_yelp(business_id)
 
-            restaurant_data = validate_fields(restaurant_info)
-
-            details = YelpRestaurantDetails(
-                business_id=business_id,
-                neighborhood=restaurant_data["neighborhood"],
-                # category=restaurant_data["category"],
-                price=restaurant_data["price"],
-                rating=restaurant_data["rating"],
-                img_url=restaurant_data["img_url"],
-                latitude=restaurant_data["latitude"],
-                longitude=restaurant_data["longitude"],
+            details, categories = build_yelp_restaurant_details(
+                business_id, restaurant_info
             )
 
-            # print(details)
             details.save()
-            for cat in restaurant_data["category"]:
-                # print(cat)
-                details.category.add(cat)
-                details.save()
+            details.category.add(*categories)
 
             logger.info(
                 "Yelp restaurant details successfully saved: {}".format(business_id)
@@ -182,6 +310,381 @@ def save_yelp_restaurant_details(business_id):
         )
 
 
+def fetch_yelp_match(restaurant_name, business_address, client=None):
+    """
+    Match one restaurant on Yelp and fetch its business info. Runs in a worker
+    thread, so it only talks HTTP and never touches the database.
+    """
+    response = json.loads(match_on_yelp(restaurant_name, business_address, client))
+    if next(iter(response)) == "error" or not response["businesses"]:
+        return None, None
+
+    business_id = response["businesses"][0]["id"]
+    info = get_restaurant_info_yelp(business_id, client)
+    if info.status_code != 200:
+        return business_id, None
+    return business_id, {"info": json.loads(info.content)}
+
+
+def enrich_restaurants(restaurant_keys, max_workers=None, requests_per_second=None):
+    """
+    Match and fetch Yelp info for many (name, address, postcode) keys with a
+    bounded pool of workers. Calls go through the shared HTTP client and its
+    per-token rate limits unless requests_per_second asks for a dedicated
+    client with a different rate.
+    Returns {key: (business_id, restaurant_info)}; either may be None.
+    """
+    max_workers = max_workers or settings.YELP_ENRICHMENT_WORKERS
+    client = get_http_client()
+    if requests_per_second:
+        client = HttpClient(
+            token_rate=requests_per_second,
+            **dict(settings.HTTP_CLIENT, pool_maxsize=max_workers),
+        )
+
+    def fetch(key):
+        try:
+            return key, fetch_yelp_match(key[0], key[1], client)
+        except Exception as e:
+            logger.error(
+                "Error while matching restaurant on Yelp: {} {}".format(key, e)
+            )
+            return key, (None, None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = dict(executor.map(fetch, restaurant_keys))
+
+    logger.info(
+        "Matched {} of {} restaurants on Yelp".format(
+            sum(1 for b_id, _ in results.values() if b_id), len(results)
+        )
+    )
+    return results
+
+
+def save_yelp_restaurant_details_bulk(enriched):
+    """
+    Write the details fetched by enrich_restaurants in bulk and return
+    {business_id: YelpRestaurantDetails} for every business that has details.
+    """
+    details_list = []
+    category_links = []
+    for business_id, restaurant_info in enriched.values():
+        if not business_id or not restaurant_info:
+            continue
+        try:
+            details, categories = build_yelp_restaurant_details(
+                business_id, restaurant_info
+            )
+        except Exception as e:
+            logger.error(
+                "Error while building YelpRestaurantDetails: {} {}".format(
+                    business_id, e
+                )
+            )
+            continue
+        details_list.append(details)
+        for cat in categories:
+            category_links.append(
+                YelpRestaurantDetails.category.through(
+                    yelprestaurantdetails_id=business_id, categories_id=cat.category
+                )
+            )
+
+    YelpRestaurantDetails.objects.bulk_create(details_list, ignore_conflicts=True)
+    YelpRestaurantDetails.category.through.objects.bulk_create(
+        category_links, ignore_conflicts=True
+    )
+    return YelpRestaurantDetails.objects.in_bulk([d.business_id for d in details_list])
+
+
+def reserve_yelp_calls(items, calls_per_item=1):
+    """
+    Take the Yelp calls for up to `items` items from today's
+    YELP_DAILY_BUDGET of background calls and return how many items fit.
+    """
+    day = datetime.now().date()
+    YelpCallBudget.objects.bulk_create([YelpCallBudget(day=day)], ignore_conflicts=True)
+    while True:
+        used = YelpCallBudget.objects.get(day=day).used
+        granted = max(
+            min(items, (settings.YELP_DAILY_BUDGET - used) // calls_per_item), 0
+        )
+        if not granted:
+            break
+        # Only take the calls if no other worker took some since the read,
+        # otherwise read again
+        if YelpCallBudget.objects.filter(day=day, used=used).update(
+            used=F("used") + granted * calls_per_item
+        ):
+            break
+    if granted < items:
+        logger.warning(
+            "Daily Yelp budget reached, {} of {} items deferred".format(
+                items - granted, items
+            )
+        )
+    return granted
+
+
+def yelp_match_retry_on(attempts, now):
+    """When a restaurant that failed its attempts-th Yelp match is tried again."""
+    delay = min(
+        settings.YELP_MATCH_RETRY_DELAY * 2 ** (attempts - 1),
+        settings.YELP_MATCH_MAX_RETRY_DELAY,
+    )
+    return now + timedelta(seconds=delay)
+
+
+def enrich_unmatched_restaurants(limit=None, now=None):
+    """
+    Match up to limit restaurants that have no Yelp details yet on Yelp,
+    those tried least often and most recently inspected first, and link
+    them to the details found. Restaurants that fail to match are backed
+    off, see yelp_match_retry_on. Returns the restaurants that were linked.
+    """
+    limit = limit or settings.YELP_REFRESH_BATCH_SIZE
+    now = now or datetime.now()
+    reset_reference_tables()
+    restaurants = {
+        (r.restaurant_name, r.business_address, r.postcode): r
+        for r in Restaurant.objects.filter(yelp_detail__isnull=True)
+        .filter(Q(yelp_match_retry_on__isnull=True) | Q(yelp_match_retry_on__lte=now))
+        .order_by("yelp_match_attempts", F("inspected_on").desc(nulls_last=True), "id")[
+            :limit
+        ]
+    }
+    # Each restaurant takes a match and a business details call
+    granted = reserve_yelp_calls(len(restaurants), calls_per_item=2)
+    restaurants = dict(list(restaurants.items())[:granted])
+    if not restaurants:
+        return []
+
+    enriched = enrich_restaurants(restaurants)
+    details = save_yelp_restaurant_details_bulk(enriched)
+    owners = dict(
+        Restaurant.objects.filter(business_id__in=details).values_list(
+            "business_id", "id"
+        )
+    )
+    linked = []
+    for key, (business_id, _) in enriched.items():
+        restaurant = restaurants[key]
+        if business_id not in details:
+            continue
+        # Another restaurant already owns this Yelp business
+        if owners.setdefault(business_id, restaurant.id) != restaurant.id:
+            continue
+        restaurant.business_id = business_id
+        restaurant.yelp_detail = details[business_id]
+        linked.append(restaurant)
+
+    Restaurant.objects.bulk_update(linked, ["business_id", "yelp_detail"])
+    failed = [r for r in restaurants.values() if r.yelp_detail_id is None]
+    for restaurant in failed:
+        restaurant.yelp_match_attempts += 1
+        restaurant.yelp_match_retry_on = yelp_match_retry_on(
+            restaurant.yelp_match_attempts, now
+        )
+    Restaurant.objects.bulk_update(
+        failed, ["yelp_match_attempts", "yelp_match_retry_on"]
+    )
+    get_geo_backend().index(linked)
+    if linked:
+        invalidate_tiles()
+    refresh_top_compliant_restaurants([r.id for r in linked])
+    logger.info(
+        "Linked {} of {} unmatched restaurants to Yelp".format(
+            len(linked), len(restaurants)
+        )
+    )
+    return linked
+
+
+REFRESHED_FIELDS = [
+    "neighborhood",
+    "neighborhood_key",
+    "price",
+    "rating",
+    "img_url",
+    "latitude",
+    "longitude",
+]
+
+
+def yelp_refresh_candidates(limit, now=None):
+    """
+    Details that were never refreshed or are older than YELP_DETAILS_MAX_AGE,
+    most viewed first and then least recently refreshed first.
+    """
+    now = now or datetime.now()
+    stale = now - timedelta(seconds=settings.YELP_DETAILS_MAX_AGE)
+    return list(
+        YelpRestaurantDetails.objects.filter(
+            Q(last_refreshed__isnull=True) | Q(last_refreshed__lt=stale)
+        )
+        .order_by(
+            "-profile_views",
+            F("last_refreshed").asc(nulls_first=True),
+            "business_id",
+        )
+        .prefetch_related("category")[:limit]
+    )
+
+
+def fetch_yelp_details(business_ids, max_workers=None):
+    """
+    Fetch the business info of business_ids concurrently through the shared
+    client. Returns {business_id: response or None}.
+    """
+    client = get_http_client()
+
+    def fetch(business_id):
+        try:
+            return business_id, get_restaurant_info_yelp(business_id, client)
+        except Exception as e:
+            logger.error(
+                "Error while fetching Yelp details: {} {}".format(business_id, e)
+            )
+            return business_id, None
+
+    max_workers = max_workers or settings.YELP_ENRICHMENT_WORKERS
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(fetch, business_ids))
+
+
+def diff_yelp_details(details, restaurant_info):
+    """
+    Copy the fields of restaurant_info that differ onto details. Returns the
+    changed field names, and the (added, removed) category aliases.
+    """
+    fresh, categories = build_yelp_restaurant_details(
+        details.business_id, restaurant_info
+    )
+    changed = []
+    for field in REFRESHED_FIELDS:
+        old, new = getattr(details, field), getattr(fresh, field)
+        if field in ("latitude", "longitude"):
+            # Missing coordinates keep the stored ones; compare as floats so
+            # the stored decimals match the JSON values
+            if new is None or float(old) == float(new):
+                continue
+        elif old == new:
+            continue
+        setattr(details, field, new)
+        changed.append(field)
+
+    current = {c.category for c in details.category.all()}
+    aliases = {c.category for c in categories}
+    return changed, (aliases - current, current - aliases)
+
+
+def refresh_yelp_details(limit=None, now=None):
+    """
+    Re-fetch stale Yelp details in priority order within the daily budget.
+    Only the fields that changed are written, with one bulk_update per set
+    of changed fields, and every fetched row gets a new last_refreshed.
+    Returns {"refreshed": n, "changed": n, "failed": n}.
+    """
+    now = now or datetime.now()
+    limit = limit or settings.YELP_REFRESH_BATCH_SIZE
+    candidates = yelp_refresh_candidates(limit, now)
+    candidates = candidates[: reserve_yelp_calls(len(candidates))]
+    if not candidates:
+        return {"refreshed": 0, "changed": 0, "failed": 0}
+
+    reset_reference_tables()
+    responses = fetch_yelp_details([d.business_id for d in candidates])
+    refreshed = []
+    by_fields = defaultdict(list)
+    links_added = []
+    links_removed = Q(pk__in=[])
+    rating_changed = []
+    moved = []
+    for details in candidates:
+        response = responses.get(details.business_id)
+        if response is None or response.status_code not in (200, 404):
+            continue
+        details.last_refreshed = now
+        refreshed.append(details)
+        # Closed businesses are kept as they are until their next refresh
+        if response.status_code == 404:
+            continue
+        cache_yelp_response("info", details.business_id, response)
+        try:
+            changed, (added, removed) = diff_yelp_details(
+                details, {"info": json.loads(response.content)}
+            )
+        except Exception as e:
+            logger.error(
+                "Error while diffing Yelp details: {} {}".format(details.business_id, e)
+            )
+            continue
+        if changed:
+            by_fields[tuple(changed)].append(details)
+        if "rating" in changed:
+            rating_changed.append(details.business_id)
+        if "latitude" in changed or "longitude" in changed:
+            moved.append(details.business_id)
+        links_added.extend(
+            YelpRestaurantDetails.category.through(
+                yelprestaurantdetails_id=details.business_id, categories_id=alias
+            )
+            for alias in added
+        )
+        if removed:
+            links_removed |= Q(
+                yelprestaurantdetails_id=details.business_id,
+                categories_id__in=removed,
+            )
+
+    with transaction.atomic():
+        for fields, rows in by_fields.items():
+            YelpRestaurantDetails.objects.bulk_update(
+                rows, list(fields) + ["last_refreshed"]
+            )
+        changed_ids = {d.business_id for rows in by_fields.values() for d in rows}
+        YelpRestaurantDetails.objects.filter(
+            business_id__in=[
+                d.business_id for d in refreshed if d.business_id not in changed_ids
+            ]
+        ).update(last_refreshed=now)
+        YelpRestaurantDetails.category.through.objects.filter(links_removed).delete()
+        YelpRestaurantDetails.category.through.objects.bulk_create(
+            links_added, ignore_conflicts=True
+        )
+    if moved:
+        get_geo_backend().index(Restaurant.objects.filter(yelp_detail__in=moved))
+    if changed_ids:
+        invalidate_tiles()
+    if rating_changed:
+        refresh_top_compliant_restaurants(
+            Restaurant.objects.filter(business_id__in=rating_changed).values_list(
+                "id", flat=True
+            )
+        )
+
+    stats = {
+        "refreshed": len(refreshed),
+        "changed": len(changed_ids),
+        "failed": len(candidates) - len(refreshed),
+    }
+    logger.info(
+        "Refreshed {refreshed} Yelp details, {changed} changed, "
+        "{failed} failed".format(**stats)
+    )
+    return stats
+
+
+def refresh_yelp_restaurants():
+    """
+    The yelp_refresh job: link newly inspected restaurants to Yelp first,
+    then spend what is left of the daily budget refreshing stale details.
+    """
+    enrich_unmatched_restaurants()
+    refresh_yelp_details()
+
+
 def update_restuarant_inspection(restaurant):
     if restaurant.business_id:
         record = InspectionRecords.objects.filter(